@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+ANCS entry points:
+- `ancs.web` creates the Flask app serving the REST API and the metrics (`FLASK_APP=ancs`, uWSGI),
+- `ancs.collector` only polls the drop-ins and exports their metrics (`python -m ancs.collector`),
+- `ancs.footprint` compares the memory and boot time of both modes (`python -m ancs.footprint`).
+
+The Flask app is created on first access to `ancs.app`, so that the collector never loads Flask.
+"""
+
+
+def __getattr__(name: str) -> object:
+    if name == 'app':
+        from ancs.web import app
+        return app
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
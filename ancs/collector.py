@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Headless collector: polls the configured drop-ins and exports their metrics through the standard library HTTP
+server of prometheus_client. Neither Flask, flask_restx nor marshmallow are imported, which lowers the memory
+footprint and boot time of nodes that only collect (e.g. a Pi Zero).
+
+Usage: `python -m ancs.collector [--address 0.0.0.0] [--port 8080]`
+"""
+
+from app.core.background_watcher import BackgroundWatcher
+from app.core.checkpoint import Checkpoint
+from app.core.dropin.loader import DropInLoader
+from app.core.lifecycle import Lifecycle
+from app.core.logs import install_queue
+from argparse import ArgumentParser, Namespace
+from logging import Logger, basicConfig, getLogger
+from os import getenv
+from threading import Event
+from typing import List, Optional
+import signal
+
+LOG_FORMAT = '[%(asctime)s] %(levelname)s in %(module)s at line %(lineno)d: %(message)s'
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Namespace:
+    """
+    Parses the command line, defaults are read from COLLECTOR_ADDRESS and COLLECTOR_PORT.
+
+    :param argv: command line arguments, defaults to sys.argv
+    :type argv: Optional[List[str]]
+    :return: the parsed arguments
+    :rtype: Namespace
+    """
+    parser = ArgumentParser(prog='python -m ancs.collector', description='Polls the drop-ins and exports metrics')
+    parser.add_argument('--address', default=getenv('COLLECTOR_ADDRESS', '0.0.0.0'), help='address to listen on')
+    parser.add_argument('--port', type=int, default=int(getenv('COLLECTOR_PORT', '8080')), help='port of /metrics')
+    return parser.parse_args(argv)
+
+
+def configure_logging() -> Logger:
+    """
+    Logs to stderr with the same format as the Flask app, behind the same queue (see `app.core.logs`).
+
+    :return: the root logger
+    :rtype: Logger
+    """
+    basicConfig(level=getenv('LOG_LEVEL', 'INFO'), format=LOG_FORMAT)
+    install_queue()
+    return getLogger()
+
+
+def start(address: str, port: int, logger: Logger) -> BackgroundWatcher:
+    """
+    Loads the drop-ins, starts the metrics exporter and the watcher.
+
+    :param address: address the exporter listens on
+    :type address: str
+    :param port: port the exporter listens on, 0 picks a free one
+    :type port: int
+    :param logger: a logger instance
+    :type logger: Logger
+    :return: the started watcher
+    :rtype: BackgroundWatcher
+    """
+    from app.core.alerts import load_alerts
+    from app.core.shared_metrics import SnapshotRegistry
+    from app.dropins import load_drop_ins
+    from prometheus_client import start_http_server
+
+    DropInLoader(logger, with_api=False)
+    Checkpoint(logger).load()
+    drop_ins, _ = load_drop_ins()
+    load_alerts(logger)
+    start_http_server(port, addr=address, registry=SnapshotRegistry())
+    logger.info('exporting metrics on {}:{}/metrics'.format(address, port))
+
+    watcher = BackgroundWatcher(drop_ins=drop_ins, logger=logger)
+    watcher.after_cycle.append(Checkpoint().maybe_save)
+    watcher.start()
+    return watcher
+
+
+def stop(watcher: BackgroundWatcher, logger: Logger) -> None:
+    """
+    Stops the watcher, lets the jobs and the commands in progress finish within SHUTDOWN_TIMEOUT, saves the
+    checkpoint and closes the drop-ins.
+
+    :param watcher: the running watcher
+    :type watcher: BackgroundWatcher
+    :param logger: a logger instance
+    :type logger: Logger
+    """
+    from app.core.alerts import AlertEngine
+    from app.core.jobs import JobManager
+
+    lifecycle = Lifecycle(logger)
+    lifecycle.on_shutdown('watcher', watcher.shutdown)
+    lifecycle.on_shutdown('jobs', JobManager(logger).shutdown)
+    lifecycle.on_shutdown('checkpoint', lambda timeout: Checkpoint().save())
+    lifecycle.on_shutdown('alerts', AlertEngine(logger).flush)
+    lifecycle.on_shutdown('drop-ins', DropInLoader().shutdown)
+    lifecycle.shutdown()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Runs the collector until SIGINT or SIGTERM.
+
+    :param argv: command line arguments, defaults to sys.argv
+    :type argv: Optional[List[str]]
+    :return: exit code
+    :rtype: int
+    """
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        pass
+    else:
+        load_dotenv(override=True)
+    args = parse_args(argv)
+    logger = configure_logging()
+
+    stopping = Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    # Alert rules are reloaded from the configuration file on SIGHUP
+    reloading = Event()
+    signal.signal(signal.SIGHUP, lambda *_: reloading.set())
+
+    watcher = start(args.address, args.port, logger)
+    from app.core.alerts import load_alerts
+    while not stopping.wait(1.0):
+        if reloading.is_set():
+            reloading.clear()
+            load_alerts(logger)
+    logger.info('stopping collector...')
+    stop(watcher, logger)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the footprint of the headless collector (`ancs.collector`) and of the full web app (`ancs.web`).
+
+Each mode is started several times in a fresh interpreter, with the drop-ins configured as for production; the
+report gives the median boot time (entry point import until the watcher runs), the time spent importing modules
+(`python -X importtime`), the number of loaded modules and the resident memory once booted.
+
+Usage: `python -m ancs.footprint [--runs 5]`
+"""
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import environ
+from statistics import median
+from typing import Dict, List, Optional
+import subprocess
+import sys
+
+# Started in the measured interpreter, prints the measures as JSON on the last line of stdout
+PROBE = '''
+from time import perf_counter
+started = perf_counter()
+{boot}
+boot = perf_counter() - started
+import json, os, resource, sys
+memory = {{'VmRSS': 0, 'VmHWM': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}
+try:
+    with open('/proc/self/status') as status_fd:
+        for line in status_fd:
+            key, _, value = line.partition(':')
+            if key in memory:
+                memory[key] = int(value.split()[0])
+except OSError:
+    pass
+print(json.dumps({{'boot': boot, 'modules': len(sys.modules), 'rss': memory['VmRSS'], 'peak': memory['VmHWM']}}))
+sys.stdout.flush()
+os._exit(0)
+'''
+
+MODES: Dict[str, str] = {
+    'headless': (
+        'from ancs.collector import configure_logging, start\n'
+        'start("127.0.0.1", 0, configure_logging())'
+    ),
+    'full': 'from ancs import app\napp.name',
+}
+
+
+def measure(mode: str) -> Dict[str, float]:
+    """
+    Boots a mode in a new interpreter and returns its measures.
+
+    :param mode: one of MODES
+    :type mode: str
+    :return: boot and import times (seconds), loaded modules count, RSS and peak RSS (KiB)
+    :rtype: Dict[str, float]
+    """
+    env = dict(environ, LOG_LEVEL='WARNING', FLASK_ENV='production', FLASK_DEBUG='0', WATCHER_LOCK_FILE='')
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE.format(boot=MODES[mode])],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120
+    )
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode or not lines:
+        raise RuntimeError('{} mode failed to boot:\n{}'.format(mode, completed.stderr[-2000:]))
+    measures = loads(lines[-1])
+    # "import time: self [us] | cumulative | imported package"
+    measures['imports'] = sum(
+        int(line.split(':', 1)[1].split('|')[0]) for line in completed.stderr.splitlines()
+        if line.startswith('import time:') and line.split(':', 1)[1].split('|')[0].strip().isdigit()
+    ) / 1e6
+    return measures
+
+
+def report(runs: int) -> Dict[str, Dict[str, float]]:
+    """
+    Median measures of each mode.
+
+    :param runs: number of boots per mode
+    :type runs: int
+    :return: measures indexed by mode
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    results = {}
+    for mode in MODES:
+        samples = [measure(mode) for _ in range(runs)]
+        results[mode] = {key: median(sample[key] for sample in samples) for key in samples[0]}
+    return results
+
+
+def format_report(results: Dict[str, Dict[str, float]]) -> str:
+    """
+    Renders the measures as a table, with the savings of the headless mode.
+
+    :param results: measures indexed by mode, see `report`
+    :type results: Dict[str, Dict[str, float]]
+    :return: the table
+    :rtype: str
+    """
+    rows = [('mode', 'boot (s)', 'imports (s)', 'modules', 'RSS (MiB)', 'peak RSS (MiB)')]
+    for mode, measures in results.items():
+        rows.append((
+            mode,
+            '{:.3f}'.format(measures['boot']),
+            '{:.3f}'.format(measures['imports']),
+            '{:d}'.format(int(measures['modules'])),
+            '{:.1f}'.format(measures['rss'] / 1024),
+            '{:.1f}'.format(measures['peak'] / 1024)
+        ))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+
+    headless, full = results['headless'], results['full']
+    if full['rss'] and full['boot']:
+        lines.append('')
+        lines.append('headless mode saves {:.1f} MiB RSS ({:.0%}) and {:.3f}s of boot time ({:.0%})'.format(
+            (full['rss'] - headless['rss']) / 1024,
+            (full['rss'] - headless['rss']) / full['rss'],
+            full['boot'] - headless['boot'],
+            (full['boot'] - headless['boot']) / full['boot']
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(prog='python -m ancs.footprint', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3, help='boots per mode, the median is reported')
+    parser.add_argument('--json', action='store_true', help='print the raw measures as JSON')
+    args = parser.parse_args(argv)
+
+    results = report(max(1, args.runs))
+    print(dumps(results, indent=2) if args.json else format_report(results))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
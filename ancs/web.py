@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from os import getenv, environ
+
+try:
+    if environ.get("FLASK_ENV") == "development":
+        import pydevd_pycharm
+        pydevd_pycharm.settrace(
+            environ.get("PYDEV_TRACE_ALLOWED_IP", '0.0.0.0'),
+            port=environ.get("PYDEV_TRACE_PORT", 9090),
+            stdoutToServer=True,
+            stderrToServer=True
+        )
+except:
+    pass
+
+from app import create_app
+from app.core.background_watcher import BackgroundWatcher
+from app.core.leader import LeaderElection
+from app.core.lifecycle import Lifecycle
+from app.core.shared_metrics import make_shared_wsgi_app, write_snapshot
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+app = create_app(getenv('FLASK_ENV', "development"))
+app.logger.info("App created !")
+
+
+def start_watcher() -> None:
+    """
+    Initializes the drop-ins and starts polling them; only run by the process elected as watcher leader.
+    """
+    from app.api.proxy import close_leader_socket, serve_leader_socket
+    from app.core.alerts import AlertEngine, load_alerts
+    from app.core.checkpoint import Checkpoint
+    from app.core.dropin.loader import DropInLoader
+    from app.core.jobs import JobManager
+    Checkpoint(app.logger).load()
+    drop_ins = DropInLoader().initialize()
+    load_alerts(app.logger)
+
+    # Reload drop-ins whose module or configuration changed
+    if environ.get("DROP_INS_AUTORELOAD", "0") not in ("0", "false", "no"):
+        from app.core.dropin.autoreload import DropInAutoReloader
+        DropInAutoReloader(DropInLoader(), app.logger).start()
+
+    # Start watcher thread
+    try:
+        thd = BackgroundWatcher(app, drop_ins)
+        thd.after_cycle.append(write_snapshot)
+        thd.after_cycle.append(Checkpoint().maybe_save)
+        thd.start()
+        Lifecycle().on_shutdown('watcher', thd.shutdown)
+    except BaseException as excp:
+        app.logger.error('could not start background watcher, aborting ! Reason: {}'.format(excp))
+    else:
+        app.logger.debug('started background watcher, frequency = {}'.format(BackgroundWatcher.REFRESH_FREQUENCY))
+
+    # Answers the requests the other processes forward to the leader
+    leader_socket = serve_leader_socket(app, app.logger)
+
+    # Once the watcher stopped, the commands in progress complete and the state is flushed before a follower takes over
+    lifecycle = Lifecycle()
+    lifecycle.on_shutdown('jobs', JobManager().shutdown)
+    lifecycle.on_shutdown('checkpoint', lambda timeout: Checkpoint().save())
+    lifecycle.on_shutdown('metrics', lambda timeout: write_snapshot())
+    lifecycle.on_shutdown('alerts', AlertEngine().flush)
+    lifecycle.on_shutdown('drop-ins', DropInLoader().shutdown)
+    if leader_socket is not None:
+        lifecycle.on_shutdown('leader-socket', lambda timeout: close_leader_socket(leader_socket))
+    lifecycle.on_shutdown('leader', lambda timeout: LeaderElection().release())
+
+
+# Avoids double initialization when starting the app with flask in debug mode
+if not app.debug or environ.get("WERKZEUG_RUN_MAIN") == "true":
+    # Load REST api, importing the configured drop-in modules
+    from app.api.module import init_api
+    init_api(app)
+
+    # Installed from the main thread, see `start_watcher` for the shutdown hooks
+    Lifecycle(app.logger).install()
+
+    # Only one process per host polls the sensors, the others wait to take over
+    election = LeaderElection(app.logger)
+    election.start(start_watcher)
+
+    # add Prometheus and REST entry points
+    app.wsgi_app = DispatcherMiddleware(
+        app.wsgi_app,
+        {
+            '/metrics': make_shared_wsgi_app(election)
+        }
+    )
+
+    app.logger.info('initialization ended successfully')
@@ -3,13 +3,15 @@
 Factory to create and configure a Flask instance
 """
 
-from dotenv import load_dotenv
-from flask import Flask
 from logging.config import dictConfig
 from os import getenv, makedirs
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from flask import Flask
 
-def create_app(env=None) -> Flask:
+
+def create_app(env=None) -> 'Flask':
     """
     Returns an instance of a configured Dispatcher, containing the app itself and a prometheus endpoint.
 
@@ -18,10 +20,15 @@ def create_app(env=None) -> Flask:
     :return: a configured Flask instance
     :rtype: Flask
     """
+    # Imported here so that importing `app.core` and the drop-ins does not load Flask (see `ancs.collector`)
+    from app.core.logs import install_queue
+    from dotenv import load_dotenv
+    from flask import Flask
+
     load_dotenv(override=True)
     secret_key = getenv("SECRET_KEY")
 
-    # Setup the logger
+    # Setup the logger, its handlers run behind a queue (see `app.core.logs`)
     dictConfig(
         {
             'version': 1,
@@ -43,6 +50,7 @@ def create_app(env=None) -> Flask:
             }
         }
     )
+    install_queue()
 
     # create and configure the ANCS app
     app = Flask(__name__, instance_relative_config=True)
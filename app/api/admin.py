@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Administrative API used to manage drop-ins at runtime.
+"""
+
+from app.api.auth import admin_required
+from app.api.proxy import forward_to_leader
+from app.core.alerts import AlertEngine, load_alerts
+from app.core.config import DropInConfig
+from app.core.dropin.loader import DropInLoader
+from app.core.exception.dropin_exceptions import BaseDropInException
+from app.core.leader import LeaderElection
+from flask import Response, request
+from flask_restx import Namespace, Resource
+from http import HTTPStatus
+
+api_namespace = Namespace("admin", description="Runtime management of drop-ins", decorators=[admin_required])
+
+
+def describe(name: str) -> dict:
+    """
+    Returns the state of a drop-in instance.
+
+    :param name: name of the instance
+    :type name: str
+    :return: a serializable description of the instance
+    :rtype: dict
+    """
+    loader = DropInLoader()
+    config = loader.configs.get(name)
+    drop_in = loader.drop_ins.get(name)
+    return {
+        'name': name,
+        'module': config.module if config else type(drop_in).__module__,
+        'state': 'ready' if drop_in is not None else 'pending',
+        'interval': drop_in.interval if drop_in is not None else (config.interval if config else None),
+        'labels': drop_in.labels if drop_in is not None else (config.labels if config else {})
+    }
+
+
+def not_leader(timeout: float = None) -> Response:
+    """
+    Response of the processes that do not run the watcher: drop-ins only live in the leader, which answers the
+    request instead (see `app.api.proxy`).
+
+    :param timeout: maximum wait for the leader, in seconds, see `forward_to_leader`
+    :type timeout: float
+    :return: the response of the leader, 503 when it can not be reached
+    :rtype: Response
+    """
+    return forward_to_leader(timeout=timeout)
+
+
+@api_namespace.route('/drop-ins')
+class DropIns(Resource):
+    @classmethod
+    def get(cls):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        loader = DropInLoader()
+        names = sorted(set(loader.configs) | set(loader.drop_ins))
+        return {
+            'status': 200,
+            'leader': LeaderElection().is_leader,
+            'result': [describe(name) for name in names]
+        }, 200
+
+    @classmethod
+    def post(cls):
+        """
+        Load a new drop-in instance, the body holds its configuration (same keys as the configuration file).
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        try:
+            instance = DropInConfig(**(request.get_json(force=True) or {}))
+            drop_in = DropInLoader().add(instance)
+        except (BaseDropInException, TypeError) as excp:
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': str(excp)}, HTTPStatus.BAD_REQUEST
+        except Exception as excp:
+            return {'status': HTTPStatus.INTERNAL_SERVER_ERROR, 'error': str(excp)}, HTTPStatus.INTERNAL_SERVER_ERROR
+        return {'status': HTTPStatus.CREATED, 'result': describe(drop_in.name)}, HTTPStatus.CREATED
+
+
+@api_namespace.route('/drop-ins/<string:name>')
+class DropInInstance(Resource):
+    @classmethod
+    def get(cls, name: str):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        loader = DropInLoader()
+        if name not in loader.configs and name not in loader.drop_ins:
+            return {'status': HTTPStatus.NOT_FOUND, 'error': 'unknown drop-in'}, HTTPStatus.NOT_FOUND
+        return {'status': 200, 'result': describe(name)}, 200
+
+    @classmethod
+    def delete(cls, name: str):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        try:
+            DropInLoader().unload(name)
+        except BaseDropInException as excp:
+            return {'status': HTTPStatus.NOT_FOUND, 'error': str(excp)}, HTTPStatus.NOT_FOUND
+        return {'status': 200, 'result': {'name': name, 'state': 'unloaded'}}, 200
+
+
+@api_namespace.route('/drop-ins/<string:name>/reload')
+class DropInReload(Resource):
+    @classmethod
+    def post(cls, name: str):
+        """
+        Reload a drop-in instance; `?module=0` keeps the current module code and only recreates the instance.
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        reload_module = request.args.get('module', '1') not in ('0', 'false', 'no')
+        try:
+            DropInLoader().reload(name, reload_module=reload_module)
+        except BaseDropInException as excp:
+            return {'status': HTTPStatus.NOT_FOUND, 'error': str(excp)}, HTTPStatus.NOT_FOUND
+        except Exception as excp:
+            return {'status': HTTPStatus.INTERNAL_SERVER_ERROR, 'error': str(excp)}, HTTPStatus.INTERNAL_SERVER_ERROR
+        return {'status': 200, 'result': describe(name)}, 200
+
+
+@api_namespace.route('/alerts')
+class Alerts(Resource):
+    @classmethod
+    def get(cls):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        return {'status': 200, 'result': AlertEngine().states()}, 200
+
+
+@api_namespace.route('/alerts/reload')
+class AlertsReload(Resource):
+    @classmethod
+    def post(cls):
+        """
+        Reload the alert rules and notifiers from the configuration file, firing alerts whose rule did not change
+        keep firing.
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        if not load_alerts():
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': 'invalid alerts configuration'}, HTTPStatus.BAD_REQUEST
+        return {'status': 200, 'result': AlertEngine().states()}, 200
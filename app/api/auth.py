@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Token authentication for administrative endpoints.
+"""
+
+from flask import abort, request
+from functools import wraps
+from hmac import compare_digest
+from os import getenv
+from typing import Callable
+
+
+def admin_required(func: Callable) -> Callable:
+    """
+    Decorator rejecting requests that do not carry the ADMIN_TOKEN environment variable as a bearer token.
+    Administrative endpoints are disabled (403) when ADMIN_TOKEN is not set.
+
+    :param func: the view to protect
+    :type func: Callable
+    :return: the wrapped view
+    :rtype: Callable
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = getenv('ADMIN_TOKEN')
+        if not token:
+            abort(403, 'administrative endpoints are disabled, set ADMIN_TOKEN to enable them')
+        authorization = request.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer ') or not compare_digest(authorization[7:], token):
+            abort(401, 'invalid or missing bearer token')
+        return func(*args, **kwargs)
+    return wrapper
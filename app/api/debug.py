@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Diagnostics of the running process, protected by the admin token (see `app.api.auth`).
+
+`GET /debug/profile?seconds=5&threads=watcher,http&format=collapsed` samples the stacks of the selected threads for
+the given time and returns them as collapsed stacks, or `format=speedscope` for https://www.speedscope.app. The
+request blocks for the duration of the profile; one profile runs at a time. The watcher and the job threads only run
+in the watcher leader, which answers the profiles selecting them.
+"""
+
+from app.api.admin import not_leader
+from app.api.auth import admin_required
+from app.api.proxy import TIMEOUT
+from app.core.leader import LeaderElection
+from app.core.profiler import StackSampler
+from flask import Response, request
+from flask_restx import Namespace, Resource
+from http import HTTPStatus
+from json import dumps
+from threading import Lock
+
+api_namespace = Namespace("debug", description="Diagnostics of the running process", decorators=[admin_required])
+
+profiling = Lock()
+
+
+@api_namespace.route('/profile')
+class Profile(Resource):
+    # Longest profile, in seconds
+    MAX_SECONDS: float = 60.0
+    FORMATS: tuple = ('collapsed', 'speedscope')
+
+    @classmethod
+    def get(cls):
+        """
+        Sample the stacks of the watcher and request threads (`threads` among watcher, http, jobs and all).
+        """
+        try:
+            seconds = float(request.args.get('seconds', 5))
+            interval = float(request.args.get('interval', 0.005))
+            if not 0 < seconds <= cls.MAX_SECONDS or interval < 0.001:
+                raise ValueError('expected 0 < seconds <= {:.0f} and interval >= 0.001'.format(cls.MAX_SECONDS))
+            output = request.args.get('format', 'collapsed')
+            if output not in cls.FORMATS:
+                raise ValueError('expected format among {}'.format(', '.join(cls.FORMATS)))
+            sampler = StackSampler(request.args.get('threads', 'watcher,http').split(','), interval)
+        except ValueError as excp:
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': str(excp)}, HTTPStatus.BAD_REQUEST
+        if sampler.kinds & {StackSampler.WATCHER, StackSampler.JOBS} and not LeaderElection().is_leader:
+            # The leader answers once its profile is complete
+            return not_leader(TIMEOUT + seconds)
+        if not profiling.acquire(blocking=False):
+            return {'status': HTTPStatus.CONFLICT, 'error': 'a profile is already running'}, HTTPStatus.CONFLICT
+        try:
+            sampler.run(seconds)
+        finally:
+            profiling.release()
+
+        headers = {
+            'X-Profile-Samples': str(sampler.rounds),
+            'X-Profile-Overhead': '{:.4f}'.format(sampler.overhead / sampler.duration if sampler.duration else 0.0)
+        }
+        if output == 'speedscope':
+            headers['Content-Disposition'] = 'attachment; filename="ancs.speedscope.json"'
+            return Response(dumps(sampler.speedscope()), mimetype='application/json', headers=headers)
+        return Response(sampler.collapsed(), mimetype='text/plain', headers=headers)
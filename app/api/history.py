@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Latest readings and history of the drop-ins, as published to the pipeline.
+Readings only live in the watcher leader, other processes forward the requests to it (see `app.api.proxy`).
+
+The latest readings carry the version they belong to (see `Pipeline.current`), also sent as their ETag: requests
+with `If-None-Match` get a 304 until new readings are published.
+"""
+
+from app.api.admin import not_leader
+from app.core.exception.dropin_exceptions import ConfigurationException
+from app.core.filters import FilterChain, build_filter
+from app.core.leader import LeaderElection
+from app.core.pipeline import Pipeline
+from app.core.reading import Reading
+from flask import request
+from flask_restx import Namespace, Resource
+from http import HTTPStatus
+from typing import Optional
+
+api_namespace = Namespace("readings", description="Latest readings and history of the drop-ins")
+
+
+def versioned(result: dict, version: int, timestamp: Optional[float]) -> tuple:
+    """
+    Response of the latest readings of a version, or 304 when the client already holds it.
+
+    :param result: the readings
+    :type result: dict
+    :param version: version of the readings
+    :type version: int
+    :param timestamp: time base of the version
+    :type timestamp: Optional[float]
+    :return: the response
+    :rtype: tuple
+    """
+    etag = '{}-{}'.format(Pipeline().epoch, version)
+    headers = {'ETag': '"{}"'.format(etag)}
+    if request.if_none_match.contains(etag):
+        return None, HTTPStatus.NOT_MODIFIED, headers
+    return {'status': 200, 'version': version, 'timestamp': timestamp, 'result': result}, 200, headers
+
+
+@api_namespace.route('')
+class Readings(Resource):
+    @classmethod
+    def get(cls):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        version, timestamp, latest = Pipeline().current()
+        return versioned(
+            {
+                name: {metric: reading.to_dict() for metric, reading in readings.items()}
+                for name, readings in latest.items()
+            },
+            version,
+            timestamp
+        )
+
+
+@api_namespace.route('/<string:name>')
+class DropInReadings(Resource):
+    @classmethod
+    def get(cls, name: str):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        version, timestamp, latest = Pipeline().current()
+        readings = latest.get(name)
+        if readings is None:
+            return {'status': HTTPStatus.NOT_FOUND, 'error': 'no readings for this drop-in'}, HTTPStatus.NOT_FOUND
+        return versioned({metric: reading.to_dict() for metric, reading in readings.items()}, version, timestamp)
+
+
+@api_namespace.route('/<string:name>/<string:metric>/history')
+class History(Resource):
+    @classmethod
+    def get(cls, name: str, metric: str):
+        """
+        Readings of a metric, oldest first; `?since=<unix timestamp>` only returns the newer ones and
+        `?filter=median:5,ema:0.3` replays the valid readings through a filter chain (see `app.core.filters`).
+        `?resolution=1h` returns the rollup buckets of the metric (min, max, mean, count) instead of its readings.
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        try:
+            since = float(request.args['since']) if 'since' in request.args else None
+        except ValueError:
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': 'invalid `since` timestamp'}, HTTPStatus.BAD_REQUEST
+        if request.args.get('resolution'):
+            buckets = Pipeline().sinks['rollups'].buckets(name, metric, request.args['resolution'], since=since)
+            if buckets is None:
+                return {'status': HTTPStatus.BAD_REQUEST, 'error': 'unknown resolution'}, HTTPStatus.BAD_REQUEST
+            return {'status': 200, 'result': [bucket.to_dict() for bucket in buckets]}, 200
+        readings = Pipeline().sinks['history'].series(name, metric, since=since)
+        if request.args.get('filter'):
+            try:
+                chain = FilterChain([build_filter(spec) for spec in request.args['filter'].split(',')])
+            except ConfigurationException as excp:
+                return {'status': HTTPStatus.BAD_REQUEST, 'error': str(excp)}, HTTPStatus.BAD_REQUEST
+            readings = [reading for reading in readings if reading.quality != Reading.BAD]
+            readings = [
+                Reading(reading.metric, value, reading.unit, reading.timestamp, reading.quality)
+                for reading, value in zip(readings, chain.replay([reading.value for reading in readings]))
+            ]
+        return {
+            'status': 200,
+            'result': [
+                {'timestamp': reading.timestamp, 'value': reading.value, 'quality': reading.quality}
+                for reading in readings
+            ]
+        }, 200
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Status of the device jobs (see `app.core.jobs`): poll `/api/jobs/<id>` or stream `/api/jobs/<id>/events`.
+Jobs only live in the watcher leader, other processes forward the requests to it (see `app.api.proxy`).
+"""
+
+from app.api.admin import not_leader
+from app.core.jobs import Job, JobManager
+from app.core.leader import LeaderElection
+from flask import Response
+from flask_restx import Namespace, Resource
+from http import HTTPStatus
+from json import dumps
+from typing import Iterator
+
+api_namespace = Namespace("jobs", description="Long-running device operations")
+
+
+def unknown_job() -> tuple:
+    return {'status': HTTPStatus.NOT_FOUND, 'error': 'unknown job'}, HTTPStatus.NOT_FOUND
+
+
+@api_namespace.route('/<string:job_id>')
+class JobStatus(Resource):
+    @classmethod
+    def get(cls, job_id: str):
+        if not LeaderElection().is_leader:
+            return not_leader()
+        job = JobManager().get(job_id)
+        if job is None:
+            return unknown_job()
+        return {'status': 200, 'result': job.to_dict()}, 200
+
+    @classmethod
+    def delete(cls, job_id: str):
+        """
+        Cancel a job that did not start yet.
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        manager = JobManager()
+        job = manager.get(job_id)
+        if job is None:
+            return unknown_job()
+        if not manager.cancel(job_id):
+            return {'status': HTTPStatus.CONFLICT, 'error': 'the job already started'}, HTTPStatus.CONFLICT
+        return {'status': 200, 'result': job.to_dict()}, 200
+
+
+@api_namespace.route('/<string:job_id>/events')
+class JobEvents(Resource):
+    # Seconds between two comments keeping an idle stream open
+    KEEP_ALIVE: float = 15.0
+
+    @classmethod
+    def get(cls, job_id: str):
+        """
+        Server-sent events: the job is sent on each change, as an event named after its state, until it finishes.
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        manager = JobManager()
+        job = manager.get(job_id)
+        if job is None:
+            return unknown_job()
+
+        def events() -> Iterator[str]:
+            version = None
+            while True:
+                if job.version != version:
+                    version = job.version
+                    yield 'event: {}\ndata: {}\n\n'.format(job.state, dumps(job.to_dict()))
+                    if job.state in Job.FINISHED:
+                        return
+                if not manager.wait(job, version, cls.KEEP_ALIVE):
+                    yield ': keep-alive\n\n'
+
+        return Response(
+            events(),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
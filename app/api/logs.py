@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Recent log records of the process, kept in memory at LOG_RING_LEVEL (see `app.core.logs`); each process keeps its
+own records. Protected by the admin token (see `app.api.auth`).
+"""
+
+from app.api.auth import admin_required
+from app.core.logs import RingHandler
+from flask import request
+from flask_restx import Namespace, Resource
+from http import HTTPStatus
+
+api_namespace = Namespace("logs", description="Recent log records", decorators=[admin_required])
+
+
+@api_namespace.route('')
+class Logs(Resource):
+    @classmethod
+    def get(cls):
+        """
+        Recent records, oldest first: `?level=WARNING&logger=app&since=<id>&limit=100`; poll with the id of the
+        last record received as `since` to only get the new ones.
+        """
+        try:
+            records = RingHandler().query(
+                level=request.args.get('level'),
+                logger=request.args.get('logger'),
+                since=int(request.args.get('since', 0)),
+                limit=int(request.args.get('limit', 100))
+            )
+        except ValueError as excp:
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': str(excp)}, HTTPStatus.BAD_REQUEST
+        return {'status': 200, 'result': records}, 200
@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
+from app.api.admin import api_namespace as admin_namespace
+from app.api.debug import api_namespace as debug_namespace
+from app.api.history import api_namespace as readings_namespace
+from app.api.jobs import api_namespace as jobs_namespace
+from app.api.logs import api_namespace as logs_namespace
+from app.api.stats import api_namespace as stats_namespace
+from app.core.dropin.loader import DropInLoader
 from app.dropins import api_drop_ins
-from flask_restx import Api
+from flask import abort, request
+from flask_restx import Api, Namespace
+from flask_restx.utils import camel_to_dash
+from itertools import chain
 from logging import getLogger
+from types import ModuleType
+from typing import Dict, List, Optional
 
 API_VERSION = '0.1'
 API_TITLE = 'ANCS API'
@@ -14,6 +26,182 @@ api = Api(
 )
 
 logger = getLogger()
+# Flask endpoints of each drop-in module's namespace, and modules whose API is currently disabled
+module_endpoints: Dict[str, List[str]] = {}
+disabled_modules: set = set()
+
+
+def namespace_endpoints(namespace: Namespace) -> List[str]:
+    """
+    Returns the Flask endpoints of a namespace's resources, as computed by flask_restx.
+
+    :param namespace: a flask_restx namespace
+    :type namespace: Namespace
+    :return: list of endpoint names
+    :rtype: List[str]
+    """
+    return [
+        resource.kwargs.get('endpoint') or '{}_{}'.format(namespace.name, camel_to_dash(resource.resource.__name__))
+        for resource in namespace.resources
+    ]
+
+
+def mount_namespace(module_id: str, namespace: Namespace) -> None:
+    """
+    Exposes a drop-in namespace under /api/<module_id>.
+    When the module was already mounted (reload), the view functions of its existing endpoints are rebound to the
+    new resources; new routes can only be added until Flask serves its first request.
+
+    :param module_id: identifier of the drop-in module
+    :type module_id: str
+    :param namespace: the namespace declared by the module
+    :type namespace: Namespace
+    """
+    disabled_modules.discard(module_id)
+    endpoints = namespace_endpoints(namespace)
+    if module_id in module_endpoints:
+        for endpoint in rebind_namespace(api, namespace, "/api/{}".format(module_id)):
+            logger.warning('new route "{}" of drop-in "{}" will be available after a restart'.format(
+                endpoint, module_id
+            ))
+    else:
+        try:
+            api.add_namespace(namespace, path="/api/{}".format(module_id))
+        except AssertionError as excp:
+            logger.warning('API of drop-in "{}" will be available after a restart: {}'.format(module_id, excp))
+            return
+    module_endpoints[module_id] = endpoints
+
+
+def rebind_namespace(target: Api, namespace: Namespace, ns_path: str) -> List[str]:
+    """
+    Replaces a mounted namespace with a new one of the same name, e.g. declared by a reloaded module, and rebinds
+    the Flask views of its endpoints to the new resources.
+
+    flask_restx has no API for this: this is the only function relying on its internals, namely the list of
+    namespaces (`Api.namespaces`), their paths (`Api.ns_paths`), the Apis of a namespace (`Namespace.apis`) and the
+    way `Api._register_view` builds a view (`mediatypes`, `endpoint`, `Api.output` then the decorators of the
+    namespace and of the Api). Flask only accepts new routes until it serves its first request, hence the views of
+    existing endpoints are replaced in `view_functions` instead.
+
+    :param target: the Api the namespace is mounted on
+    :type target: Api
+    :param namespace: the new namespace
+    :type namespace: Namespace
+    :param ns_path: path the namespace is mounted under, e.g. `/api/atlas_ph`
+    :type ns_path: str
+    :return: the endpoints of the new namespace that are not routed yet, left unbound
+    :rtype: List[str]
+    """
+    for position, registered in enumerate(target.namespaces):
+        if registered.name == namespace.name and registered is not namespace:
+            target.namespaces[position] = namespace
+            target.ns_paths[namespace] = target.ns_paths.pop(registered, ns_path)
+    if target not in namespace.apis:
+        namespace.apis.append(target)
+    if target.app is None:
+        # Views are built from the namespaces when the Api is bound to the application
+        return []
+    unbound = []
+    for resource, endpoint in zip(namespace.resources, namespace_endpoints(namespace)):
+        if endpoint not in target.app.view_functions:
+            unbound.append(endpoint)
+            continue
+        resource.resource.mediatypes = target.mediatypes_method()
+        resource.resource.endpoint = endpoint
+        view = target.output(resource.resource.as_view(endpoint, target))
+        for decorator in chain(namespace.decorators, target.decorators):
+            view = decorator(view)
+        target.app.view_functions[endpoint] = view
+    return unbound
+
+
+def on_drop_in_change(event: str, module_name: str, module: Optional[ModuleType]) -> None:
+    """
+    Keeps the API in sync with drop-in modules added, reloaded or unloaded at runtime.
+
+    :param event: one of 'add', 'reload' or 'unload'
+    :type event: str
+    :param module_name: name of the module
+    :type module_name: str
+    :param module: the module object
+    :type module: Optional[ModuleType]
+    """
+    if module is None:
+        return
+    module_id = DropInLoader.module_id(module)
+    if event == 'unload':
+        disabled_modules.add(module_id)
+        logger.info('disabled API of drop-in module "{}"'.format(module_name))
+    elif getattr(module, 'api_namespace', None) is not None:
+        mount_namespace(module_id, module.api_namespace)
+        logger.info('mounted API of drop-in module "{}"'.format(module_name))
+
+
+def reject_disabled_modules() -> None:
+    """
+    Answers 404 to requests targeting the API of an unloaded drop-in module.
+    """
+    if request.endpoint is None or not disabled_modules:
+        return
+    for module_id in disabled_modules:
+        if request.endpoint in module_endpoints.get(module_id, ()):
+            abort(404)
+
+
+def init_api(app) -> None:
+    """
+    Registers the REST API on the Flask application.
+
+    :param app: the Flask application
+    :type app: Flask
+    """
+    api.init_app(app)
+    app.before_request(reject_disabled_modules)
+    DropInLoader().subscribe(on_drop_in_change)
+
+
+api.add_namespace(admin_namespace, path="/api/admin")
+api.add_namespace(readings_namespace, path="/api/readings")
+api.add_namespace(jobs_namespace, path="/api/jobs")
+api.add_namespace(logs_namespace, path="/api/logs")
+api.add_namespace(stats_namespace, path="/api/stats")
+api.add_namespace(debug_namespace, path="/debug")
 api_modules = api_drop_ins
 for module_id, api_namespace in api_modules.items():
-    api.add_namespace(api_namespace, path="/api/{}".format(module_id))
+    mount_namespace(module_id, api_namespace)
+
+
+class TestMountNamespace(object):
+    def test_rebind(self) -> None:
+        from flask import Flask
+        from flask_restx import Resource
+
+        def declare(value: int, extra: bool = False) -> Namespace:
+            namespace = Namespace('test_probe')
+
+            @namespace.route('/value')
+            class Value(Resource):
+                def get(self) -> dict:
+                    return {'value': value}
+
+            if extra:
+                @namespace.route('/extra')
+                class Extra(Resource):
+                    def get(self) -> dict:
+                        return {}
+            return namespace
+
+        app = Flask(__name__)
+        target = Api(app)
+        first = declare(1)
+        target.add_namespace(first, path='/api/test_probe')
+        client = app.test_client()
+        assert client.get('/api/test_probe/value').get_json() == {'value': 1}
+
+        second = declare(2, extra=True)
+        assert namespace_endpoints(second) == ['test_probe_value', 'test_probe_extra']
+        assert rebind_namespace(target, second, '/api/test_probe') == ['test_probe_extra']
+        assert client.get('/api/test_probe/value').get_json() == {'value': 2}
+        assert second in target.namespaces and first not in target.namespaces
+        assert target.ns_paths[second] == '/api/test_probe' and target in second.apis
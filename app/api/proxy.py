@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Forwarding of the requests that need the state of the watcher leader (readings, history, jobs, alerts, drop-ins).
+
+Drop-ins, readings and jobs only live in the process elected as watcher leader (see `app.core.leader`), while any
+uWSGI worker may receive a request. The leader serves the application on a Unix socket (LEADER_SOCKET) besides the
+shared HTTP socket; the other processes forward such requests to it and stream its response back, so that clients
+never have to know which worker leads.
+
+Forwarded requests carry FORWARDED_HEADER: a process that lost the leadership answers them with 503 instead of
+forwarding them again.
+"""
+
+from flask import Flask, Response, request
+from http import HTTPStatus
+from http.client import HTTPConnection, HTTPException
+from json import dumps
+from logging import Logger, getLogger
+from os import getenv, getpid, path, unlink
+from socket import AF_UNIX, SOCK_STREAM, socket
+from threading import Thread
+from typing import Iterator, Optional
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+
+LEADER_SOCKET: str = getenv('LEADER_SOCKET', '/tmp/ancs-leader.sock')
+# Maximum wait for the leader to accept a request or send the next part of its response, in seconds
+TIMEOUT: float = float(getenv('LEADER_PROXY_TIMEOUT', '30'))
+FORWARDED_HEADER: str = 'X-ANCS-Forwarded'
+# Connection-specific headers, not forwarded (RFC 7230, section 6.1)
+HOP_BY_HOP: frozenset = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'transfer-encoding',
+    'upgrade', 'host', 'content-length'
+))
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """
+    HTTP connection to a server listening on a Unix socket.
+    """
+
+    def __init__(self, socket_path: str, timeout: float) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class LeaderRequestHandler(WSGIRequestHandler):
+    """
+    Handler of the requests forwarded to the leader; HTTP/1.0 closes the connection after each streamed response.
+    """
+    protocol_version = 'HTTP/1.0'
+
+    def log_request(self, *args) -> None:
+        # Already logged by the process that received the request
+        pass
+
+
+def unavailable(error: str) -> Response:
+    """
+    JSON 503 response, the client is expected to retry.
+
+    :param error: description of the error
+    :type error: str
+    :return: the response
+    :rtype: Response
+    """
+    return Response(
+        dumps({'status': HTTPStatus.SERVICE_UNAVAILABLE, 'error': error}),
+        status=HTTPStatus.SERVICE_UNAVAILABLE,
+        mimetype='application/json',
+        headers={'Retry-After': '1'}
+    )
+
+
+def forward_to_leader(socket_path: str = None, timeout: float = None) -> Response:
+    """
+    Sends the current request to the watcher leader and streams its response back.
+
+    :param socket_path: socket of the leader, defaults to LEADER_SOCKET
+    :type socket_path: str
+    :param timeout: maximum wait for the leader, in seconds, defaults to TIMEOUT
+    :type timeout: float
+    :return: the response of the leader, or a 503 when it can not be reached
+    :rtype: Response
+    """
+    if request.headers.get(FORWARDED_HEADER):
+        return unavailable('this process does not run the watcher anymore, retry later')
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP}
+    headers[FORWARDED_HEADER] = str(getpid())
+    connection = UnixHTTPConnection(socket_path or LEADER_SOCKET, TIMEOUT if timeout is None else timeout)
+    try:
+        connection.request(request.method, request.full_path.rstrip('?'), request.get_data(), headers)
+        response = connection.getresponse()
+    except (OSError, HTTPException) as excp:
+        connection.close()
+        getLogger().warning('could not forward {} {} to the watcher leader: {}'.format(
+            request.method, request.path, excp
+        ))
+        return unavailable('the watcher leader can not be reached, retry later')
+
+    def body() -> Iterator[bytes]:
+        try:
+            # Server-sent events are passed on as they arrive
+            chunk = response.read1(65536)
+            while chunk:
+                yield chunk
+                chunk = response.read1(65536)
+        finally:
+            connection.close()
+
+    return Response(
+        body(),
+        status=response.status,
+        headers=[(name, value) for name, value in response.getheaders() if name.lower() not in HOP_BY_HOP],
+        direct_passthrough=True
+    )
+
+
+def serve_leader_socket(app: Flask, logger: Logger = None, socket_path: str = None) -> Optional[BaseWSGIServer]:
+    """
+    Serves the application on the leader socket from a daemon thread, replacing the socket of a previous leader.
+
+    :param app: the Flask application
+    :type app: Flask
+    :param logger: a logger instance
+    :type logger: Logger
+    :param socket_path: path of the socket, defaults to LEADER_SOCKET
+    :type socket_path: str
+    :return: the server, to shut down when giving the leadership up; None when the socket could not be bound
+    :rtype: Optional[BaseWSGIServer]
+    """
+    logger = logger or getLogger()
+    socket_path = socket_path or LEADER_SOCKET
+    try:
+        server = make_server('unix://' + socket_path, 0, app, threaded=True, request_handler=LeaderRequestHandler)
+    # werkzeug exits when the socket can not be bound
+    except (OSError, SystemExit) as excp:
+        logger.error('could not serve the leader socket {}, other processes can not forward requests: {}'.format(
+            socket_path, excp
+        ))
+        return None
+    Thread(target=server.serve_forever, name='leader-socket', daemon=True).start()
+    logger.info('serving forwarded requests on {}'.format(socket_path))
+    return server
+
+
+def close_leader_socket(server: BaseWSGIServer) -> None:
+    """
+    Stops serving the leader socket and removes it.
+
+    :param server: the server returned by `serve_leader_socket`
+    :type server: BaseWSGIServer
+    """
+    server.shutdown()
+    server.server_close()
+    if path.exists(server.server_address):
+        unlink(server.server_address)
+
+
+class TestProxy(object):
+    def test_forward(self) -> None:
+        from tempfile import mkdtemp
+
+        leader = Flask('leader')
+
+        @leader.route('/api/readings/<name>', methods=['GET', 'POST'])
+        def readings(name: str):
+            return {
+                'name': name,
+                'args': request.args.to_dict(),
+                'body': request.get_data(as_text=True),
+                'forwarded': request.headers.get(FORWARDED_HEADER) == str(getpid())
+            }, 201, {'ETag': '"1-2"'}
+
+        socket_path = path.join(mkdtemp(), 'leader.sock')
+        follower = Flask('follower')
+        follower.add_url_rule(
+            '/api/<path:target>', 'forward', lambda target: forward_to_leader(socket_path), methods=['GET', 'POST']
+        )
+        client = follower.test_client()
+        assert client.get('/api/readings/ph').status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+        server = serve_leader_socket(leader, socket_path=socket_path)
+        try:
+            response = client.post('/api/readings/ph?since=10', data='payload')
+            assert (response.status_code, response.headers['ETag']) == (201, '"1-2"')
+            assert response.get_json() == {'name': 'ph', 'args': {'since': '10'}, 'body': 'payload', 'forwarded': True}
+            looped = client.get('/api/readings/ph', headers={FORWARDED_HEADER: '1'})
+            assert looped.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+        finally:
+            close_leader_socket(server)
+        assert not path.exists(socket_path)
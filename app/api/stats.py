@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+CPU and wall time spent on each drop-in since the start of the watcher leader (see `app.core.accounting`), to size
+how many sensors a host can poll. Other processes forward the requests to the leader (see `app.api.proxy`).
+"""
+
+from app.api.admin import not_leader
+from app.core.accounting import CostAccounting
+from app.core.leader import LeaderElection
+from flask_restx import Namespace, Resource
+
+api_namespace = Namespace("stats", description="Time spent on each drop-in")
+
+
+@api_namespace.route('')
+class Stats(Resource):
+    @classmethod
+    def get(cls):
+        """
+        CPU and wall time of each drop-in, by stage (periodic call, wake up and each output), per call and as a
+        share of the elapsed time.
+        """
+        if not LeaderElection().is_leader:
+            return not_leader()
+        return {'status': 200, 'result': CostAccounting().summary()}, 200
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+CPU and wall time spent on each drop-in, by stage: the periodic call run by the watcher (sampling, screening,
+conditioning, deriving, logging), waking the device up, and each output of the pipeline (`output:<sink>`).
+
+CPU time is the time of the running thread (`time.thread_time`), so that the API and the other threads are not
+charged to the drop-in. Stages are exclusive: the outputs dispatched within a periodic call are not counted in the
+`periodic_call` stage, the stages of a drop-in add up to its total. Isolated drop-ins are only charged for what their
+proxy does in this process.
+
+Exported as `ancs_drop_in_cpu_seconds`, `ancs_drop_in_wall_seconds` and `ancs_drop_in_calls`, by `drop_in_name` and
+`stage`, and summarized by `/api/stats`.
+"""
+
+from app.core.helper.metrics import get_or_create
+from app.core.helper.singleton import Singleton
+from contextlib import contextmanager
+from os import cpu_count
+from prometheus_client import Counter
+from threading import Lock, local
+from time import monotonic, perf_counter, process_time, thread_time
+from typing import Dict, Iterator, List, Tuple
+
+
+class CostAccounting(object, metaclass=Singleton):
+    """
+    Accumulates the CPU and wall time of the measured stages of each drop-in.
+    """
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        self._process_started = process_time()
+        # Calls, CPU and wall time of each (drop-in name, stage)
+        self.totals: Dict[Tuple[str, str], List[float]] = {}
+        self._lock = Lock()
+        # Time of the nested stages of the stages running in each thread
+        self._local = local()
+        labels = ['drop_in_name', 'stage']
+        self.cpu = get_or_create(
+            Counter,
+            'ancs_drop_in_cpu_seconds',
+            'CPU time of the thread running each stage of a drop-in, nested stages excluded',
+            labels
+        )
+        self.wall = get_or_create(
+            Counter,
+            'ancs_drop_in_wall_seconds',
+            'Wall time of each stage of a drop-in, nested stages excluded',
+            labels
+        )
+        self.calls = get_or_create(Counter, 'ancs_drop_in_calls', 'Number of runs of each stage of a drop-in', labels)
+
+    @contextmanager
+    def measure(self, drop_in_name: str, stage: str) -> Iterator[None]:
+        """
+        Charges the time spent in the block to a stage of a drop-in, minus the time of the stages measured within.
+
+        :param drop_in_name: name of the drop-in instance
+        :type drop_in_name: str
+        :param stage: name of the stage, e.g. `periodic_call`
+        :type stage: str
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        nested = [0.0, 0.0]
+        stack.append(nested)
+        cpu, wall = thread_time(), perf_counter()
+        try:
+            yield
+        finally:
+            cpu, wall = thread_time() - cpu, perf_counter() - wall
+            stack.pop()
+            if stack:
+                stack[-1][0] += cpu
+                stack[-1][1] += wall
+            self.record(drop_in_name, stage, max(0.0, cpu - nested[0]), max(0.0, wall - nested[1]))
+
+    def record(self, drop_in_name: str, stage: str, cpu: float, wall: float) -> None:
+        """
+        Charges a run of a stage to a drop-in.
+
+        :param drop_in_name: name of the drop-in instance
+        :type drop_in_name: str
+        :param stage: name of the stage
+        :type stage: str
+        :param cpu: CPU time of the run, in seconds
+        :type cpu: float
+        :param wall: wall time of the run, in seconds
+        :type wall: float
+        """
+        with self._lock:
+            totals = self.totals.get((drop_in_name, stage))
+            if totals is None:
+                totals = self.totals[(drop_in_name, stage)] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += cpu
+            totals[2] += wall
+        self.calls.labels(drop_in_name, stage).inc()
+        self.cpu.labels(drop_in_name, stage).inc(cpu)
+        self.wall.labels(drop_in_name, stage).inc(wall)
+
+    def forget(self, drop_in_name: str) -> None:
+        """
+        Drops the time of an unloaded drop-in instance.
+
+        :param drop_in_name: name of the instance
+        :type drop_in_name: str
+        """
+        with self._lock:
+            keys = [key for key in self.totals if key[0] == drop_in_name]
+            for key in keys:
+                del self.totals[key]
+        for key in keys:
+            for counter in (self.calls, self.cpu, self.wall):
+                try:
+                    counter.remove(*key)
+                except KeyError:
+                    pass
+
+    def summary(self) -> dict:
+        """
+        Summarizes the time of each drop-in since the start of the process: per call, and as a share of the
+        elapsed time (`cpu_load` in cores, `busy` for the watcher, which runs the drop-ins one after the other).
+
+        :return: process totals and the time of each drop-in, by stage
+        :rtype: dict
+        """
+        elapsed = max(monotonic() - self.started, 1e-9)
+        with self._lock:
+            totals = sorted((key, list(values)) for key, values in self.totals.items())
+        drop_ins = {}
+        for (drop_in_name, stage), (calls, cpu, wall) in totals:
+            entry = drop_ins.setdefault(drop_in_name, {'cpu_seconds': 0.0, 'wall_seconds': 0.0, 'stages': {}})
+            entry['stages'][stage] = {
+                'calls': calls,
+                'cpu_seconds': cpu,
+                'wall_seconds': wall,
+                'cpu_per_call_ms': 1000.0 * cpu / calls,
+                'wall_per_call_ms': 1000.0 * wall / calls
+            }
+            entry['cpu_seconds'] += cpu
+            entry['wall_seconds'] += wall
+        for entry in drop_ins.values():
+            entry['cpu_load'] = entry['cpu_seconds'] / elapsed
+            entry['busy'] = entry['wall_seconds'] / elapsed
+        process_cpu = process_time() - self._process_started
+        return {
+            'elapsed_seconds': elapsed,
+            'cpu_count': cpu_count(),
+            'process_cpu_seconds': process_cpu,
+            'process_cpu_load': process_cpu / elapsed,
+            'drop_ins_cpu_load': sum(entry['cpu_load'] for entry in drop_ins.values()),
+            'drop_ins_busy': sum(entry['busy'] for entry in drop_ins.values()),
+            'drop_ins': drop_ins
+        }
+
+
+class TestCostAccounting(object):
+    def test_nested_stages(self) -> None:
+        from time import sleep
+
+        accounting = object.__new__(CostAccounting)
+        accounting.__init__()
+        with accounting.measure('test_probe', 'periodic_call'):
+            sum(range(100000))
+            with accounting.measure('test_probe', 'output:history'):
+                sleep(0.05)
+        with accounting.measure('test_probe', 'periodic_call'):
+            pass
+
+        calls, cpu, wall = accounting.totals[('test_probe', 'periodic_call')]
+        assert calls == 2 and cpu > 0 and wall < 0.05
+        assert accounting.totals[('test_probe', 'output:history')][2] >= 0.05
+        stages = accounting.summary()['drop_ins']['test_probe']['stages']
+        assert set(stages) == {'periodic_call', 'output:history'} and stages['output:history']['calls'] == 1
+        accounting.forget('test_probe')
+        assert accounting.summary()['drop_ins'] == {}
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive sampling: the interval between two periodic calls of a drop-in grows while its readings stay still, and
+falls back to the fastest rate as soon as one of them moves.
+
+Enabled per drop-in instance, under the `adaptive` key:
+
+    adaptive:
+      min_interval: 10
+      max_interval: 600
+      backoff: 2
+      metrics:
+        # the interval snaps back to `min_interval` when the moisture moves by more than 2 since the last change,
+        # or by more than 0.5 per minute since the previous reading
+        moisture: {deadband: 2, rate: 0.5}
+        # short form, deadband only
+        temperature: 0.5
+
+Otherwise, each periodic call multiplies the interval by `backoff`, up to `max_interval`. The current interval of the
+instance is exported as `<DROP_IN_ID>_sampling_interval_seconds`.
+"""
+
+from app.core.exception.dropin_exceptions import ConfigurationException
+from app.core.reading import Reading
+from typing import Dict, List, Optional, Union
+
+
+class Deadband(object):
+    """
+    Change detector of a metric: a value moving further than `deadband` from the value of the last change, or faster
+    than `rate` per minute since the previous value, is a change.
+    """
+    __slots__ = ('deadband', 'rate', 'reference', 'previous', 'previous_timestamp')
+
+    def __init__(self, deadband: float, rate: float = None) -> None:
+        """
+        Ctor
+
+        :param deadband: largest move of the value that is not a change
+        :type deadband: float
+        :param rate: largest rate of change of the value per minute that is not a change, None to ignore it
+        :type rate: float
+        """
+        if float(deadband) < 0 or (rate is not None and float(rate) <= 0):
+            raise ValueError('the deadband must be positive or zero and the rate positive')
+        self.deadband = float(deadband)
+        self.rate = float(rate) if rate is not None else None
+        self.reference: Optional[float] = None
+        self.previous: Optional[float] = None
+        self.previous_timestamp: Optional[float] = None
+
+    def changed(self, value: float, timestamp: float) -> bool:
+        """
+        Tells whether a new value is a change, which becomes the reference of the next ones.
+
+        :param value: the new value
+        :type value: float
+        :param timestamp: unix timestamp of the value
+        :type timestamp: float
+        :return: True if the value changed
+        :rtype: bool
+        """
+        changed = self.reference is None or abs(value - self.reference) > self.deadband
+        if not changed and self.rate is not None and timestamp > self.previous_timestamp:
+            changed = abs(value - self.previous) * 60.0 / (timestamp - self.previous_timestamp) > self.rate
+        self.previous, self.previous_timestamp = value, timestamp
+        if changed:
+            self.reference = value
+        return changed
+
+
+class AdaptiveInterval(object):
+    """
+    Interval between two periodic calls of a drop-in, backing off exponentially while its readings stay within
+    their deadbands.
+    """
+
+    def __init__(
+            self,
+            metrics: Dict[str, Union[float, str, dict]],
+            min_interval: float = 10.0,
+            max_interval: float = 600.0,
+            backoff: float = 2.0
+    ) -> None:
+        """
+        Ctor
+
+        :param metrics: deadband of each metric, `{deadband: 2, rate: 0.5}`, `2:0.5` or `2`
+        :type metrics: Dict[str, Union[float, str, dict]]
+        :param min_interval: interval after a change, in seconds
+        :type min_interval: float
+        :param max_interval: longest interval, in seconds
+        :type max_interval: float
+        :param backoff: factor applied to the interval by each periodic call without change
+        :type backoff: float
+        """
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.backoff = float(backoff)
+        if not 0 < self.min_interval <= self.max_interval or self.backoff < 1:
+            raise ValueError('expected 0 < min_interval <= max_interval and backoff >= 1')
+        if not metrics or not isinstance(metrics, dict):
+            raise ValueError('`metrics` must map at least one metric to its deadband')
+        self.deadbands: Dict[str, Deadband] = {}
+        for metric, spec in metrics.items():
+            if isinstance(spec, dict):
+                self.deadbands[str(metric)] = Deadband(**spec)
+            else:
+                self.deadbands[str(metric)] = Deadband(*(float(arg) for arg in str(spec).split(':')))
+        self.interval = self.min_interval
+
+    def update(self, readings: List[Reading]) -> float:
+        """
+        Computes the interval before the next periodic call from the readings of the current one.
+        Bad readings are ignored; a call without any valid reading of the tracked metrics keeps the interval.
+
+        :param readings: published readings
+        :type readings: List[Reading]
+        :return: the interval, in seconds
+        :rtype: float
+        """
+        tracked = changed = False
+        for reading in readings:
+            deadband = self.deadbands.get(reading.metric)
+            if deadband is None or reading.quality == Reading.BAD:
+                continue
+            tracked = True
+            # Every deadband sees the reading, so that the references of all the metrics stay current
+            changed = deadband.changed(reading.value, reading.timestamp) or changed
+        if changed:
+            self.interval = self.min_interval
+        elif tracked:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
+
+
+def build_adaptive(config: Optional[dict]) -> Optional[AdaptiveInterval]:
+    """
+    Builds the adaptive interval of a drop-in instance.
+
+    :param config: settings found under the `adaptive` key of an instance
+    :type config: Optional[dict]
+    :return: the adaptive interval, None when not configured
+    :rtype: Optional[AdaptiveInterval]
+    """
+    if not config:
+        return None
+    if not isinstance(config, dict):
+        raise ConfigurationException('`adaptive` must declare `metrics` and optionally the interval bounds')
+    try:
+        return AdaptiveInterval(**config)
+    except (TypeError, ValueError) as excp:
+        raise ConfigurationException('invalid adaptive sampling "{}": {}'.format(config, excp))
+
+
+class TestAdaptive(object):
+    def test_backoff(self) -> None:
+        adaptive = AdaptiveInterval({'moisture': '2:3'}, min_interval=10, max_interval=60)
+        intervals = []
+        for timestamp, value in ((0, 40.0), (10, 40.5), (30, 41.0), (70, 40.2), (130, 41.5), (190, 50.0)):
+            intervals.append(adaptive.update([Reading('moisture', value, timestamp=timestamp)]))
+        assert intervals == [10, 20, 40, 60, 60, 10]
+        # A fast move within the deadband is a change too
+        assert adaptive.update([Reading('moisture', 51.5, timestamp=200)]) == 10
+        assert adaptive.update([Reading('moisture', -1.0, timestamp=210, quality=Reading.BAD)]) == 10
+
+    def test_config(self) -> None:
+        import pytest
+
+        assert build_adaptive(None) is None
+        assert build_adaptive({'metrics': {'moisture': {'deadband': 1}}}).deadbands['moisture'].rate is None
+        for config in ({'metrics': {}}, {'metrics': {'t': 1}, 'min_interval': 0}, {'metrics': {'t': 'x'}}, [1]):
+            with pytest.raises(ConfigurationException):
+                build_adaptive(config)
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+Local alert rules, evaluated on each published reading so that alerts neither wait for a scrape nor depend on the
+uplink.
+
+Rules and notifiers are declared in the configuration file, next to the drop-ins:
+
+    notifiers:
+      ops: {type: webhook, url: 'https://hooks.example.org/greenhouse', timeout: 5}
+      broker: {type: mqtt, host: localhost, topic: greenhouse/alerts}
+    alerts:
+      - name: dry_bed
+        source: soil_north.moisture
+        below: 20
+        clear: 25           # hysteresis: resolved once the moisture is back above 25
+        for: 300            # seconds the condition must hold before firing
+        notify: [log, ops]
+      - name: ph_drift
+        source: ph.ph
+        rate: 0.5           # absolute change per minute
+        severity: critical
+        notify: [broker]
+
+Each rule keeps a constant amount of state and only the rules of the published metric are evaluated. Notifications
+are sent by a background thread, a slow webhook never delays the watcher. The `log` notifier is always available.
+Rules are reloaded with the configuration file (see `app.core.dropin.autoreload`) or through the admin API.
+"""
+
+from app.core.exception.dropin_exceptions import ConfigurationException
+from app.core.helper.metrics import get_or_create
+from app.core.helper.singleton import Singleton
+from app.core.pipeline import Pipeline, Sink
+from app.core.reading import Reading
+from json import dumps
+from logging import Logger, getLogger
+from prometheus_client import Counter, Gauge
+from queue import Full, Queue
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple, Type
+from urllib.request import Request, urlopen
+
+
+class Rule(object):
+    """
+    Threshold (`above`, `below`) or rate of change (`rate`, per minute) rule on the readings of one metric, with an
+    optional hysteresis (`clear`) and debounce delay (`for`, in seconds).
+    """
+    FIRING: str = 'firing'
+    RESOLVED: str = 'resolved'
+
+    def __init__(
+            self,
+            name: str,
+            source: str,
+            above: float = None,
+            below: float = None,
+            rate: float = None,
+            clear: float = None,
+            hold: float = 0.0,
+            severity: str = 'warning',
+            notify: List[str] = None,
+            description: str = ''
+    ) -> None:
+        """
+        Ctor
+
+        :param name: unique name of the rule
+        :type name: str
+        :param source: `<instance>.<metric>` watched by the rule
+        :type source: str
+        :param above: fires when the value is greater than this threshold
+        :type above: float
+        :param below: fires when the value is lower than this threshold
+        :type below: float
+        :param rate: fires when the value changes by more than this amount per minute
+        :type rate: float
+        :param clear: threshold (or rate) under which a firing alert resolves, defaults to the firing one
+        :type clear: float
+        :param hold: seconds the condition must hold before the alert fires
+        :type hold: float
+        :param severity: free-form severity sent with the notifications
+        :type severity: str
+        :param notify: names of the notifiers of the rule, defaults to `log`
+        :type notify: List[str]
+        :param description: free-form description sent with the notifications
+        :type description: str
+        """
+        conditions = [condition for condition in (above, below, rate) if condition is not None]
+        if len(conditions) != 1:
+            raise ValueError('a rule needs exactly one of `above`, `below` or `rate`')
+        if '.' not in str(source):
+            raise ValueError('`source` must be `<instance>.<metric>`')
+        self.name = str(name)
+        self.source = str(source)
+        self.above = float(above) if above is not None else None
+        self.below = float(below) if below is not None else None
+        self.rate = abs(float(rate)) if rate is not None else None
+        self.clear = float(clear) if clear is not None else conditions[0]
+        self.hold = float(hold)
+        self.severity = str(severity)
+        self.notify = list(notify or ['log'])
+        self.description = str(description)
+        self.firing = False
+        self.value: Optional[float] = None
+        self._pending_since: Optional[float] = None
+        self._previous: Optional[Tuple[float, float]] = None
+
+    def breached(self, reading: Reading) -> bool:
+        """
+        Tells whether a reading breaches the rule, the clear threshold applying while the alert fires.
+
+        :param reading: a valid reading of the source
+        :type reading: Reading
+        :return: True if the condition is met
+        :rtype: bool
+        """
+        if self.above is not None:
+            return reading.value > (self.clear if self.firing else self.above)
+        if self.below is not None:
+            return reading.value < (self.clear if self.firing else self.below)
+        previous, self._previous = self._previous, (reading.timestamp, reading.value)
+        if previous is None or reading.timestamp <= previous[0]:
+            return self.firing
+        rate = abs(reading.value - previous[1]) / (reading.timestamp - previous[0]) * 60.0
+        return rate > (abs(self.clear) if self.firing else self.rate)
+
+    def evaluate(self, reading: Reading) -> Optional[str]:
+        """
+        Updates the state of the rule with a new reading.
+
+        :param reading: a reading of the source
+        :type reading: Reading
+        :return: FIRING or RESOLVED when the state of the alert changes, None otherwise
+        :rtype: Optional[str]
+        """
+        if reading.quality == Reading.BAD:
+            return None
+        self.value = reading.value
+        if not self.breached(reading):
+            self._pending_since = None
+            if self.firing:
+                self.firing = False
+                return self.RESOLVED
+            return None
+        if self._pending_since is None:
+            self._pending_since = reading.timestamp
+        if not self.firing and reading.timestamp - self._pending_since >= self.hold:
+            self.firing = True
+            return self.FIRING
+        return None
+
+    def same_as(self, other: 'Rule') -> bool:
+        definition = ('source', 'above', 'below', 'rate', 'clear', 'hold')
+        return all(getattr(self, key) == getattr(other, key) for key in definition)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'source': self.source,
+            'severity': self.severity,
+            'state': self.FIRING if self.firing else ('pending' if self._pending_since is not None else 'ok'),
+            'value': self.value,
+            'notify': self.notify
+        }
+
+
+class Notifier(object):
+    """
+    Destination of the alert notifications; `notify` runs in the notifications thread.
+    """
+
+    def notify(self, event: dict) -> None:
+        """
+        Sends a notification.
+
+        :param event: the alert name, state, source, value, timestamp, severity and description
+        :type event: dict
+        """
+        raise NotImplementedError
+
+
+class LogNotifier(Notifier):
+    def __init__(self, logger: Logger = None) -> None:
+        self.logger = logger or getLogger()
+
+    def notify(self, event: dict) -> None:
+        log = self.logger.warning if event['state'] == Rule.FIRING else self.logger.info
+        log('alert "{}" {}: {} = {} ({})'.format(
+            event['alert'], event['state'], event['source'], event['value'], event['severity']
+        ))
+
+
+class WebhookNotifier(Notifier):
+    """
+    POSTs the event as JSON.
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0, headers: Dict[str, str] = None) -> None:
+        self.url = url
+        self.timeout = float(timeout)
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+
+    def notify(self, event: dict) -> None:
+        request = Request(self.url, data=dumps(event).encode(), headers=self.headers, method='POST')
+        with urlopen(request, timeout=self.timeout):
+            pass
+
+
+class MqttNotifier(Notifier):
+    """
+    Publishes the event as JSON on an MQTT topic, requires paho-mqtt.
+    """
+
+    def __init__(self, host: str, port: int = 1883, topic: str = 'ancs/alerts', qos: int = 1, **auth) -> None:
+        try:
+            from paho.mqtt import publish
+        except ImportError:
+            raise ValueError('the mqtt notifier requires paho-mqtt')
+        self._publish = publish
+        self.host = host
+        self.port = int(port)
+        self.topic = topic
+        self.qos = int(qos)
+        self.auth = auth or None
+
+    def notify(self, event: dict) -> None:
+        self._publish.single(
+            self.topic,
+            dumps(event),
+            qos=self.qos,
+            hostname=self.host,
+            port=self.port,
+            auth=self.auth
+        )
+
+
+NOTIFIERS: Dict[str, Type[Notifier]] = {
+    'log': LogNotifier,
+    'webhook': WebhookNotifier,
+    'mqtt': MqttNotifier
+}
+
+
+def build_rules(config: List[dict]) -> List[Rule]:
+    """
+    Builds the rules declared under the `alerts` key of the configuration.
+
+    :param config: the rules
+    :type config: List[dict]
+    :return: the rules
+    :rtype: List[Rule]
+    """
+    rules = []
+    for spec in config or []:
+        try:
+            spec = dict(spec)
+            spec['hold'] = spec.pop('for', spec.get('hold', 0.0))
+            rules.append(Rule(**spec))
+        except (TypeError, ValueError) as excp:
+            raise ConfigurationException('invalid alert rule "{}": {}'.format(spec, excp))
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ConfigurationException('alert rules must have distinct names: {}'.format(', '.join(names)))
+    return rules
+
+
+def build_notifiers(config: Dict[str, dict], logger: Logger = None) -> Dict[str, Notifier]:
+    """
+    Builds the notifiers declared under the `notifiers` key of the configuration, plus the `log` one.
+
+    :param config: settings of each notifier, with their `type`
+    :type config: Dict[str, dict]
+    :param logger: logger of the `log` notifier
+    :type logger: Logger
+    :return: notifiers indexed by name
+    :rtype: Dict[str, Notifier]
+    """
+    notifiers: Dict[str, Notifier] = {'log': LogNotifier(logger)}
+    for name, spec in (config or {}).items():
+        try:
+            spec = dict(spec)
+            notifier_type = spec.pop('type')
+            notifiers[name] = LogNotifier(logger) if notifier_type == 'log' else NOTIFIERS[notifier_type](**spec)
+        except KeyError:
+            raise ConfigurationException(
+                'notifier "{}" needs a `type` among {}'.format(name, ', '.join(sorted(NOTIFIERS)))
+            )
+        except (TypeError, ValueError) as excp:
+            raise ConfigurationException('invalid notifier "{}": {}'.format(name, excp))
+    return notifiers
+
+
+class AlertEngine(Sink, metaclass=Singleton):
+    """
+    Evaluates the rules of each published reading and queues the notifications of the alerts changing state.
+    Registered on the pipeline by the first `load`.
+    """
+    # Notifications waiting to be sent beyond which new ones are dropped
+    QUEUE_SIZE: int = 1000
+
+    def __init__(self, logger: Logger = None) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        """
+        self.logger = logger or getLogger()
+        self.rules: Dict[str, List[Rule]] = {}
+        self.notifiers: Dict[str, Notifier] = build_notifiers({}, self.logger)
+        self._queue: Queue = Queue(maxsize=self.QUEUE_SIZE)
+        self._thread: Optional[Thread] = None
+        self._lock = Lock()
+        self.firing = get_or_create(Gauge, 'ancs_alert_firing', 'Whether an alert fires', ['alert', 'severity'])
+        self.failures = get_or_create(
+            Counter,
+            'ancs_alert_notification_failures',
+            'Number of notifications that could not be sent',
+            ['notifier']
+        )
+
+    def load(self, config: dict) -> None:
+        """
+        Replaces the rules and notifiers with those of a configuration; rules whose definition did not change keep
+        their state, so that a reload does not fire or resolve them again.
+
+        :param config: configuration as returned by `app.core.config.load_config`
+        :type config: dict
+        """
+        rules = build_rules(config.get('alerts'))
+        notifiers = build_notifiers(config.get('notifiers'), self.logger)
+        for rule in rules:
+            unknown = set(rule.notify) - set(notifiers)
+            if unknown:
+                raise ConfigurationException(
+                    'alert rule "{}" uses unknown notifiers: {}'.format(rule.name, ', '.join(sorted(unknown)))
+                )
+
+        with self._lock:
+            current = {rule.name: rule for source_rules in self.rules.values() for rule in source_rules}
+            indexed: Dict[str, List[Rule]] = {}
+            for rule in rules:
+                previous = current.pop(rule.name, None)
+                if previous is not None and previous.same_as(rule):
+                    previous.severity, previous.notify = rule.severity, rule.notify
+                    previous.description = rule.description
+                    rule = previous
+                indexed.setdefault(rule.source, []).append(rule)
+            for removed in current.values():
+                try:
+                    self.firing.remove(removed.name, removed.severity)
+                except KeyError:
+                    pass
+            self.rules, self.notifiers = indexed, notifiers
+
+        pipeline = Pipeline()
+        if pipeline.sinks.get('alerts') is not self:
+            pipeline.add_sink('alerts', self)
+        self.logger.info('loaded {} alert rules'.format(len(rules)))
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        rules = self.rules
+        if not rules:
+            return
+        for reading in readings:
+            for rule in rules.get('{}.{}'.format(drop_in.name, reading.metric), ()):
+                state = rule.evaluate(reading)
+                if state is not None:
+                    self.dispatch(rule, state, reading)
+
+    def dispatch(self, rule: Rule, state: str, reading: Reading) -> None:
+        """
+        Queues the notifications of an alert changing state.
+
+        :param rule: the rule
+        :type rule: Rule
+        :param state: FIRING or RESOLVED
+        :type state: str
+        :param reading: the reading that changed the state
+        :type reading: Reading
+        """
+        self.firing.labels(rule.name, rule.severity).set(1 if state == Rule.FIRING else 0)
+        event = {
+            'alert': rule.name,
+            'state': state,
+            'source': rule.source,
+            'value': reading.value,
+            'timestamp': reading.timestamp,
+            'severity': rule.severity,
+            'description': rule.description
+        }
+        try:
+            self._queue.put_nowait((event, list(rule.notify)))
+        except Full:
+            self.logger.error('alert notifications queue is full, dropped "{}" {}'.format(rule.name, state))
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self.send, name='alert-notifications', daemon=True)
+            self._thread.start()
+
+    def send(self) -> None:
+        """
+        Notifications thread: sends the queued events through the notifiers of their rule.
+        """
+        while True:
+            event, names = self._queue.get()
+            for name in names:
+                notifier = self.notifiers.get(name)
+                if notifier is None:
+                    continue
+                try:
+                    notifier.notify(event)
+                except Exception as excp:
+                    self.failures.labels(name).inc()
+                    self.logger.error('notifier "{}" failed for alert "{}": {}'.format(name, event['alert'], excp))
+            self._queue.task_done()
+
+    def flush(self, timeout: float) -> None:
+        """
+        Waits until the queued notifications are sent, on shutdown.
+
+        :param timeout: maximum wait, in seconds
+        :type timeout: float
+        """
+        with self._queue.all_tasks_done:
+            if not self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout):
+                self.logger.warning('{} alert notifications not sent after {:.1f}s'.format(
+                    self._queue.unfinished_tasks, timeout
+                ))
+
+    def states(self) -> List[dict]:
+        """
+        Current state of every rule.
+
+        :return: the states, sorted by rule name
+        :rtype: List[dict]
+        """
+        rules = [rule for source_rules in self.rules.values() for rule in source_rules]
+        return [rule.to_dict() for rule in sorted(rules, key=lambda rule: rule.name)]
+
+
+def load_alerts(logger: Logger = None) -> bool:
+    """
+    (Re)loads the alert rules and notifiers of the configuration file; an invalid configuration is logged and the
+    current rules are kept.
+
+    :param logger: a logger instance
+    :type logger: Logger
+    :return: True if the configuration was applied
+    :rtype: bool
+    """
+    from app.core.config import load_config
+    engine = AlertEngine(logger)
+    try:
+        engine.load(load_config())
+    except ConfigurationException as excp:
+        engine.logger.error('invalid alerts configuration, keeping the current rules: {}'.format(excp))
+        return False
+    return True
+
+
+class TestRules(object):
+    @staticmethod
+    def states(rule: Rule, values: List[float]) -> List[Optional[str]]:
+        return [rule.evaluate(Reading('moisture', value, timestamp=60.0 * index)) for index, value in enumerate(values)]
+
+    def test_hysteresis_and_hold(self) -> None:
+        rule, = build_rules([{'name': 'dry', 'source': 'soil.moisture', 'below': 20, 'clear': 25, 'for': 60}])
+        assert self.states(rule, [30, 19, 18, 22, 19, 26]) == [None, None, Rule.FIRING, None, None, Rule.RESOLVED]
+        # The condition must hold for 60 seconds again
+        assert self.states(rule, [19, 30]) == [None, None]
+
+    def test_rate(self) -> None:
+        rule, = build_rules([{'name': 'drift', 'source': 'ph.ph', 'rate': 0.5}])
+        assert self.states(rule, [7.0, 7.2, 6.5, 6.4]) == [None, None, Rule.FIRING, Rule.RESOLVED]
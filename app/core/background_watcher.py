@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from flask import Flask
+from app.core.accounting import CostAccounting
+from app.core.checkpoint import Checkpoint
+from app.core.logs import Lazy
+from app.core.pipeline import Pipeline
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
+from os import getenv
 from prometheus_client import Counter
 from threading import Thread, Event
+from time import monotonic
+from typing import TYPE_CHECKING
 from app.core.helper.singleton import Singleton
 
+if TYPE_CHECKING:
+    from flask import Flask
+
 
 class BackgroundWatcher(Thread, metaclass=Singleton):
     """
@@ -16,26 +26,46 @@ class BackgroundWatcher(Thread, metaclass=Singleton):
     REFRESH_FREQUENCY = 10
     # Time before the first periodic call is performed, in seconds
     DELAY_BEFORE_ACTIVATION = 10
+    # Time a periodic call waits for a device held by the API or a job before being postponed, in seconds
+    BUSY_TIMEOUT = 0.5
+    # Samples the due drop-ins of each cycle concurrently and publishes their readings as one version, based on the
+    # start of the cycle (see `Pipeline.snapshot`)
+    SNAPSHOTS = getenv('WATCHER_SNAPSHOTS', '0') not in ('0', 'false', 'no')
+    # Name of the thread, e.g. to select it in profiles (see `app.core.profiler`)
+    THREAD_NAME = 'background-watcher'
 
-    app: Flask = None
+    app: 'Flask' = None
     logger: Logger = None
     drop_ins: dict = {}
     _kill_switch: Event = None
+    _deadlines: dict = None
+    after_cycle: list = None
+    iterations: int = 0
 
-    def __init__(self, app: Flask, drop_ins: dict = None, **kwargs) -> None:
+    def __init__(self, app: 'Flask' = None, drop_ins: dict = None, logger: Logger = None, **kwargs) -> None:
         """
         Ctor
 
+        :param app: the Flask app, None in headless mode
+        :type app: Flask
         :param drop_ins: dictionary of loaded drop ins
         :type drop_ins: dict
+        :param logger: a logger instance, defaults to the app's
+        :type logger: Logger
         """
+        # The interpreter would otherwise wait for the thread before running the shutdown hooks that stop it
+        kwargs.setdefault('daemon', True)
+        kwargs.setdefault('name', self.THREAD_NAME)
         super().__init__(**kwargs)
         self.app = app
-        self.logger = app.logger
+        self.logger = logger or app.logger
         if not drop_ins:
             drop_ins = {}
         self.drop_ins = drop_ins
         self._kill_switch = Event()
+        self._deadlines = {}
+        # Callables run at the end of every cycle, e.g. to share the resulting metrics
+        self.after_cycle = []
 
     def run(self) -> None:
         """
@@ -45,28 +75,191 @@ class BackgroundWatcher(Thread, metaclass=Singleton):
         :param drop_ins:
         :return:
         """
-        iteration = 0
         c_iter = Counter('num_watcher_iter', 'Number of iterations the background watcher performed')
+        # Carries on with the count of the previous run
+        self.iterations = int(Checkpoint().take('watcher').get('iterations', 0))
+        c_iter.inc(self.iterations)
+        Checkpoint().register('watcher', lambda: {'iterations': self.iterations})
         self._kill_switch.wait(self.DELAY_BEFORE_ACTIVATION)
         while not self._kill_switch.is_set():
             self.logger.debug('Starting background watcher cycle...')
-            for di_name, di_instance in self.drop_ins.items():
-                self.logger.debug('- running periodic_call for drop-in {} ({})'.format(di_name, type(di_instance)))
-                try:
-                    di_instance.periodic_call()
-                except BaseException as excp:
-                    self.logger.error('drop-in "{}" encountered an error: {}'.format(di_name, excp))
-                else:
-                    self.logger.debug('- call succeeded')
+            if self.SNAPSHOTS:
+                with Pipeline().snapshot():
+                    self.poll()
+            else:
+                self.poll()
 
-            iteration += 1
+            self.iterations += 1
             c_iter.inc()
+            for callback in self.after_cycle:
+                try:
+                    callback()
+                except BaseException as excp:
+                    self.logger.error('end of cycle callback failed: {}'.format(excp))
             self.logger.debug('Success')
-            self._kill_switch.wait(self.REFRESH_FREQUENCY)
+            self._kill_switch.wait(self.next_wait())
+
+    def poll(self) -> None:
+        """
+        Runs the periodic call of every due drop-in. In snapshot mode, the due drop-ins are sampled concurrently, so
+        that their readings are taken in the same window instead of one after the other, and the next calls are
+        scheduled from the start of the cycle so that the drop-ins sharing an interval keep being sampled together.
+        """
+        started = monotonic()
+        due = []
+        for di_name, di_instance in list(self.drop_ins.items()):
+            deadline = self._deadlines.get(di_name, 0.0)
+            if deadline <= monotonic():
+                due.append((di_name, di_instance))
+            elif di_instance.asleep and deadline - di_instance.WAKE_TIME <= monotonic():
+                self.wake(di_name, di_instance)
+        if self.SNAPSHOTS and len(due) > 1:
+            pipeline = Pipeline()
+
+            def call(di_name: str, di_instance) -> None:
+                with pipeline.joined():
+                    self.call(di_name, di_instance, started)
+
+            with ThreadPoolExecutor(max_workers=len(due), thread_name_prefix=self.THREAD_NAME) as executor:
+                for future in [executor.submit(call, di_name, di_instance) for di_name, di_instance in due]:
+                    future.result()
+            return
+        for di_name, di_instance in due:
+            if self._kill_switch.is_set():
+                # Shutting down: the remaining drop-ins keep their deadlines
+                break
+            self.call(di_name, di_instance, started)
+
+    def call(self, di_name: str, di_instance, started: float) -> None:
+        """
+        Runs the periodic call of a drop-in and schedules the next one; a device held by the API or a job is
+        postponed rather than waited for.
+
+        :param di_name: name of the drop-in
+        :type di_name: str
+        :param di_instance: the drop-in
+        :type di_instance: BaseDropIn
+        :param started: start of the cycle, from `monotonic`
+        :type started: float
+        """
+        self.logger.debug(Lazy('- running periodic_call for drop-in {} ({})', di_name, type(di_instance)))
+        try:
+            if not di_instance.lock.acquire(timeout=self.BUSY_TIMEOUT):
+                # Other drop-ins are not held back by a device under calibration
+                self.logger.debug(Lazy('- drop-in {} is busy, postponing its periodic call', di_name))
+                self._deadlines[di_name] = monotonic() + self.BUSY_TIMEOUT
+                return
+            try:
+                if di_instance.closed:
+                    return
+                with CostAccounting().measure(di_name, 'periodic_call'):
+                    di_instance.periodic_call()
+                    di_instance.rest(di_instance.interval or self.REFRESH_FREQUENCY)
+            finally:
+                di_instance.lock.release()
+        except BaseException as excp:
+            self.logger.error('drop-in "{}" encountered an error: {}'.format(di_name, excp))
+        else:
+            self.logger.debug('- call succeeded')
+        scheduled = started if self.SNAPSHOTS else monotonic()
+        self._deadlines[di_name] = scheduled + (di_instance.interval or self.REFRESH_FREQUENCY)
+
+    def wake(self, di_name: str, di_instance) -> None:
+        """
+        Wakes a sleeping drop-in up WAKE_TIME ahead of its next periodic call, so that its read is not delayed.
+        A busy device is left alone: whoever holds it wakes it up.
+
+        :param di_name: name of the drop-in
+        :type di_name: str
+        :param di_instance: the sleeping drop-in
+        :type di_instance: BaseDropIn
+        """
+        if not di_instance.lock.acquire(timeout=self.BUSY_TIMEOUT):
+            return
+        try:
+            with CostAccounting().measure(di_name, 'wake_up'):
+                di_instance.wake_up()
+        except BaseException as excp:
+            self.logger.error('drop-in "{}" could not be woken up: {}'.format(di_name, excp))
+        finally:
+            di_instance.lock.release()
+
+    def next_wait(self) -> float:
+        """
+        Returns the time to wait before the next drop-in is due, or a sleeping one must be woken up, in seconds.
+        Drop-ins without a configured interval are polled every REFRESH_FREQUENCY seconds.
+
+        :return: time to wait, in seconds
+        :rtype: float
+        """
+        deadlines = [
+            self._deadlines.get(di_name, 0.0) - (di_instance.WAKE_TIME if di_instance.asleep else 0.0)
+            for di_name, di_instance in list(self.drop_ins.items())
+        ]
+        if not deadlines:
+            return self.REFRESH_FREQUENCY
+        return max(0.0, min(deadlines) - monotonic())
 
     def stop(self) -> None:
         """
-        Stops the thread using an Event.
-        @todo Currently inoperative with Flask / uWSGI.
+        Stops the thread using an Event: the periodic call in progress completes, the next ones are skipped.
         """
         self._kill_switch.set()
+
+    def shutdown(self, timeout: float) -> None:
+        """
+        Stops the thread and waits for the periodic call in progress, see `app.core.lifecycle`.
+
+        :param timeout: maximum wait, in seconds
+        :type timeout: float
+        """
+        self.stop()
+        if self.is_alive():
+            self.join(timeout)
+        if self.is_alive():
+            self.logger.warning('background watcher still running after {:.1f}s'.format(timeout))
+
+
+class TestBackgroundWatcher(object):
+    def test_snapshot_window(self) -> None:
+        from app.core.dropin.device_lock import DeviceLock
+        from app.core.reading import Reading
+        from logging import getLogger
+        from time import sleep
+
+        class DropIn(object):
+            WAKE_TIME = None
+            asleep = closed = False
+            interval = 60.0
+
+            def __init__(self, name: str) -> None:
+                self.name = name
+                self.lock = DeviceLock(name)
+
+            def periodic_call(self) -> None:
+                # A slow device, e.g. waiting for a conversion
+                sleep(0.2)
+                Pipeline().publish(self, [Reading('value', 1.0)])
+
+            def rest(self, gap: float) -> bool:
+                return False
+
+        drop_ins = {name: DropIn(name) for name in ('test_window_a', 'test_window_b', 'test_window_c')}
+        watcher = object.__new__(BackgroundWatcher)
+        watcher.__init__(drop_ins=drop_ins, logger=getLogger())
+        watcher.SNAPSHOTS = True
+        pipeline = Pipeline()
+        try:
+            started = monotonic()
+            with pipeline.snapshot():
+                watcher.poll()
+            assert monotonic() - started < 0.5
+            latest = pipeline.latest()
+            taken = [latest[name]['value'].timestamp for name in drop_ins]
+            assert max(taken) - min(taken) < 0.1 and pipeline.window_gauge._value.get() < 0.1
+            # Scheduled from the start of the cycle
+            assert 59.0 < watcher.next_wait() <= 60.0 - (monotonic() - started) + 0.01
+        finally:
+            for name, drop_in in drop_ins.items():
+                pipeline.forget(name)
+                drop_in.lock.forget()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint of the runtime state, restored on boot so that a restart is warm: counters carry on, the latest readings
+are served right away and drop-ins skip the slow queries whose answer they kept (e.g. the identity of a board).
+
+Components register a provider returning their state under a key (`watcher`, `drop_in:<name>`); the checkpoint is
+written every CHECKPOINT_INTERVAL seconds by the watcher leader, and when it stops, to CHECKPOINT_FILE (write then
+rename, so a crash never leaves a partial file). On boot, each component takes back the state saved under its key;
+the sections nobody took yet (e.g. a drop-in whose initialization is deferred) are kept in the next checkpoints.
+"""
+
+from app.core.helper.singleton import Singleton
+from json import dump, load
+from logging import Logger, getLogger
+from os import fsync, getenv, path, replace
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import monotonic, time
+from typing import Callable, Dict
+
+
+class Checkpoint(object, metaclass=Singleton):
+    """
+    Registry of the state providers, and reader and writer of the checkpoint file.
+    """
+    # Destination of the checkpoint, empty to disable it; choose a persistent location to survive reboots
+    FILE: str = getenv('CHECKPOINT_FILE', '/tmp/ancs-state.json')
+    # Time between two checkpoints, in seconds
+    INTERVAL: float = float(getenv('CHECKPOINT_INTERVAL', '60'))
+    # Restored readings older than this are not served, in seconds
+    READINGS_MAX_AGE: float = 3600.0
+    FORMAT_VERSION: int = 1
+
+    def __init__(self, logger: Logger = None, file_path: str = None) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        :param file_path: destination of the checkpoint, defaults to FILE
+        :type file_path: str
+        """
+        self.logger = logger or getLogger()
+        self.path = self.FILE if file_path is None else file_path
+        # Restored state not taken back yet, by key
+        self.sections: Dict[str, dict] = {}
+        self._providers: Dict[str, Callable[[], dict]] = {}
+        self._lock = Lock()
+        self._saved_at = monotonic()
+
+    def load(self) -> None:
+        """
+        Reads the checkpoint file; a missing, unreadable or outdated file is ignored.
+        """
+        if not self.path or not path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as checkpoint_fd:
+                content = load(checkpoint_fd)
+            if content.get('version') != self.FORMAT_VERSION:
+                raise ValueError('unsupported version {}'.format(content.get('version')))
+            sections = dict(content['sections'])
+        except Exception as excp:
+            self.logger.warning('ignoring checkpoint "{}": {}'.format(self.path, excp))
+            return
+        with self._lock:
+            self.sections = sections
+        self.logger.info('restored checkpoint of {} components, saved {:.0f}s ago'.format(
+            len(sections), time() - content.get('saved', time())
+        ))
+
+    def peek(self, key: str) -> dict:
+        """
+        Returns the restored state of a component without taking it back, see `register`.
+
+        :param key: key of the component
+        :type key: str
+        :return: its state, empty when none was restored
+        :rtype: dict
+        """
+        with self._lock:
+            return self.sections.get(key) or {}
+
+    def take(self, key: str) -> dict:
+        """
+        Returns the restored state of a component, which is not returned again.
+
+        :param key: key of the component
+        :type key: str
+        :return: its state, empty when none was restored
+        :rtype: dict
+        """
+        with self._lock:
+            return self.sections.pop(key, None) or {}
+
+    def register(self, key: str, provider: Callable[[], dict]) -> None:
+        """
+        Registers the provider of the state of a component, replacing its restored state.
+
+        :param key: key of the component
+        :type key: str
+        :param provider: returns the state to save, made of JSON types
+        :type provider: Callable[[], dict]
+        """
+        with self._lock:
+            self._providers[key] = provider
+            self.sections.pop(key, None)
+
+    def unregister(self, key: str) -> None:
+        with self._lock:
+            self._providers.pop(key, None)
+            self.sections.pop(key, None)
+
+    def save(self) -> None:
+        """
+        Atomically writes the state of every registered component, along with the restored sections not taken back.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            sections = dict(self.sections)
+            providers = list(self._providers.items())
+        for key, provider in providers:
+            try:
+                sections[key] = provider()
+            except Exception as excp:
+                self.logger.error('could not checkpoint "{}": {}'.format(key, excp))
+        content = {'version': self.FORMAT_VERSION, 'saved': time(), 'sections': sections}
+        try:
+            with NamedTemporaryFile('w', dir=path.dirname(self.path) or '.', delete=False) as checkpoint_fd:
+                dump(content, checkpoint_fd, separators=(',', ':'))
+                checkpoint_fd.flush()
+                fsync(checkpoint_fd.fileno())
+            replace(checkpoint_fd.name, self.path)
+        except OSError as excp:
+            self.logger.error('could not write checkpoint "{}": {}'.format(self.path, excp))
+        self._saved_at = monotonic()
+
+    def maybe_save(self) -> None:
+        """
+        Saves the checkpoint when the last one is older than INTERVAL, called after each watcher cycle.
+        """
+        if monotonic() - self._saved_at >= self.INTERVAL:
+            self.save()
+
+
+class TestCheckpoint(object):
+    @staticmethod
+    def checkpoint(file_path: str) -> Checkpoint:
+        # Bypasses the singleton so that tests do not share state
+        checkpoint = object.__new__(Checkpoint)
+        checkpoint.__init__(getLogger(), file_path)
+        return checkpoint
+
+    def test_round_trip(self, tmp_path) -> None:
+        file_path = str(tmp_path / 'state.json')
+        saved = self.checkpoint(file_path)
+        saved.register('watcher', lambda: {'iterations': 42})
+        saved.register('drop_in:broken', lambda: 1 / 0)
+        saved.save()
+
+        restored = self.checkpoint(file_path)
+        restored.load()
+        assert restored.peek('watcher') == {'iterations': 42}
+        assert restored.take('watcher') == {'iterations': 42}
+        assert restored.take('watcher') == {} and restored.take('drop_in:broken') == {}
+
+    def test_unclaimed_sections_are_kept(self, tmp_path) -> None:
+        file_path = str(tmp_path / 'state.json')
+        with open(file_path, 'w') as checkpoint_fd:
+            checkpoint_fd.write('{"version": 1, "sections": {"drop_in:ph": {"counters": {}}}}')
+        checkpoint = self.checkpoint(file_path)
+        checkpoint.load()
+        checkpoint.save()
+        checkpoint.load()
+        assert checkpoint.peek('drop_in:ph') == {'counters': {}}
+
+        with open(file_path, 'w') as checkpoint_fd:
+            checkpoint_fd.write('{"version": 1, "sect')
+        corrupted = self.checkpoint(file_path)
+        corrupted.load()
+        assert corrupted.sections == {}
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of the drop-ins configuration file (YAML or TOML).
+
+Example (YAML):
+
+    drop_ins:
+      - name: soil_north
+        module: catnip_i2c_soil
+        bus: 1
+        address: 0x20
+        interval: 30
+        labels:
+          bed: north
+        calibration:
+          min_moisture: 221
+          max_moisture: 614
+        oversample: 4
+        filters:
+          capacitance: [median:5, ema:0.3]
+        outliers:
+          moisture: {window: 7, threshold: 3.0, action: suppress, reread: true}
+        derived: [{formula: vpd, name: soil_vpd, inputs: {humidity: bme280.humidity}}]
+        adaptive: {min_interval: 10, max_interval: 600, metrics: {moisture: {deadband: 2, rate: 0.5}}}
+        power_saving: true
+
+See `app.core.filters` for the available filters and outlier detectors, `app.core.derived` for the formulas and
+`app.core.adaptive` for the adaptive sampling.
+"""
+
+from app.core.adaptive import build_adaptive
+from app.core.derived import Derivation, build_derivations
+from app.core.exception.dropin_exceptions import ConfigurationException
+from app.core.filters import build_chains, build_detectors
+from os import getenv, path
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_CONFIG_PATH: str = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'drop_ins.yml')
+
+
+class DropInConfig(object):
+    """
+    Configuration of a single drop-in instance.
+    """
+    name: str = None
+    module: str = None
+    bus: Optional[int] = None
+    address: Optional[int] = None
+    interval: Optional[float] = None
+    labels: Dict[str, str] = None
+    calibration: dict = None
+    options: dict = None
+
+    def __init__(
+            self,
+            module: str = None,
+            name: str = None,
+            bus: int = None,
+            address: int = None,
+            interval: float = None,
+            labels: Dict[str, str] = None,
+            calibration: dict = None,
+            **options
+    ) -> None:
+        """
+        Ctor
+
+        :param module: name of the module in `app.dropins` providing the DropIn class
+        :type module: str
+        :param name: unique instance name, used as the `drop_in_name` label of its metrics;
+            defaults to the drop-in's DEFAULT_INSTANCE_NAME
+        :type name: str
+        :param bus: I2C bus number, defaults to the drop-in's own default
+        :type bus: int
+        :param address: I2C address, defaults to the drop-in's own default
+        :type address: int
+        :param interval: time between two measurements, in seconds
+        :type interval: float
+        :param labels: static labels describing the instance
+        :type labels: Dict[str, str]
+        :param calibration: drop-in specific calibration values
+        :type calibration: dict
+        :param options: any other key, kept for drop-in specific use
+        """
+        if not module:
+            raise ConfigurationException('drop-in instance "{}" does not declare a module'.format(name))
+        self.module = module
+        self.name = name
+        self.bus = self.convert('bus', bus, int)
+        self.address = self.convert(
+            'address', address, lambda value: int(value, 0) if isinstance(value, str) else int(value)
+        )
+        self.interval = self.convert('interval', interval, float)
+        self.labels = self.convert(
+            'labels', labels or {}, lambda value: {str(key): str(label) for key, label in value.items()}
+        )
+        self.calibration = self.convert('calibration', calibration or {}, dict)
+        self.options = options
+        self.check_options()
+
+    def convert(self, key: str, value: object, conversion: Callable[[object], object]) -> object:
+        """
+        Converts a configuration value, reporting invalid values as configuration errors.
+
+        :param key: configuration key of the value
+        :type key: str
+        :param value: the configured value, None when unset
+        :type value: object
+        :param conversion: conversion of a set value
+        :type conversion: Callable[[object], object]
+        :return: the converted value, None when unset
+        :rtype: object
+        :raises ConfigurationException: when the value can not be converted
+        """
+        if value is None:
+            return None
+        try:
+            return conversion(value)
+        except (AttributeError, TypeError, ValueError) as excp:
+            raise ConfigurationException(
+                'drop-in instance "{}": invalid `{}` {!r}: {}'.format(self.name, key, value, excp)
+            )
+
+    def check_options(self) -> None:
+        """
+        Validates the conditioning options (filters, outlier detectors, derived metrics, adaptive sampling,
+        compensation and oversampling) so that errors are reported when loading the configuration.
+
+        :raises ConfigurationException: when an option is invalid
+        """
+        built = {}
+        for key, build in (
+                ('filters', build_chains), ('outliers', build_detectors), ('derived', build_derivations),
+                ('adaptive', build_adaptive)
+        ):
+            if self.options.get(key):
+                built[key] = build(self.options[key])
+        if self.options.get('isolated'):
+            self.check_isolated(built.get('derived') or [])
+        compensation = self.options.get('compensation')
+        if compensation is not None:
+            if not isinstance(compensation, dict) or '.' not in str(compensation.get('temperature', '')):
+                raise ConfigurationException(
+                    'drop-in instance "{}": `compensation` must declare `temperature: <instance>.<metric>`'.format(
+                        self.name
+                    )
+                )
+        try:
+            if int(self.options.get('oversample', 1)) < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ConfigurationException(
+                'drop-in instance "{}": `oversample` must be a positive integer'.format(self.name)
+            )
+
+    def check_isolated(self, derivations: List[Derivation]) -> None:
+        """
+        Rejects the options of an isolated instance that need the readings of other instances: its worker process
+        has its own pipeline, where no other instance publishes (see `app.core.isolation`).
+
+        :param derivations: derived metrics of the instance
+        :type derivations: List[Derivation]
+        :raises ConfigurationException: when the instance compensates or derives from another instance
+        """
+        if self.options.get('compensation') is not None:
+            raise ConfigurationException(
+                'drop-in instance "{}": an isolated instance can not use `compensation`'.format(self.name)
+            )
+        sources = [source for derivation in derivations for source in derivation.sources if '.' in source]
+        if sources:
+            raise ConfigurationException(
+                'drop-in instance "{}": an isolated instance can not derive metrics from other instances ({})'.format(
+                    self.name, ', '.join(sources)
+                )
+            )
+
+    def __repr__(self) -> str:
+        return '<DropInConfig {} ({})>'.format(self.name or '-', self.module)
+
+
+def config_path() -> str:
+    """
+    Returns the path of the configuration file, overridable with the DROP_INS_CONFIG environment variable.
+
+    :return: path of the configuration file
+    :rtype: str
+    """
+    return getenv('DROP_INS_CONFIG', DEFAULT_CONFIG_PATH)
+
+
+def load_config(file_path: str = None) -> dict:
+    """
+    Reads the configuration file; returns an empty dict if it does not exist.
+
+    :param file_path: path of the file to read, defaults to `config_path()`
+    :type file_path: str
+    :return: the parsed configuration
+    :rtype: dict
+    """
+    file_path = file_path or config_path()
+    if not path.isfile(file_path):
+        return {}
+    try:
+        if file_path.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+            with open(file_path, 'rb') as config_fd:
+                content = tomllib.load(config_fd)
+        else:
+            import yaml
+            with open(file_path, 'r') as config_fd:
+                content = yaml.safe_load(config_fd)
+    except Exception as excp:
+        raise ConfigurationException('could not parse configuration file "{}": {}'.format(file_path, excp))
+    if content is None:
+        return {}
+    if not isinstance(content, dict):
+        raise ConfigurationException('configuration file "{}" must contain a mapping'.format(file_path))
+    return content
+
+
+def drop_in_configs(config: dict) -> List[DropInConfig]:
+    """
+    Builds the list of declared drop-in instances, ensuring their names are unique.
+
+    :param config: configuration as returned by `load_config`
+    :type config: dict
+    :return: declared instances, in declaration order
+    :rtype: List[DropInConfig]
+    """
+    instances: List[DropInConfig] = []
+    names: set = set()
+    for entry in config.get('drop_ins') or []:
+        if not isinstance(entry, dict):
+            raise ConfigurationException('invalid drop-in declaration: {}'.format(entry))
+        instance = DropInConfig(**entry)
+        instance_name = instance.name or instance.module
+        if instance_name in names:
+            raise ConfigurationException('duplicated drop-in instance name "{}"'.format(instance_name))
+        names.add(instance_name)
+        instances.append(instance)
+    check_isolation(instances)
+    return instances
+
+
+def check_isolation(instances: List[DropInConfig]) -> None:
+    """
+    Ensures that the instances of a module are either all isolated or all in-process: the samples mirrored from the
+    worker processes would duplicate the metric families of the in-process instances (see `app.core.isolation`).
+
+    :param instances: declared drop-in instances
+    :type instances: List[DropInConfig]
+    :raises ConfigurationException: when a module has both isolated and in-process instances
+    """
+    isolation: Dict[str, bool] = {}
+    for instance in instances:
+        isolated = bool(instance.options.get('isolated'))
+        if isolation.setdefault(instance.module, isolated) != isolated:
+            raise ConfigurationException(
+                'drop-in module "{}" can not have both isolated and in-process instances'.format(instance.module)
+            )
+
+
+class TestDropInConfig(object):
+    def test_mixed_isolation(self) -> None:
+        config = {'drop_ins': [
+            {'name': 'ph_tank', 'module': 'atlas_ezo_ph', 'isolated': True},
+            {'name': 'ph_sump', 'module': 'atlas_ezo_ph', 'isolated': True},
+            {'name': 'soil', 'module': 'catnip_i2c_soil'}
+        ]}
+        assert [instance.name for instance in drop_in_configs(config)] == ['ph_tank', 'ph_sump', 'soil']
+        config['drop_ins'][1]['isolated'] = False
+        try:
+            drop_in_configs(config)
+        except ConfigurationException as excp:
+            assert '"atlas_ezo_ph"' in str(excp)
+        else:
+            raise AssertionError('mixed isolation was accepted')
+
+    def test_parsing_errors(self) -> None:
+        import pytest
+        from tempfile import mkdtemp
+
+        directory = mkdtemp()
+        assert load_config(path.join(directory, 'missing.yml')) == {}
+        for file_name, content in (('invalid.yml', 'drop_ins: [name: ph'), ('list.yml', '- ph\n- soil\n')):
+            with open(path.join(directory, file_name), 'w') as config_fd:
+                config_fd.write(content)
+            with pytest.raises(ConfigurationException):
+                load_config(path.join(directory, file_name))
+        with open(path.join(directory, 'empty.yml'), 'w'):
+            pass
+        assert load_config(path.join(directory, 'empty.yml')) == {}
+
+        for entries in (
+                ['atlas_ezo_ph'],
+                [{'name': 'ph'}],
+                [{'name': 'ph', 'module': 'atlas_ezo_ph'}, {'name': 'ph', 'module': 'catnip_i2c_soil'}],
+                [{'module': 'atlas_ezo_ph', 'oversample': 0}],
+                [{'module': 'atlas_ezo_ph', 'oversample': 'many'}],
+                [{'module': 'atlas_ezo_ph', 'compensation': {'temperature': 'bme280'}}],
+                [{'module': 'atlas_ezo_ph', 'filters': {'ph': ['unknown:1']}}],
+                [{'module': 'atlas_ezo_ph', 'address': '0xZZ'}],
+                [{'module': 'atlas_ezo_ph', 'bus': 'one'}],
+                [{'module': 'atlas_ezo_ph', 'interval': 'fast'}],
+                [{'module': 'atlas_ezo_ph', 'labels': ['a']}],
+                [{'module': 'atlas_ezo_ph', 'calibration': ['a']}],
+                [{'module': 'atlas_ezo_ph', 'isolated': True, 'compensation': {'temperature': 'bme280.temperature'}}],
+                [{'module': 'catnip_i2c_soil', 'isolated': True, 'derived': [
+                    {'formula': 'vpd', 'inputs': {'temperature': 'bme280.temperature'}}
+                ]}]
+        ):
+            with pytest.raises(ConfigurationException):
+                drop_in_configs({'drop_ins': entries})
+        # Derived from its own metrics only
+        assert drop_in_configs({'drop_ins': [{'module': 'bme280', 'isolated': True, 'derived': ['dew_point']}]})
+        instance = drop_in_configs({'drop_ins': [{'module': 'atlas_ezo_ph', 'address': '0x63', 'oversample': '4'}]})[0]
+        assert (instance.address, instance.options['oversample']) == (0x63, '4')
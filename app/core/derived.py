@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics derived from the readings of a sample (dew point, vapor pressure deficit, ...), computed once when the readings
+are published instead of by every dashboard query.
+
+Formulas are registered with the `formula` decorator and enabled per drop-in instance, under the `derived` key:
+
+    derived:
+      - dew_point
+      - vpd
+      # inputs default to the metrics named after the formula's parameters; `<instance>.<metric>` reads the latest
+      # reading of another instance
+      - {formula: vpd, name: soil_vpd, inputs: {temperature: soil_north.temperature}}
+
+Each derivation is exported as a gauge of the instance (`<DROP_IN_ID>_<name>`) and published with its readings.
+"""
+
+from app.core.exception.dropin_exceptions import ConfigurationException
+from app.core.helper.metrics import MetricSpec
+from app.core.reading import Reading
+from math import exp, log
+from prometheus_client import Gauge
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+
+class Formula(object):
+    """
+    A registered formula: a function of named input metrics.
+    """
+    __slots__ = ('key', 'inputs', 'function', 'unit', 'rounding', 'documentation')
+
+    def __init__(
+            self,
+            key: str,
+            inputs: Tuple[str, ...],
+            function: Callable[..., float],
+            unit: str,
+            rounding: Optional[int],
+            documentation: str
+    ) -> None:
+        self.key = key
+        self.inputs = inputs
+        self.function = function
+        self.unit = unit
+        self.rounding = rounding
+        self.documentation = documentation
+
+
+FORMULAS: Dict[str, Formula] = {}
+
+
+def formula(
+        key: str,
+        inputs: Tuple[str, ...],
+        unit: str,
+        documentation: str,
+        rounding: Optional[int] = 2
+) -> Callable:
+    """
+    Registers a formula, usable by any drop-in instance whose configuration enables it.
+
+    :param key: name of the formula, and default name of its metric
+    :type key: str
+    :param inputs: metrics passed as positional arguments to the function
+    :type inputs: Tuple[str, ...]
+    :param unit: unit of the result
+    :type unit: str
+    :param documentation: metric description
+    :type documentation: str
+    :param rounding: number of decimals kept
+    :type rounding: Optional[int]
+    :return: decorator
+    :rtype: Callable
+    """
+    def register(function: Callable[..., float]) -> Callable[..., float]:
+        FORMULAS[key] = Formula(key, inputs, function, unit, rounding, documentation)
+        return function
+    return register
+
+
+def saturation_vapor_pressure(temperature: float) -> float:
+    """
+    Saturation vapor pressure of water (Tetens), in kPa.
+
+    :param temperature: temperature in celsius
+    :type temperature: float
+    :return: the pressure in kPa
+    :rtype: float
+    """
+    return 0.61078 * exp(17.27 * temperature / (temperature + 237.3))
+
+
+@formula('dew_point', ('temperature', 'humidity'), 'celsius', 'Dew point', rounding=1)
+def dew_point(temperature: float, humidity: float) -> float:
+    # Magnus formula
+    gamma = log(max(humidity, 0.01) / 100.0) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+@formula('vpd', ('temperature', 'humidity'), 'kPa', 'Vapor pressure deficit')
+def vapor_pressure_deficit(temperature: float, humidity: float) -> float:
+    return saturation_vapor_pressure(temperature) * (1.0 - humidity / 100.0)
+
+
+@formula('absolute_humidity', ('temperature', 'humidity'), 'g/m3', 'Absolute humidity')
+def absolute_humidity(temperature: float, humidity: float) -> float:
+    # Ideal gas law: 2.1674 g.K/J is the molar mass of water over the gas constant, the pressure is in Pa
+    return 2167.4 * saturation_vapor_pressure(temperature) * humidity / 100.0 / (273.15 + temperature)
+
+
+class Derivation(object):
+    """
+    A formula enabled on a drop-in instance, with the metrics feeding each of its inputs.
+    """
+
+    def __init__(self, formula_key: str, name: str = None, inputs: Dict[str, str] = None) -> None:
+        """
+        Ctor
+
+        :param formula_key: key of a registered formula
+        :type formula_key: str
+        :param name: name of the derived metric, defaults to the formula key
+        :type name: str
+        :param inputs: metric feeding each input, `<metric>` of the instance or `<instance>.<metric>`
+        :type inputs: Dict[str, str]
+        """
+        if formula_key not in FORMULAS:
+            raise ValueError('unknown formula, expected one of {}'.format(', '.join(sorted(FORMULAS))))
+        self.formula = FORMULAS[formula_key]
+        self.name = name or formula_key
+        inputs = dict(inputs or {})
+        unknown = set(inputs) - set(self.formula.inputs)
+        if unknown:
+            raise ValueError('unknown inputs {}'.format(', '.join(sorted(unknown))))
+        self.sources: Tuple[str, ...] = tuple(str(inputs.get(key, key)) for key in self.formula.inputs)
+
+    @property
+    def spec(self) -> MetricSpec:
+        return MetricSpec(
+            self.name,
+            Gauge,
+            self.formula.documentation,
+            unit=self.formula.unit,
+            rounding=self.formula.rounding
+        )
+
+    def compute(self, readings: Dict[str, Reading], latest: Dict[str, Dict[str, Reading]]) -> Optional[Reading]:
+        """
+        Applies the formula to the inputs; the result is suspect when one of them is.
+
+        :param readings: readings of the current sample, by metric
+        :type readings: Dict[str, Reading]
+        :param latest: latest readings of every instance, for the inputs read from another instance
+        :type latest: Dict[str, Dict[str, Reading]]
+        :return: the derived reading, None when an input is missing or bad
+        :rtype: Optional[Reading]
+        """
+        inputs = []
+        for source in self.sources:
+            if '.' in source:
+                name, _, metric = source.partition('.')
+                reading = latest.get(name, {}).get(metric)
+            else:
+                reading = readings.get(source)
+            if reading is None or reading.quality == Reading.BAD:
+                return None
+            inputs.append(reading)
+        try:
+            value = self.formula.function(*(reading.value for reading in inputs))
+        except (ArithmeticError, ValueError):
+            return None
+        if self.formula.rounding is not None:
+            value = round(value, self.formula.rounding)
+        quality = Reading.SUSPECT if any(reading.quality == Reading.SUSPECT for reading in inputs) else Reading.GOOD
+        return Reading(self.name, value, self.formula.unit, inputs[0].timestamp, quality)
+
+
+def build_derivations(config: List[Union[str, dict]]) -> List[Derivation]:
+    """
+    Builds the derivations of a drop-in instance.
+
+    :param config: formula keys, or `{formula, name, inputs}` mappings, as found under the `derived` key of an instance
+    :type config: List[Union[str, dict]]
+    :return: the derivations
+    :rtype: List[Derivation]
+    """
+    if isinstance(config, (str, dict)):
+        config = [config]
+    derivations = []
+    for spec in config:
+        try:
+            if isinstance(spec, str):
+                derivations.append(Derivation(spec))
+            else:
+                spec = dict(spec)
+                derivations.append(Derivation(spec.pop('formula', None), **spec))
+        except (TypeError, ValueError) as excp:
+            raise ConfigurationException('invalid derived metric "{}": {}'.format(spec, excp))
+    names = [derivation.name for derivation in derivations]
+    if len(set(names)) != len(names):
+        raise ConfigurationException('derived metrics must have distinct names: {}'.format(', '.join(names)))
+    return derivations
+
+
+class TestDerived(object):
+    def test_formulas(self) -> None:
+        assert round(dew_point(20.0, 50.0), 1) == 9.3
+        assert round(vapor_pressure_deficit(25.0, 60.0), 2) == 1.27
+        assert round(absolute_humidity(20.0, 50.0), 2) == 8.64
+
+    def test_derivation(self) -> None:
+        temperature = Reading('temperature', 20.0, 'celsius', timestamp=1.0)
+        humidity = Reading('humidity', 50.0, '%', timestamp=1.0, quality=Reading.SUSPECT)
+        dew, soil_vpd = build_derivations([
+            'dew_point',
+            {'formula': 'vpd', 'name': 'soil_vpd', 'inputs': {'temperature': 'soil.temperature'}}
+        ])
+        reading = dew.compute({'temperature': temperature, 'humidity': humidity}, {})
+        assert (reading.metric, reading.value, reading.quality) == ('dew_point', 9.3, Reading.SUSPECT)
+        assert soil_vpd.compute({'humidity': humidity}, {}) is None
+        latest = {'soil': {'temperature': Reading('temperature', 25.0, 'celsius')}}
+        assert soil_vpd.compute({'humidity': humidity}, latest).value == 1.58
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+File watcher reloading drop-ins when their module or the configuration file changes.
+"""
+
+from app.core.alerts import load_alerts
+from app.core.config import config_path
+from app.core.dropin.loader import DropInLoader
+from app.dropins import declared_instances
+from logging import Logger
+from os import path
+from threading import Event, Thread
+from typing import Dict, Optional
+
+
+class DropInAutoReloader(Thread):
+    """
+    Polls the modification time of the loaded drop-in modules and of the configuration file.
+    A changed module is re-imported and its instances recreated; a changed configuration adds, reloads or
+    unloads the affected instances only. Other drop-ins keep being polled by the watcher meanwhile.
+    """
+    # Time between two checks, in seconds
+    POLL_INTERVAL: float = 2.0
+
+    def __init__(self, loader: DropInLoader, logger: Logger, **kwargs) -> None:
+        """
+        Ctor
+
+        :param loader: the drop-ins loader
+        :type loader: DropInLoader
+        :param logger: a logger instance
+        :type logger: Logger
+        """
+        super().__init__(name='drop-in-autoreload', daemon=True, **kwargs)
+        self.loader = loader
+        self.logger = logger
+        self._kill_switch = Event()
+        self._mtimes: Dict[str, float] = {}
+
+    def run(self) -> None:
+        self.snapshot()
+        while not self._kill_switch.wait(self.POLL_INTERVAL):
+            try:
+                self.check()
+            except Exception as excp:
+                self.logger.error('drop-ins autoreload failed: {}'.format(excp))
+
+    def stop(self) -> None:
+        self._kill_switch.set()
+
+    def snapshot(self) -> None:
+        """
+        Records the current modification times of the watched files.
+        """
+        for watched in self.watched_files().values():
+            self._mtimes[watched] = self.mtime(watched)
+
+    def check(self) -> None:
+        """
+        Reloads what changed since the last check.
+        """
+        for module_name, watched in self.watched_files().items():
+            current = self.mtime(watched)
+            previous = self._mtimes.get(watched)
+            self._mtimes[watched] = current
+            if previous is None or current == previous:
+                continue
+            if module_name is None:
+                self.apply_config()
+                continue
+            self.logger.info('drop-in module "{}" changed, reloading it'.format(module_name))
+            self.loader.reload_module(module_name)
+            for name in self.loader.instances_of(module_name):
+                try:
+                    self.loader.reload(name, reload_module=False)
+                except Exception as excp:
+                    self.logger.error('could not reload drop-in "{}": {}'.format(name, excp))
+
+    def apply_config(self) -> None:
+        """
+        Compares the configuration file with the loaded instances and applies the differences; the declared
+        instances follow the rules of the startup (see `app.dropins.declared_instances`), an invalid file changes
+        nothing.
+        """
+        self.logger.info('drop-ins configuration changed, applying it')
+        load_alerts(self.logger)
+        declared = {}
+        for instance in declared_instances(self.logger):
+            if self.loader.import_module(instance.module) is not None:
+                declared[self.loader.resolve_name(instance)] = instance
+        current = dict(self.loader.configs)
+        for name in current.keys() - declared.keys():
+            self.loader.unload(name)
+        for name, instance in declared.items():
+            try:
+                if name not in current:
+                    self.loader.add(instance)
+                elif vars(instance) != vars(current[name]):
+                    self.loader.reload(name, instance, reload_module=False)
+            except Exception as excp:
+                self.logger.error('could not apply configuration of drop-in "{}": {}'.format(name, excp))
+
+    def watched_files(self) -> Dict[Optional[str], str]:
+        """
+        Returns the watched files indexed by module name, the configuration file being indexed by None.
+
+        :return: watched files
+        :rtype: Dict[Optional[str], str]
+        """
+        watched: Dict[Optional[str], str] = {None: config_path()}
+        for module_name, module in list(self.loader.modules.items()):
+            module_file = getattr(module, '__file__', None)
+            if module_file:
+                watched[module_name] = module_file
+        return watched
+
+    @staticmethod
+    def mtime(file_path: str) -> float:
+        try:
+            return path.getmtime(file_path)
+        except OSError:
+            return 0.0
+
+
+class TestDropInAutoReloader(object):
+    def test_apply_config(self) -> None:
+        from app.core.config import DropInConfig
+        from app.core.exception.dropin_exceptions import ConfigurationException
+        from logging import getLogger
+        from os import environ
+        from tempfile import mkdtemp
+        import pytest
+
+        class Loader(object):
+            def __init__(self) -> None:
+                self.configs = {'ph': DropInConfig('atlas_ezo_ph', name='ph')}
+                self.unloaded = []
+
+            def import_module(self, module_name: str) -> object:
+                return object()
+
+            def resolve_name(self, instance: DropInConfig) -> str:
+                return instance.name or instance.module
+
+            def unload(self, name: str) -> None:
+                self.unloaded.append(name)
+                del self.configs[name]
+
+        directory = mkdtemp()
+        previous = environ.get('DROP_INS_CONFIG')
+        loader = Loader()
+        reloader = DropInAutoReloader(loader, getLogger())
+        try:
+            environ['DROP_INS_CONFIG'] = path.join(directory, 'drop_ins.yml')
+            with open(environ['DROP_INS_CONFIG'], 'w') as config_fd:
+                config_fd.write('drop_ins: [address: 1]\n')
+            with pytest.raises(ConfigurationException):
+                reloader.apply_config()
+            assert loader.unloaded == []
+            with open(environ['DROP_INS_CONFIG'], 'w') as config_fd:
+                config_fd.write('drop_ins: []\n')
+            reloader.apply_config()
+            # Same as a restart: a file declaring no instance loads none
+            assert loader.unloaded == ['ph'] and loader.configs == {}
+        finally:
+            if previous is None:
+                environ.pop('DROP_INS_CONFIG', None)
+            else:
+                environ['DROP_INS_CONFIG'] = previous
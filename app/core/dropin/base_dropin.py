@@ -1,34 +1,492 @@
 # -*- coding: utf-8 -*-
 
+from app.core.adaptive import AdaptiveInterval, build_adaptive
+from app.core.checkpoint import Checkpoint
+from app.core.derived import Derivation, build_derivations
+from app.core.dropin.device_lock import DeviceLock
+from app.core.filters import FilterChain, Hampel, build_chains, build_detectors
+from app.core.helper.metrics import MetricSpec, get_or_create
+from app.core.logs import Lazy
+from app.core.pipeline import Pipeline
+from app.core.reading import Reading
 from logging import Logger
-from typing import Optional
+from prometheus_client import Counter, Enum, Gauge, Info, metrics
+from time import monotonic, sleep, time
+from typing import Callable, Dict, List, Optional, Tuple
 
 
 class BaseDropIn(object):
     """
     Base class used by drop-ins.
     """
+    DROP_IN_ID: str = None
+    DROP_IN_VERSION: str = None
+    # Name given to the instance when none is configured, used as the `drop_in_name` metrics label
+    DEFAULT_INSTANCE_NAME: str = None
+    # Metrics of every drop-in, their names are prefixed with DROP_IN_ID
+    BASE_METRICS: Tuple[MetricSpec, ...] = (
+        MetricSpec(
+            'state',
+            Enum,
+            'Current status of the drop-in',
+            name='drop_in_status',
+            states=['starting', 'ready', 'measuring']
+        ),
+        MetricSpec(
+            'periodic_passes',
+            Counter,
+            'Number of times periodic measurements were performed',
+            name='measurements_count'
+        )
+    )
+    # Metrics of the drop-ins configured with outlier detectors
+    OUTLIER_METRICS: Tuple[MetricSpec, ...] = (
+        MetricSpec('outliers', Counter, 'Number of readings flagged as outliers', name='outliers'),
+        MetricSpec('rereads', Counter, 'Number of samples taken again after an outlier', name='outlier_rereads')
+    )
+    # Metrics of the drop-ins whose interval adapts to their readings
+    ADAPTIVE_METRICS: Tuple[MetricSpec, ...] = (
+        MetricSpec(
+            'sampling_interval',
+            Gauge,
+            'Current time between two periodic calls, in seconds',
+            name='sampling_interval_seconds'
+        ),
+    )
+    # Metrics measured by the drop-in, keyed like the readings returned by `sample`
+    METRICS: Tuple[MetricSpec, ...] = ()
+    # Key of the Info metric describing the instance (`<DROP_IN_ID>_drop_in`), None to disable it
+    INFO_METRIC: Optional[str] = 'info'
+    # Time the device takes to answer after `wake`, in seconds; None when it cannot sleep (see `power_saving`)
+    WAKE_TIME: Optional[float] = None
+
+    name: str = None
+    labels: Dict[str, str] = None
+    interval: Optional[float] = None
+    oversample: int = 1
+    filters: Dict[str, FilterChain] = None
+    detectors: Dict[str, Hampel] = None
+    derivations: List[Derivation] = None
+    adaptive: Optional[AdaptiveInterval] = None
+    power_saving: bool = False
+    asleep: bool = False
+    closed: bool = False
 
-    def __init__(self, logger: Logger) -> None:
+    def __init__(
+            self,
+            logger: Logger,
+            name: str = None,
+            labels: Dict[str, str] = None,
+            interval: float = None,
+            oversample: int = None,
+            filters: dict = None,
+            outliers: dict = None,
+            derived: list = None,
+            adaptive: dict = None,
+            power_saving: bool = False,
+            checkpoint: dict = None
+    ) -> None:
         """
         Ctor
 
         :param logger: a logger instance
         :type logger: Logger
+        :param name: unique name of this instance, defaults to DEFAULT_INSTANCE_NAME
+        :type name: str
+        :param labels: static labels describing this instance
+        :type labels: Dict[str, str]
+        :param interval: time between two periodic calls in seconds, defaults to the watcher's frequency
+        :type interval: float
+        :param oversample: number of samples averaged by each periodic call
+        :type oversample: int
+        :param filters: filters applied to the readings of each metric, see `app.core.filters`
+        :type filters: dict
+        :param outliers: outlier detector of each metric, see `app.core.filters.Hampel`
+        :type outliers: dict
+        :param derived: metrics derived from the readings, see `app.core.derived`
+        :type derived: list
+        :param adaptive: interval adapting to the changes of the readings, replaces `interval`, see
+            `app.core.adaptive`
+        :type adaptive: dict
+        :param power_saving: puts the device to sleep between two periodic calls, when it supports it (WAKE_TIME)
+        :type power_saving: bool
+        :param checkpoint: state saved by the previous run, see `checkpoint`
+        :type checkpoint: dict
         """
         self.logger = logger
+        self.name = name or self.DEFAULT_INSTANCE_NAME or type(self).__module__.rsplit('.', 1)[-1]
+        self.labels = dict(labels or {})
+        self.interval = interval
+        self.oversample = max(1, int(oversample or 1))
+        self.filters = build_chains(filters or {})
+        self.detectors = build_detectors(outliers or {})
+        self.derivations = build_derivations(derived or [])
+        self.adaptive = build_adaptive(adaptive)
+        if self.adaptive is not None:
+            self.interval = self.adaptive.interval
+        self.power_saving = bool(power_saving) and self.WAKE_TIME is not None
+        if power_saving and not self.power_saving:
+            logger.warning('drop-in "{}" cannot sleep, `power_saving` is ignored'.format(self.name))
+        # Monotonic time at which the device answers again after a wake up
+        self._awake_at = 0.0
+        self._restored = dict(checkpoint or {})
+        self._metrics: Dict[str, metrics.MetricWrapperBase] = {}
+        # Children of the metrics labeled with this instance's name, bound once by `setup_metrics`
+        self._children: Dict[str, object] = {}
+        self._specs: Dict[str, MetricSpec] = {}
+        self._subscriptions: List[Tuple[str, Callable[[Reading], None]]] = []
+        # Held by the watcher during periodic calls, by the API and jobs while they query the device, and while the
+        # drop-in is being closed
+        self.lock = DeviceLock(self.name)
+
+    def setup_metrics(self) -> None:
+        """
+        Creates the metrics declared by BASE_METRICS, METRICS and INFO_METRIC (and OUTLIER_METRICS when outliers are
+        detected, ADAPTIVE_METRICS when the interval adapts, and the derived metrics), and binds their children.
+        """
+        specs = self.BASE_METRICS + (self.OUTLIER_METRICS if self.detectors else ())
+        specs += (self.ADAPTIVE_METRICS if self.adaptive is not None else ()) + self.METRICS
+        for spec in specs + tuple(derivation.spec for derivation in self.derivations):
+            self._specs[spec.key] = spec
+            self._metrics[spec.key] = spec.create(self.DROP_IN_ID)
+            self._children[spec.key] = self._metrics[spec.key].labels(self.name)
+        self._children['state'].state('starting')
+
+        if self.INFO_METRIC is not None:
+            self._metrics[self.INFO_METRIC] = get_or_create(
+                Info,
+                self.DROP_IN_ID + '_drop_in',
+                'Information regarding this drop_in',
+                ['drop_in_name']
+            )
+            self._metrics[self.INFO_METRIC].labels(self.name).info(
+                {key: str(value) for key, value in self.info().items() if value is not None}
+            )
+        if self.adaptive is not None:
+            self._children['sampling_interval'].set(self.interval)
+        self.restore(self._restored)
+        self._restored = {}
+        self._children['state'].state('ready')
+
+    def checkpoint(self) -> dict:
+        """
+        State of the instance kept across restarts (see `app.core.checkpoint`): the values of its counters and its
+        latest readings. Drop-ins extend it with what is slow to query again, e.g. the identity of their device.
+
+        :return: the state, made of JSON types
+        :rtype: dict
+        """
+        counters = {}
+        for key, child in self._children.items():
+            if isinstance(self._metrics.get(key), Counter):
+                counters[key] = next(
+                    sample.value for metric in child.collect() for sample in metric.samples
+                    if sample.name.endswith('_total')
+                )
+        snapshot = Pipeline().sinks.get('snapshot')
+        latest = snapshot.latest.get(self.name, {}) if snapshot is not None else {}
+        return {
+            'counters': counters,
+            'readings': [reading.to_dict() for reading in latest.values()],
+            'asleep': self.asleep
+        }
+
+    def restore(self, state: dict) -> None:
+        """
+        Resumes the counters of the previous run and serves its latest readings, unless they are too old; called
+        once the metrics are set up.
+
+        :param state: state saved by `checkpoint`
+        :type state: dict
+        """
+        for key, value in (state.get('counters') or {}).items():
+            child = self._children.get(key)
+            if child is not None and isinstance(self._metrics.get(key), Counter) and value > 0:
+                child.inc(value)
+        oldest = time() - Checkpoint.READINGS_MAX_AGE
+        readings = [Reading(**reading) for reading in state.get('readings') or ()]
+        readings = [reading for reading in readings if reading.timestamp > oldest]
+        if readings:
+            Pipeline().restore(self, readings)
+        # A device put to sleep by the previous run is woken up before its first use
+        self.asleep = bool(state.get('asleep')) and self.WAKE_TIME is not None
+
+    def info(self) -> Dict[str, str]:
+        """
+        Labels of the Info metric of the instance.
+
+        :return: the labels
+        :rtype: Dict[str, str]
+        """
+        return {
+            **self.labels,
+            'version': self.DROP_IN_VERSION,
+            'id': self.DROP_IN_ID,
+            'capabilities': ', '.join(spec.key for spec in self.METRICS)
+        }
+
+    def reading(self, metric: str, value: float, quality: str = Reading.GOOD) -> Reading:
+        """
+        Builds a reading of a declared metric, in the unit of its spec.
+
+        :param metric: key of the metric
+        :type metric: str
+        :param value: measured value
+        :type value: float
+        :param quality: quality of the reading
+        :type quality: str
+        :return: the reading
+        :rtype: Reading
+        """
+        spec = self._specs.get(metric)
+        return Reading(metric, value, spec.unit if spec is not None else '', quality=quality)
+
+    def validate(self, readings: List[Reading]) -> List[Reading]:
+        """
+        Flags the readings of declared metrics that are outside of their valid range as bad.
+
+        :param readings: readings returned by `sample`
+        :type readings: List[Reading]
+        :return: the same readings
+        :rtype: List[Reading]
+        """
+        for reading in readings:
+            spec = self._specs.get(reading.metric)
+            if spec is None:
+                continue
+            if not spec.is_valid(reading.value):
+                if reading.quality != Reading.BAD:
+                    self.logger.debug(Lazy('"{}" reading out of range: {}', self.name, reading))
+                reading.quality = Reading.BAD
+        return readings
+
+    def reject_outliers(self, readings: List[Reading]) -> List[str]:
+        """
+        Runs the readings through the outlier detector of their metric; outliers are flagged as suspect or bad,
+        depending on the action of the detector.
+
+        :param readings: validated readings
+        :type readings: List[Reading]
+        :return: metrics of the outliers whose detector asks for a re-read
+        :rtype: List[str]
+        """
+        reread = []
+        for reading in readings:
+            detector = self.detectors.get(reading.metric)
+            if detector is None or reading.quality == Reading.BAD or not detector.is_outlier(reading.value):
+                continue
+            self.logger.debug(Lazy('"{}" reading is an outlier: {}', self.name, reading))
+            reading.quality = Reading.SUSPECT if detector.action == 'tag' else Reading.BAD
+            self._children['outliers'].inc()
+            if detector.reread:
+                reread.append(reading.metric)
+        return reread
+
+    def screen(self, readings: List[Reading]) -> List[Reading]:
+        """
+        Validates a sample and rejects its outliers; when a detector asks for it, the drop-in is sampled once more
+        and the outliers are replaced by the new readings that are neither bad nor outliers themselves.
+
+        :param readings: readings returned by `sample`
+        :type readings: List[Reading]
+        :return: the screened readings
+        :rtype: List[Reading]
+        """
+        readings = self.validate(readings)
+        if not self.detectors:
+            return readings
+        reread = self.reject_outliers(readings)
+        if not reread:
+            return readings
+
+        self._children['rereads'].inc()
+        retries = {reading.metric: reading for reading in self.validate(self.sample() or [])}
+        for index, reading in enumerate(readings):
+            retry = retries.get(reading.metric)
+            if reading.metric not in reread or retry is None or retry.quality == Reading.BAD:
+                continue
+            if not self.detectors[reading.metric].is_outlier(retry.value):
+                readings[index] = retry
+        return readings
+
+    def condition(self, samples: List[List[Reading]]) -> List[Reading]:
+        """
+        Averages the valid readings of the oversampled metrics, applies the filters of each metric and rounds the
+        values of declared metrics.
+
+        :param samples: validated readings of each sample, oldest first
+        :type samples: List[List[Reading]]
+        :return: one reading per metric
+        :rtype: List[Reading]
+        """
+        readings = samples[0] if len(samples) == 1 else self.average(samples)
+        for reading in readings:
+            if reading.quality != Reading.BAD:
+                self.apply_filters(reading)
+        return readings
+
+    @staticmethod
+    def average(samples: List[List[Reading]]) -> List[Reading]:
+        """
+        Merges oversampled readings: the latest valid reading of each metric, carrying the mean of its valid values.
+        A metric without any valid value keeps its latest bad reading.
+
+        :param samples: validated readings of each sample, oldest first
+        :type samples: List[List[Reading]]
+        :return: one reading per metric
+        :rtype: List[Reading]
+        """
+        latest: Dict[str, Reading] = {}
+        values: Dict[str, List[float]] = {}
+        for readings in samples:
+            for reading in readings:
+                if reading.quality != Reading.BAD or reading.metric not in values:
+                    latest[reading.metric] = reading
+                if reading.quality != Reading.BAD:
+                    values.setdefault(reading.metric, []).append(reading.value)
+        readings = list(latest.values())
+        for reading in readings:
+            if reading.metric in values:
+                reading.value = sum(values[reading.metric]) / len(values[reading.metric])
+        return readings
+
+    def apply_filters(self, reading: Reading) -> None:
+        """
+        Runs a valid reading through the filter chain of its metric, then rounds it as declared by its spec.
+
+        :param reading: the reading, updated in place
+        :type reading: Reading
+        """
+        chain = self.filters.get(reading.metric)
+        if chain is not None:
+            reading.value = chain.update(reading.value)
+        spec = self._specs.get(reading.metric)
+        if spec is not None and spec.rounding is not None:
+            reading.value = round(reading.value, spec.rounding)
+
+    def derive(self, readings: List[Reading]) -> List[Reading]:
+        """
+        Appends the derived metrics to the conditioned readings of a sample.
+
+        :param readings: conditioned readings
+        :type readings: List[Reading]
+        :return: the readings, followed by the derived ones that could be computed
+        :rtype: List[Reading]
+        """
+        if not self.derivations:
+            return readings
+        latest = Pipeline().latest()
+        current = {reading.metric: reading for reading in readings}
+        for derivation in self.derivations:
+            derived = derivation.compute(current, latest)
+            if derived is not None:
+                readings.append(derived)
+        return readings
 
     def periodic_call(self, context: dict = None) -> None:
         """
-        Called by the watcher thread, used to perform periodic measurements and increase
-        relevant Prometheus counters.
+        Called by the watcher thread: samples the drop-in (`oversample` times), screens and conditions the readings,
+        derives metrics from them and publishes them to the pipeline, which updates the Prometheus metrics, the
+        snapshot and the history.
+        The `state` and `periodic_passes` metrics are maintained as well, and the adaptive interval is updated.
+        """
+        state = self._children.get('state')
+        if state is not None:
+            state.state('measuring')
+        self.ready()
+        if 'periodic_passes' in self._children:
+            self._children['periodic_passes'].inc()
+
+        readings = self.sample()
+        if readings is None:
+            self.logger.info(
+                'method `sample` is not implemented by "{}", no upkeep will be performed'
+                .format(self.identity['id'])
+            )
+        else:
+            samples = [self.screen(readings)]
+            for _ in range(self.oversample - 1):
+                samples.append(self.screen(self.sample() or []))
+            readings = self.derive(self.condition(samples))
+            Pipeline().publish(self, readings)
+            if self.adaptive is not None:
+                self.interval = self.adaptive.update(readings)
+                self._children['sampling_interval'].set(self.interval)
+
+        if state is not None:
+            state.state('ready')
+
+    def sample(self) -> Optional[List[Reading]]:
+        """
+        Reads the sensor and returns its measurements; must not touch the Prometheus metrics, the pipeline does.
         This method is optional.
 
+        :return: the readings, None when the drop-in does not support sampling
+        :rtype: Optional[List[Reading]]
         """
-        self.logger.info(
-            'method `periodic_call` is not implemented by "{}", no upkeep will be performed'
-            .format(self.identity['id'])
-        )
+        return None
+
+    def sleep(self) -> None:
+        """
+        Puts the device to sleep; implemented by the drop-ins declaring a WAKE_TIME.
+        """
+        raise NotImplementedError
+
+    def wake(self) -> None:
+        """
+        Starts waking the device up, without waiting for it: it answers WAKE_TIME seconds later.
+        Implemented by the drop-ins declaring a WAKE_TIME.
+        """
+        raise NotImplementedError
+
+    def rest(self, gap: float) -> bool:
+        """
+        Puts the device to sleep until the next periodic call, when power saving is enabled and the device sleeps
+        longer than it takes to wake up. The caller holds the lock.
+
+        :param gap: time until the next periodic call, in seconds
+        :type gap: float
+        :return: True if the device sleeps
+        :rtype: bool
+        """
+        if not self.power_saving or self.asleep or gap <= 2 * self.WAKE_TIME:
+            return self.asleep
+        self.sleep()
+        self.asleep = True
+        self.logger.debug(Lazy('"{}" sleeps for {:.1f}s', self.name, gap))
+        return True
+
+    def wake_up(self) -> None:
+        """
+        Wakes a sleeping device up ahead of its next use, see `ready`. The caller holds the lock.
+        """
+        if not self.asleep:
+            return
+        self.wake()
+        self.asleep = False
+        self._awake_at = monotonic() + self.WAKE_TIME
+
+    def ready(self) -> None:
+        """
+        Wakes the device up if needed, and waits until it answers. The caller holds the lock.
+        """
+        self.wake_up()
+        remaining = self._awake_at - monotonic()
+        if remaining > 0:
+            sleep(remaining)
+
+    def subscribe(self, source: str, callback: Callable[[Reading], None]) -> None:
+        """
+        Subscribes to the readings another instance publishes (see `app.core.pipeline.ReadingBus`), until this
+        drop-in is closed. The callback runs in the publisher's thread and must not access the hardware.
+
+        :param source: `<instance>.<metric>`
+        :type source: str
+        :param callback: called with each new reading
+        :type callback: Callable[[Reading], None]
+        """
+        Pipeline().sinks['bus'].subscribe(source, callback)
+        self._subscriptions.append((source, callback))
 
     def handler(self, context: dict = None) -> Optional[str]:
         """
@@ -46,6 +504,31 @@ class BaseDropIn(object):
         )
         return
 
+    def close(self) -> None:
+        """
+        Releases the resources held by the drop-in (connector handles, ...) when it is unloaded or reloaded.
+        Overriding methods must call this implementation.
+        """
+        bus = Pipeline().sinks.get('bus')
+        for source, callback in self._subscriptions:
+            if bus is not None:
+                bus.unsubscribe(source, callback)
+        self._subscriptions = []
+        self.closed = True
+
+    def release_metrics(self) -> None:
+        """
+        Removes the metrics children labeled with this instance's name, used when the drop-in is unloaded
+        for good; a reloaded drop-in keeps them so that its counters carry on.
+        """
+        for metric in self._metrics.values():
+            try:
+                metric.remove(self.name)
+            except (KeyError, ValueError):
+                pass
+        self._children = {}
+        self.lock.forget()
+
     @property
     def identity(self) -> dict:
         """
@@ -57,3 +540,77 @@ class BaseDropIn(object):
             'Attribute `identity` is required but not implemented by drop-in "{}"'
             .format(self.identity['id'])
         )
+
+
+class TestConditioning(object):
+    class DropIn(BaseDropIn):
+        DROP_IN_ID = 'test_conditioning'
+        METRICS = (MetricSpec('ph', Gauge, 'pH', rounding=2, valid_range=(0.0, 14.0)),)
+
+        def __init__(self, reads: List[float], **kwargs) -> None:
+            from logging import getLogger
+
+            super().__init__(getLogger(), name='probe', **kwargs)
+            self.reads = iter(reads)
+            self.setup_metrics()
+
+        def sample(self) -> Optional[List[Reading]]:
+            return [self.reading('ph', next(self.reads))]
+
+    def test_oversampling(self) -> None:
+        drop_in = self.DropIn([7.0, 15.0, 7.111], filters={'ph': ['ema:0.5']})
+        readings = drop_in.condition([drop_in.screen(drop_in.sample()) for _ in range(3)])
+        # The out of range read is left out of the mean, then the EMA starts from the mean
+        assert [(reading.value, reading.quality) for reading in readings] == [(7.06, Reading.GOOD)]
+
+        only_bad = drop_in.average([[drop_in.reading('ph', -1.0, Reading.BAD)]])
+        assert [(reading.value, reading.quality) for reading in only_bad] == [(-1.0, Reading.BAD)]
+
+    def test_outlier_is_reread(self) -> None:
+        drop_in = self.DropIn(
+            [7.0, 7.01, 6.99, 7.02, 7.0, 12.0, 7.01],
+            outliers={'ph': {'window': 5, 'threshold': 3, 'action': 'suppress', 'reread': True}}
+        )
+        for _ in range(5):
+            drop_in.screen(drop_in.sample())
+        readings = drop_in.screen(drop_in.sample())
+        assert [(reading.value, reading.quality) for reading in readings] == [(7.01, Reading.GOOD)]
+        assert drop_in._children['rereads']._value.get() == 1
+
+    def test_metric_spec(self) -> None:
+        from app.core.pipeline import PrometheusSink
+
+        drop_in = self.DropIn([7.123, 15.0])
+        assert drop_in._children['ph'] is drop_in._metrics['ph'].labels('probe')
+        assert drop_in._specs['ph'].rounding == 2
+        sink = PrometheusSink()
+        readings = drop_in.condition([drop_in.screen(drop_in.sample())])
+        assert [(reading.value, reading.quality) for reading in readings] == [(7.12, Reading.GOOD)]
+        sink.write(drop_in, readings)
+        # Out of range, flagged as bad and not exported: the metric keeps its last valid value
+        readings = drop_in.condition([drop_in.screen(drop_in.sample())])
+        assert [reading.quality for reading in readings] == [Reading.BAD]
+        sink.write(drop_in, readings)
+        assert drop_in._children['ph']._value.get() == 7.12
+
+    def test_power_saving(self) -> None:
+        class Sleepy(self.DropIn):
+            WAKE_TIME = 0.05
+
+            def sleep(self) -> None:
+                calls.append('sleep')
+
+            def wake(self) -> None:
+                calls.append('wake')
+
+        calls = []
+        assert self.DropIn([], power_saving=True).power_saving is False
+        drop_in = Sleepy([], power_saving=True)
+        # Not worth sleeping for less than twice the wake up time
+        assert drop_in.rest(0.05) is False and calls == []
+        assert drop_in.rest(1.0) is True and drop_in.rest(1.0) is True and calls == ['sleep']
+        started = monotonic()
+        drop_in.ready()
+        assert monotonic() - started >= 0.05 and calls == ['sleep', 'wake'] and not drop_in.asleep
+        drop_in.ready()
+        assert calls == ['sleep', 'wake']
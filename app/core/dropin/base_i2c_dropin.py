@@ -9,7 +9,7 @@ class BaseI2CDropIn(BaseDropIn):
     """
     Base class used by I2C drop-ins.
     """
-    def __init__(self, bus: int, address: int, logger: Logger, connector: object = None) -> None:
+    def __init__(self, bus: int, address: int, logger: Logger, connector: object = None, **kwargs) -> None:
         """
         Ctor
 
@@ -19,8 +19,9 @@ class BaseI2CDropIn(BaseDropIn):
         :type address: int
         :param connector: Callable or object used to communicate with hardware sensors
         :type connector: object
+        :param kwargs: instance settings forwarded to BaseDropIn (name, labels, interval)
         """
-        super().__init__(logger)
+        super().__init__(logger, **kwargs)
         self._bus = bus
         self._address = address
         self._connector = connector
@@ -51,6 +52,16 @@ class BaseI2CDropIn(BaseDropIn):
         """
         self._connector = copy(value)
 
+    def close(self) -> None:
+        """
+        Closes the connector, if it supports it.
+        """
+        with self.lock:
+            close = getattr(self._connector, 'close', None)
+            if callable(close):
+                close()
+            super().close()
+
     @property
     def address(self) -> int:
         return self._address
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Serialized access to a device, granted by priority.
+
+Every exchange with the hardware of a drop-in (periodic reads of the watcher, API queries, calibration jobs) holds
+its `DeviceLock`, so that the write/wait/read sequences of two commands never interleave. When the device is busy,
+waiters are served by priority then in arrival order: an interactive API request goes before the routine read of
+the watcher, and a job holding the lock for its whole duration gets exclusive access to the device.
+"""
+
+from app.core.helper.metrics import get_or_create
+from contextlib import contextmanager
+from heapq import heappop, heappush, heapify
+from itertools import count
+from prometheus_client import Gauge, Histogram
+from threading import Condition, Lock, get_ident
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class DeviceLock(object):
+    """
+    Reentrant lock whose waiters are served by priority (lowest first), then in arrival order.
+    `with lock:` acquires it with the ROUTINE priority.
+    """
+    INTERACTIVE: int = 0
+    ROUTINE: int = 10
+    PRIORITIES: Dict[int, str] = {INTERACTIVE: 'interactive', ROUTINE: 'routine'}
+
+    def __init__(self, device: str) -> None:
+        """
+        Ctor
+
+        :param device: name of the device, label of the queue metrics
+        :type device: str
+        """
+        self.device = device
+        self._condition = Condition(Lock())
+        self._owner: Optional[int] = None
+        self._depth = 0
+        self._waiters: List[Tuple[int, int, int]] = []
+        self._arrivals = count()
+        self.depth_gauge = get_or_create(
+            Gauge,
+            'ancs_device_queue_depth',
+            'Number of commands waiting for a device',
+            ['device']
+        )
+        self.queue_depth = self.depth_gauge.labels(device)
+        self.wait_time = get_or_create(
+            Histogram,
+            'ancs_device_queue_wait_seconds',
+            'Time spent waiting for a device',
+            ['device', 'priority'],
+            buckets=(.001, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+        )
+
+    def acquire(self, priority: int = ROUTINE, timeout: float = None) -> bool:
+        """
+        Waits for the device.
+
+        :param priority: INTERACTIVE, ROUTINE or any other integer, lowest first
+        :type priority: int
+        :param timeout: maximum wait in seconds, None to wait as long as needed
+        :type timeout: float
+        :return: True if the lock was acquired
+        :rtype: bool
+        """
+        me = get_ident()
+        started = monotonic()
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            entry = (priority, next(self._arrivals), me)
+            heappush(self._waiters, entry)
+            self.queue_depth.set(len(self._waiters))
+            acquired = self._condition.wait_for(
+                lambda: self._owner is None and self._waiters[0] is entry,
+                timeout
+            )
+            if acquired:
+                heappop(self._waiters)
+                self._owner, self._depth = me, 1
+            else:
+                self._waiters.remove(entry)
+                heapify(self._waiters)
+                # The next waiter may have been waiting behind this one
+                self._condition.notify_all()
+            self.queue_depth.set(len(self._waiters))
+        if acquired:
+            self.wait_time.labels(self.device, self.PRIORITIES.get(priority, str(priority))).observe(
+                monotonic() - started
+            )
+        return acquired
+
+    def release(self) -> None:
+        with self._condition:
+            if self._owner != get_ident():
+                raise RuntimeError('cannot release a device lock held by another thread')
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def priority(self, priority: int, timeout: float = None) -> Iterator[None]:
+        """
+        Holds the device with a given priority.
+
+        :param priority: INTERACTIVE, ROUTINE or any other integer, lowest first
+        :type priority: int
+        :param timeout: maximum wait in seconds, None to wait as long as needed
+        :type timeout: float
+        """
+        if not self.acquire(priority, timeout):
+            raise TimeoutError('device "{}" is busy'.format(self.device))
+        try:
+            yield
+        finally:
+            self.release()
+
+    def forget(self) -> None:
+        """
+        Removes the metrics of the device, used when its drop-in is unloaded.
+        """
+        children = [(self.depth_gauge, (self.device,))]
+        children += [(self.wait_time, (self.device, name)) for name in self.PRIORITIES.values()]
+        for collector, labels in children:
+            try:
+                collector.remove(*labels)
+            except KeyError:
+                pass
+
+    def __enter__(self) -> 'DeviceLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class TestDeviceLock(object):
+    def test_priority(self) -> None:
+        from threading import Thread
+        from time import sleep
+
+        lock = DeviceLock('test')
+        served = []
+
+        def wait(name: str, priority: int) -> None:
+            with lock.priority(priority):
+                served.append(name)
+
+        with lock:
+            # Reentrant for its owner
+            with lock.priority(DeviceLock.INTERACTIVE):
+                pass
+            threads = [Thread(target=wait, args=('watcher', DeviceLock.ROUTINE))]
+            threads[0].start()
+            sleep(0.05)
+            threads.append(Thread(target=wait, args=('api', DeviceLock.INTERACTIVE)))
+            threads[1].start()
+            sleep(0.05)
+            assert len(lock._waiters) == 2
+            assert lock.acquire(timeout=0) is True
+            lock.release()
+        for thread in threads:
+            thread.join(1.0)
+        assert served == ['api', 'watcher']
+
+    def test_timeout(self) -> None:
+        from threading import Thread
+
+        lock = DeviceLock('test')
+        results = []
+        with lock:
+            thread = Thread(target=lambda: results.append(lock.acquire(timeout=0.01)))
+            thread.start()
+            thread.join(1.0)
+        assert results == [False] and lock._waiters == []
@@ -0,0 +1,736 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel initialization of the configured drop-ins.
+"""
+
+from app.core.accounting import CostAccounting
+from app.core.checkpoint import Checkpoint
+from app.core.config import DropInConfig, check_isolation
+from app.core.dropin.device_lock import DeviceLock
+from app.core.exception.dropin_exceptions import BaseDropInException
+from app.core.helper.metrics import get_or_create, release
+from app.core.helper.singleton import Singleton
+from app.core.isolation import IsolatedDropIn
+from app.core.pipeline import Pipeline
+from concurrent.futures import Future, TimeoutError
+from importlib import import_module, reload
+from logging import Logger, getLogger
+from os import getenv
+from prometheus_client import Gauge
+from threading import Event, RLock, Thread
+from time import monotonic, perf_counter
+from types import ModuleType
+from typing import Callable, Dict, List, Optional, Tuple
+import traceback
+
+
+class PendingDropIn(object):
+    """
+    Drop-in whose initialization did not complete in time or failed, and is retried in the background.
+    """
+    __slots__ = ('instance', 'future', 'attempts', 'next_try')
+
+    def __init__(self, instance: DropInConfig, future: Optional[Future], next_try: float = 0.0) -> None:
+        self.instance = instance
+        self.future = future
+        self.attempts = 1
+        self.next_try = next_try
+
+
+class DropInLoader(object, metaclass=Singleton):
+    """
+    Imports only the configured drop-in modules, then constructs every instance in its own thread.
+    Instances that are not ready after their timeout, or failed, are retried by a background thread
+    and registered as soon as they succeed, so that a missing sensor never delays the startup.
+    """
+    # Time given to each drop-in to initialize before it is deferred to the background thread, in seconds
+    INIT_TIMEOUT: float = float(getenv('DROP_IN_INIT_TIMEOUT', '0.5'))
+    # Initial and maximum delay between two attempts to initialize a failed drop-in, in seconds
+    RETRY_DELAY: float = 30.0
+    RETRY_MAX_DELAY: float = 600.0
+    # Time between two checks of the deferred drop-ins, in seconds
+    RETRY_POLL: float = 1.0
+
+    logger: Logger = None
+    drop_ins: dict = None
+    api_namespaces: dict = None
+    modules: Dict[str, ModuleType] = None
+    configs: Dict[str, DropInConfig] = None
+    phases: Dict[str, float] = None
+    with_api: bool = True
+
+    def __init__(self, logger: Logger = None, with_api: bool = True) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        :param with_api: register the API namespaces of the modules, False in headless mode
+        :type with_api: bool
+        """
+        self.logger = logger or getLogger()
+        self.with_api = with_api
+        self.drop_ins = {}
+        self.api_namespaces = {}
+        self.modules = {}
+        self.configs = {}
+        self.phases = {}
+        self._listeners: List[Callable[[str, str, Optional[ModuleType]], None]] = []
+        self._lock = RLock()
+        self._pending: Dict[str, PendingDropIn] = {}
+        self._retry_thread: Optional[Thread] = None
+        self._kill_switch = Event()
+        self._phase_metric = get_or_create(
+            Gauge,
+            'ancs_startup_phase_seconds',
+            'Time spent in each drop-ins startup phase (seconds)',
+            ['phase']
+        )
+        self._init_metric = get_or_create(
+            Gauge,
+            'ancs_drop_in_init_seconds',
+            'Time spent initializing each drop-in (seconds)',
+            ['drop_in_name']
+        )
+
+    def load(self, instances: List[DropInConfig], initialize: bool = True) -> Tuple[dict, dict]:
+        """
+        Imports the modules of the declared instances and initializes them in parallel.
+
+        :param instances: declared drop-in instances
+        :type instances: List[DropInConfig]
+        :param initialize: construct the instances; processes that do not poll the sensors only need the modules
+        :type initialize: bool
+        :return: a tuple containing loaded drop-ins indexed by instance name and API enabled handlers
+        :rtype: Tuple[dict, dict]
+        """
+        started = perf_counter()
+        instances = [instance for instance in instances if self.import_module(instance.module)]
+        for instance in instances:
+            self.resolve_name(instance)
+            self.configs[instance.name] = instance
+        self.record_phase('import', perf_counter() - started)
+
+        if initialize:
+            self.initialize()
+        return self.drop_ins, self.api_namespaces
+
+    def initialize(self) -> dict:
+        """
+        Constructs the imported instances in parallel, deferring the slow or failing ones to the background.
+
+        :return: loaded drop-ins indexed by instance name
+        :rtype: dict
+        """
+        started = perf_counter()
+        with self._lock:
+            instances = [instance for name, instance in self.configs.items() if name not in self.drop_ins]
+        futures = [(instance, self.spawn(instance), monotonic()) for instance in instances]
+        for instance, future, spawned_at in futures:
+            timeout = float(instance.options.get('timeout', self.INIT_TIMEOUT))
+            try:
+                self.register(future.result(timeout=max(0.0, spawned_at + timeout - monotonic())))
+            except TimeoutError:
+                self.logger.warning(
+                    'drop-in "{}" is not ready after {}s, deferring its initialization'
+                    .format(self.key(instance), timeout)
+                )
+                self.defer(instance, future)
+            except Exception:
+                self.logger.error(
+                    'could not register drop in {}:\n{}'.format(self.key(instance), traceback.format_exc())
+                )
+                self.defer(instance, None)
+        self.record_phase('init', perf_counter() - started)
+
+        self.logger.info(
+            'drop-ins startup: {} ({} ready, {} deferred)'.format(
+                ', '.join('{} {:.3f}s'.format(phase, duration) for phase, duration in self.phases.items()),
+                len(self.drop_ins),
+                len(self._pending)
+            )
+        )
+        if self._pending:
+            self.start_retry_thread()
+        return self.drop_ins
+
+    def import_module(self, module_name: str) -> Optional[ModuleType]:
+        """
+        Imports a drop-in module and registers its API namespace, if any.
+        Names without a dot are looked up in `app.dropins`.
+
+        :param module_name: name of the module
+        :type module_name: str
+        :return: the imported module, None if the import failed
+        :rtype: Optional[ModuleType]
+        """
+        if module_name in self.modules:
+            return self.modules[module_name]
+        try:
+            module = import_module(module_name if '.' in module_name else 'app.dropins.' + module_name)
+        except Exception:
+            self.logger.error('could not import drop-in module {}:\n{}'.format(module_name, traceback.format_exc()))
+            return None
+        self.modules[module_name] = module
+        if not self.with_api:
+            return module
+        api_namespace = getattr(module, 'api_namespace', None)
+        if api_namespace is None:
+            self.logger.info('Module "{}" does not expose an API'.format(module_name))
+        else:
+            self.api_namespaces[self.module_id(module)] = api_namespace
+            self.logger.info('registered module "{}" for API access'.format(module_name))
+        return module
+
+    def add(self, instance: DropInConfig) -> object:
+        """
+        Loads a new drop-in instance at runtime; the watcher starts polling it on its next cycle.
+
+        :param instance: configuration of the instance
+        :type instance: DropInConfig
+        :return: the initialized drop-in
+        :rtype: object
+        """
+        is_new_module = instance.module not in self.modules
+        module = self.import_module(instance.module)
+        if module is None:
+            raise BaseDropInException('could not import drop-in module "{}"'.format(instance.module))
+        key = self.resolve_name(instance)
+        with self._lock:
+            if key in self.configs:
+                raise BaseDropInException('drop-in "{}" is already loaded'.format(key))
+            check_isolation(list(self.configs.values()) + [instance])
+        drop_in = self.create(instance)
+        with self._lock:
+            self.configs[key] = instance
+            self.register(drop_in)
+        if is_new_module:
+            self.notify('add', instance.module, module)
+        return drop_in
+
+    def unload(self, name: str) -> None:
+        """
+        Stops and removes a drop-in instance: its metrics, snapshot and history are removed and its connector handles
+        released.
+        The collectors and API of its module are released as well when no other instance uses them.
+
+        :param name: name of the instance
+        :type name: str
+        """
+        with self._lock:
+            instance = self.configs.pop(name, None)
+            drop_in = self.drop_ins.pop(name, None)
+            pending = self._pending.pop(name, None)
+            if instance is None and drop_in is None and pending is None:
+                raise BaseDropInException('unknown drop-in "{}"'.format(name))
+            module_name = instance.module if instance else None
+            last_instance = module_name is not None and all(
+                config.module != module_name for config in self.configs.values()
+            )
+        if pending is not None and pending.future is not None:
+            pending.future.cancel()
+        if drop_in is not None:
+            with drop_in.lock:
+                drop_in.close()
+                drop_in.release_metrics()
+                if last_instance:
+                    for metric in drop_in._metrics.values():
+                        release(metric)
+        Pipeline().forget(name)
+        CostAccounting().forget(name)
+        Checkpoint().unregister('drop_in:{}'.format(name))
+        if last_instance:
+            module = self.modules.pop(module_name, None)
+            self.notify('unload', module_name, module)
+        self.logger.info('unloaded drop-in "{}"'.format(name))
+
+    def reload(self, name: str, instance: DropInConfig = None, reload_module: bool = True) -> object:
+        """
+        Replaces a drop-in instance with a fresh one, optionally re-importing its module first.
+        The previous instance is held while the new one is constructed, so that neither the watcher nor the API talk
+        to the device meanwhile, then it is closed; it is kept when the construction fails. Metrics children are kept
+        so that counters carry on.
+
+        :param name: name of the instance
+        :type name: str
+        :param instance: new configuration of the instance, defaults to the current one
+        :type instance: DropInConfig
+        :param reload_module: re-import the module of the drop-in
+        :type reload_module: bool
+        :return: the new drop-in instance
+        :rtype: object
+        """
+        with self._lock:
+            instance = instance or self.configs.get(name)
+        if instance is None:
+            raise BaseDropInException('unknown drop-in "{}"'.format(name))
+        if reload_module:
+            self.reload_module(instance.module)
+        with self._lock:
+            previous = self.drop_ins.get(name)
+        if previous is not None:
+            # Waits for the command in progress; the watcher postpones the calls of a held drop-in
+            previous.lock.acquire(DeviceLock.INTERACTIVE)
+        try:
+            drop_in = self.create(instance)
+            with self._lock:
+                self._pending.pop(name, None)
+                self.configs[name] = instance
+                self.register(drop_in)
+            if previous is not None and previous is not drop_in:
+                previous.close()
+        finally:
+            if previous is not None:
+                previous.lock.release()
+        self.logger.info('reloaded drop-in "{}"'.format(name))
+        return drop_in
+
+    def reload_module(self, module_name: str) -> ModuleType:
+        """
+        Re-imports a drop-in module and notifies listeners so that its API is rebound.
+
+        :param module_name: name of the module
+        :type module_name: str
+        :return: the reloaded module
+        :rtype: ModuleType
+        """
+        module = self.modules.get(module_name)
+        if module is None:
+            module = self.import_module(module_name)
+            if module is None:
+                raise BaseDropInException('could not import drop-in module "{}"'.format(module_name))
+            return module
+        module = reload(module)
+        self.modules[module_name] = module
+        if self.with_api and getattr(module, 'api_namespace', None) is not None:
+            self.api_namespaces[self.module_id(module)] = module.api_namespace
+        self.notify('reload', module_name, module)
+        return module
+
+    def instances_of(self, module_name: str) -> List[str]:
+        """
+        Names of the instances declared for a module.
+
+        :param module_name: name of the module
+        :type module_name: str
+        :return: list of instance names
+        :rtype: List[str]
+        """
+        with self._lock:
+            return [name for name, config in self.configs.items() if config.module == module_name]
+
+    def subscribe(self, listener: Callable[[str, str, Optional[ModuleType]], None]) -> None:
+        """
+        Registers a callable notified when a module is added, reloaded or unloaded at runtime;
+        it receives the event name, the module name and the module object.
+
+        :param listener: the callable to notify
+        :type listener: Callable[[str, str, Optional[ModuleType]], None]
+        """
+        self._listeners.append(listener)
+
+    def notify(self, event: str, module_name: str, module: Optional[ModuleType]) -> None:
+        """
+        Notifies listeners of a module change.
+
+        :param event: one of 'add', 'reload' or 'unload'
+        :type event: str
+        :param module_name: name of the module
+        :type module_name: str
+        :param module: the module object
+        :type module: Optional[ModuleType]
+        """
+        for listener in list(self._listeners):
+            try:
+                listener(event, module_name, module)
+            except Exception as excp:
+                self.logger.warning('drop-in listener failed on {} of "{}": {}'.format(event, module_name, excp))
+
+    def create(self, instance: DropInConfig) -> object:
+        """
+        Constructs a drop-in instance and sets up its metrics; called from a dedicated thread.
+        Instances configured with `isolated: true` run in a supervised worker process, the other ones resume from
+        the state of the previous run, if any (see `app.core.checkpoint`).
+
+        :param instance: configuration of the instance
+        :type instance: DropInConfig
+        :return: the initialized drop-in
+        :rtype: object
+        """
+        started = perf_counter()
+        drop_in_class = self.modules[instance.module].DropIn
+        isolated = bool(instance.options.get('isolated'))
+        checkpoint_key = 'drop_in:{}'.format(instance.name)
+        if isolated:
+            drop_in = IsolatedDropIn(self.logger, instance, drop_in_class)
+        else:
+            kwargs = self.instance_kwargs(instance)
+            # Only taken back once the instance is ready, so that a failed attempt leaves it to the next one
+            state = Checkpoint().peek(checkpoint_key)
+            if state:
+                kwargs['checkpoint'] = state
+            drop_in = drop_in_class(self.logger, **kwargs)
+        drop_in.setup_metrics()
+        if not isolated:
+            Checkpoint().register(checkpoint_key, drop_in.checkpoint)
+        self._init_metric.labels(drop_in.name).set(perf_counter() - started)
+        self.logger.info('loaded drop-in {} ({}) in {:.3f}s'.format(
+            drop_in.name, instance.module, perf_counter() - started
+        ))
+        return drop_in
+
+    def spawn(self, instance: DropInConfig) -> Future:
+        """
+        Runs `create` in a daemon thread, so that a hung sensor can never block the process exit.
+
+        :param instance: configuration of the instance
+        :type instance: DropInConfig
+        :return: a future resolved with the drop-in instance
+        :rtype: Future
+        """
+        future = Future()
+
+        def target() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self.create(instance))
+            except BaseException as excp:
+                future.set_exception(excp)
+
+        Thread(target=target, name='drop-in-init-{}'.format(self.key(instance)), daemon=True).start()
+        return future
+
+    def register(self, drop_in: object) -> None:
+        """
+        Makes an initialized drop-in available to the watcher.
+
+        :param drop_in: the drop-in instance
+        :type drop_in: object
+        """
+        with self._lock:
+            self.drop_ins[drop_in.name] = drop_in
+
+    def defer(self, instance: DropInConfig, future: Optional[Future]) -> None:
+        """
+        Hands an instance over to the background retry thread.
+
+        :param instance: configuration of the instance
+        :type instance: DropInConfig
+        :param future: the initialization still in progress, None if it failed
+        :type future: Optional[Future]
+        """
+        with self._lock:
+            self._pending[self.key(instance)] = PendingDropIn(instance, future, monotonic() + self.RETRY_DELAY)
+
+    def start_retry_thread(self) -> None:
+        """
+        Starts the background thread retrying deferred drop-ins, if it is not already running.
+        """
+        with self._lock:
+            if self._retry_thread is not None and self._retry_thread.is_alive():
+                return
+            self._retry_thread = Thread(target=self.retry_pending, name='drop-in-retry', daemon=True)
+            self._retry_thread.start()
+
+    def retry_pending(self) -> None:
+        """
+        Waits for deferred initializations and retries the failed ones with an exponential backoff.
+        """
+        while not self._kill_switch.wait(self.RETRY_POLL):
+            with self._lock:
+                pending = list(self._pending.items())
+            if not pending:
+                return
+            for key, entry in pending:
+                if entry.future is None:
+                    if monotonic() >= entry.next_try:
+                        self.logger.info('retrying initialization of drop-in "{}"'.format(key))
+                        entry.attempts += 1
+                        entry.future = self.spawn(entry.instance)
+                    continue
+                if not entry.future.done():
+                    continue
+                try:
+                    drop_in = entry.future.result()
+                except Exception as excp:
+                    delay = min(self.RETRY_DELAY * 2 ** (entry.attempts - 1), self.RETRY_MAX_DELAY)
+                    self.logger.warning(
+                        'drop-in "{}" failed to initialize (attempt {}), next try in {:.0f}s: {}'
+                        .format(key, entry.attempts, delay, excp)
+                    )
+                    entry.future = None
+                    entry.next_try = monotonic() + delay
+                else:
+                    with self._lock:
+                        if self._pending.get(key) is entry:
+                            del self._pending[key]
+                            self.register(drop_in)
+                            continue
+                    # Unloaded or reloaded in the meantime
+                    drop_in.close()
+
+    def stop(self) -> None:
+        """
+        Stops the background retry thread.
+        """
+        self._kill_switch.set()
+
+    def shutdown(self, timeout: float) -> None:
+        """
+        Stops the retry thread and closes the drop-ins, each once the command in progress on its device completes,
+        see `app.core.lifecycle`. Drop-ins still busy at the deadline are left open; the process exit releases them.
+
+        :param timeout: maximum wait, in seconds
+        :type timeout: float
+        """
+        deadline = monotonic() + timeout
+        self.stop()
+        with self._lock:
+            drop_ins = list(self.drop_ins.items())
+        for _, drop_in in drop_ins:
+            if isinstance(drop_in, IsolatedDropIn):
+                drop_in.request_stop()
+        for name, drop_in in drop_ins:
+            # Goes before the reads and queries waiting for the device
+            if not drop_in.lock.acquire(DeviceLock.INTERACTIVE, max(0.0, deadline - monotonic())):
+                self.logger.warning('drop-in "{}" still busy, left open'.format(name))
+                continue
+            try:
+                drop_in.close()
+            except Exception as excp:
+                self.logger.error('could not close drop-in "{}": {}'.format(name, excp))
+            finally:
+                drop_in.lock.release()
+
+    def record_phase(self, phase: str, duration: float) -> None:
+        """
+        Stores and exports the time spent in a startup phase.
+
+        :param phase: name of the phase
+        :type phase: str
+        :param duration: time spent, in seconds
+        :type duration: float
+        """
+        self.phases[phase] = duration
+        self._phase_metric.labels(phase).set(duration)
+
+    @property
+    def pending(self) -> List[str]:
+        """
+        Names of the drop-ins that are not initialized yet.
+
+        :return: list of drop-in names
+        :rtype: List[str]
+        """
+        with self._lock:
+            return list(self._pending)
+
+    def resolve_name(self, instance: DropInConfig) -> str:
+        """
+        Gives unnamed instances the default name of their drop-in, so that configurations and drop-ins
+        share the same keys.
+
+        :param instance: configuration of the instance, its module must be imported
+        :type instance: DropInConfig
+        :return: the instance name
+        :rtype: str
+        """
+        if not instance.name:
+            module = self.modules[instance.module]
+            instance.name = getattr(module.DropIn, 'DEFAULT_INSTANCE_NAME', None) or instance.module.rsplit('.', 1)[-1]
+        return instance.name
+
+    @staticmethod
+    def module_id(module: ModuleType) -> str:
+        """
+        Identifier under which a module's API is exposed.
+
+        :param module: a drop-in module
+        :type module: ModuleType
+        :return: the DROP_IN_ID of its DropIn class, or the module name
+        :rtype: str
+        """
+        return getattr(getattr(module, 'DropIn', None), 'DROP_IN_ID', module.__name__.rsplit('.', 1)[-1])
+
+    @staticmethod
+    def key(instance: DropInConfig) -> str:
+        """
+        Name used to identify an instance before it is constructed.
+
+        :param instance: configuration of the instance
+        :type instance: DropInConfig
+        :return: the instance name, or its module name if unset
+        :rtype: str
+        """
+        return instance.name or instance.module
+
+    @staticmethod
+    def instance_kwargs(instance: DropInConfig) -> dict:
+        """
+        Converts an instance configuration to the keyword arguments expected by DropIn constructors.
+        Unset values are omitted so that each drop-in keeps its own defaults.
+
+        :param instance: configuration of the instance
+        :type instance: DropInConfig
+        :return: keyword arguments
+        :rtype: dict
+        """
+        kwargs = {
+            'name': instance.name,
+            'bus': instance.bus,
+            'address': instance.address,
+            'interval': instance.interval,
+            'calibration': instance.calibration or None,
+            'labels': instance.labels or None,
+            'oversample': instance.options.get('oversample'),
+            'filters': instance.options.get('filters'),
+            'outliers': instance.options.get('outliers'),
+            'derived': instance.options.get('derived'),
+            'adaptive': instance.options.get('adaptive'),
+            'power_saving': instance.options.get('power_saving'),
+            'compensation': instance.options.get('compensation')
+        }
+        return {key: value for key, value in kwargs.items() if value is not None}
+
+
+class TestDropInLoader(object):
+    def test_reload_holds_previous_instance(self) -> None:
+        from threading import Thread
+
+        class DropIn(object):
+            fail = False
+
+            def __init__(self, logger: Logger, name: str = None, **kwargs) -> None:
+                if DropIn.fail:
+                    raise BaseDropInException('no response')
+                self.name = name
+                self.lock = DeviceLock(name)
+                self.closed = False
+                # Whether another thread, e.g. the watcher, could use the previous instance meanwhile
+                self.previous_free = None
+                previous = loader.drop_ins.get(name)
+                if previous is not None:
+                    results = []
+                    thread = Thread(target=lambda: results.append(previous.lock.acquire(timeout=0)))
+                    thread.start()
+                    thread.join(1.0)
+                    self.previous_free = results[0]
+
+            def setup_metrics(self) -> None:
+                pass
+
+            def checkpoint(self) -> dict:
+                return {}
+
+            def close(self) -> None:
+                self.closed = True
+
+        loader = object.__new__(DropInLoader)
+        loader.__init__(getLogger(), with_api=False)
+        loader.modules['test_reload'] = ModuleType('test_reload')
+        loader.modules['test_reload'].DropIn = DropIn
+        config = DropInConfig('test_reload', name='test_reload')
+        loader.configs['test_reload'] = config
+        try:
+            loader.register(loader.create(config))
+            first = loader.drop_ins['test_reload']
+            second = loader.reload('test_reload', reload_module=False)
+            assert second.previous_free is False and first.closed and loader.drop_ins['test_reload'] is second
+            DropIn.fail = True
+            try:
+                loader.reload('test_reload', reload_module=False)
+            except BaseDropInException:
+                pass
+            else:
+                raise AssertionError('the construction failure was not raised')
+            assert loader.drop_ins['test_reload'] is second and not second.closed
+            assert second.lock.acquire(timeout=0) is True
+            second.lock.release()
+        finally:
+            Checkpoint().unregister('drop_in:test_reload')
+            loader._init_metric.remove('test_reload')
+
+    def test_deferred_and_retried(self) -> None:
+        from time import sleep
+
+        attempts: Dict[str, List[float]] = {'test_slow': [], 'test_flaky': []}
+
+        class DropIn(object):
+            def __init__(self, logger: Logger, name: str = None, **kwargs) -> None:
+                attempts[name].append(monotonic())
+                if name == 'test_slow':
+                    sleep(0.2)
+                elif len(attempts[name]) < 3:
+                    raise BaseDropInException('no response')
+                self.name = name
+
+            def setup_metrics(self) -> None:
+                pass
+
+            def checkpoint(self) -> dict:
+                return {}
+
+            def close(self) -> None:
+                pass
+
+        loader = object.__new__(DropInLoader)
+        loader.__init__(getLogger(), with_api=False)
+        loader.INIT_TIMEOUT, loader.RETRY_DELAY, loader.RETRY_POLL = 0.05, 0.05, 0.01
+        loader.modules['test_retry'] = ModuleType('test_retry')
+        loader.modules['test_retry'].DropIn = DropIn
+        for name in attempts:
+            loader.configs[name] = DropInConfig('test_retry', name=name)
+        try:
+            started = monotonic()
+            assert loader.initialize() == {}
+            assert monotonic() - started < 0.2 and sorted(loader.pending) == ['test_flaky', 'test_slow']
+            loader._retry_thread.join(2.0)
+            assert sorted(loader.drop_ins) == ['test_flaky', 'test_slow'] and loader.pending == []
+            # The slow instance is not constructed again, the failing one is retried with an exponential backoff
+            first, second, third = attempts['test_flaky']
+            assert len(attempts['test_slow']) == 1 and second - first >= 0.05 and third - second >= 0.1
+        finally:
+            loader.stop()
+            for name in attempts:
+                Checkpoint().unregister('drop_in:{}'.format(name))
+                if name in loader.drop_ins:
+                    loader._init_metric.remove(name)
+
+    def test_shutdown_drains(self) -> None:
+        from threading import Event, Thread
+
+        class DropIn(object):
+            def __init__(self, name: str) -> None:
+                self.name = name
+                self.lock = DeviceLock(name)
+                self.closed_at = None
+
+            def close(self) -> None:
+                self.closed_at = monotonic()
+
+        def command(drop_in: DropIn, duration: float, holding: Event) -> None:
+            with drop_in.lock:
+                holding.set()
+                done.wait(duration)
+            released[drop_in.name] = monotonic()
+
+        loader = object.__new__(DropInLoader)
+        loader.__init__(getLogger(), with_api=False)
+        busy, stuck = DropIn('test_busy'), DropIn('test_stuck')
+        released: Dict[str, float] = {}
+        done = Event()
+        for drop_in, duration in ((busy, 0.1), (stuck, 5.0)):
+            loader.register(drop_in)
+            holding = Event()
+            Thread(target=command, args=(drop_in, duration, holding), daemon=True).start()
+            holding.wait(1.0)
+        try:
+            loader.shutdown(0.3)
+            # Closed once its command completed, the other one is still in the middle of its command
+            assert busy.closed_at is not None and busy.closed_at >= released['test_busy']
+            assert stuck.closed_at is None
+        finally:
+            done.set()
+            busy.lock.forget()
+            stuck.lock.forget()
@@ -25,6 +25,13 @@ class SecurityException(BaseDropInException):
         return '{}: {}'.format(self.severity, self.message)
 
 
+class ConfigurationException(BaseDropInException):
+    """
+    Invalid or unreadable drop-ins configuration
+    """
+    pass
+
+
 class Severity(object):
     """
     Class used to provide consistent severity levels
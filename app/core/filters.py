@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Signal conditioning of the readings, applied per metric between sampling and export.
+
+Each metric of a drop-in instance may declare a chain of filters in the configuration file:
+
+    drop_ins:
+      - name: soil_north
+        module: catnip_i2c_soil
+        oversample: 4              # average of 4 reads per periodic call
+        filters:
+          capacitance: [median:5, ema:0.3]
+          moisture:
+            - {type: kalman, process_noise: 0.001, measurement_noise: 0.5}
+
+Outliers (I2C glitches, wild reads) are detected beforehand by a streaming Hampel identifier, also declared per metric:
+
+        outliers:
+          ph: {window: 7, threshold: 3.0, action: suppress, reread: true}
+
+Streaming filters keep a constant amount of state per metric. `replay` runs a chain over a series from a fresh
+state (e.g. the history); it is vectorized with NumPy when available, for the filters that are not recursive.
+"""
+
+from app.core.exception.dropin_exceptions import ConfigurationException
+from collections import deque
+from copy import copy
+from typing import Dict, List, Sequence, Tuple, Type, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Filter(object):
+    """
+    Base class of the streaming filters.
+    """
+
+    def update(self, value: float) -> float:
+        """
+        Feeds a new value and returns the filtered one.
+
+        :param value: raw value
+        :type value: float
+        :return: filtered value
+        :rtype: float
+        """
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        """
+        Forgets the state of the filter.
+        """
+        raise NotImplementedError
+
+    def batch(self, values: Sequence[float]) -> List[float]:
+        """
+        Filters a series from the current state; overridden by the filters that can be vectorized.
+
+        :param values: raw values, oldest first
+        :type values: Sequence[float]
+        :return: filtered values
+        :rtype: List[float]
+        """
+        return [self.update(value) for value in values]
+
+
+class Mean(Filter):
+    """
+    Moving average of the last `window` values (boxcar).
+    """
+
+    def __init__(self, window: int = 4) -> None:
+        if int(window) < 1:
+            raise ValueError('window must be at least 1')
+        self.window = int(window)
+        self.reset()
+
+    def reset(self) -> None:
+        self._values = deque(maxlen=self.window)
+        self._sum = 0.0
+
+    def update(self, value: float) -> float:
+        if len(self._values) == self.window:
+            self._sum -= self._values[0]
+        self._values.append(value)
+        self._sum += value
+        return self._sum / len(self._values)
+
+    def batch(self, values: Sequence[float]) -> List[float]:
+        if numpy is None or self._values:
+            return super().batch(values)
+        series = numpy.asarray(values, dtype=float)
+        sums = numpy.cumsum(series)
+        sums[self.window:] = sums[self.window:] - sums[:-self.window]
+        counts = numpy.minimum(numpy.arange(1, len(series) + 1), self.window)
+        for value in series[-self.window:]:
+            self.update(float(value))
+        return (sums / counts).tolist()
+
+
+class Median(Filter):
+    """
+    Median of the last `window` values, removes isolated spikes.
+    """
+
+    def __init__(self, window: int = 5) -> None:
+        if int(window) < 1:
+            raise ValueError('window must be at least 1')
+        self.window = int(window)
+        self.reset()
+
+    def reset(self) -> None:
+        self._values = deque(maxlen=self.window)
+
+    def update(self, value: float) -> float:
+        self._values.append(value)
+        ordered = sorted(self._values)
+        middle = len(ordered) // 2
+        return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+    def batch(self, values: Sequence[float]) -> List[float]:
+        if numpy is None or self._values or len(values) < self.window:
+            return super().batch(values)
+        series = numpy.asarray(values, dtype=float)
+        # The first values do not fill the window yet
+        head = [self.update(float(value)) for value in series[:self.window - 1]]
+        windows = numpy.lib.stride_tricks.sliding_window_view(series, self.window)
+        self.reset()
+        for value in series[-self.window:]:
+            self._values.append(float(value))
+        return head + numpy.median(windows, axis=1).tolist()
+
+
+class EMA(Filter):
+    """
+    Exponential moving average: `alpha` close to 1 follows the signal, close to 0 smooths it.
+    """
+
+    def __init__(self, alpha: float = 0.3) -> None:
+        if not 0.0 < float(alpha) <= 1.0:
+            raise ValueError('alpha must be in ]0, 1]')
+        self.alpha = float(alpha)
+        self.reset()
+
+    def reset(self) -> None:
+        self._value = None
+
+    def update(self, value: float) -> float:
+        self._value = value if self._value is None else self.alpha * value + (1.0 - self.alpha) * self._value
+        return self._value
+
+
+class Kalman(Filter):
+    """
+    One dimensional Kalman filter for a slowly varying value measured with noise.
+    """
+
+    def __init__(
+            self,
+            process_noise: float = 1e-3,
+            measurement_noise: float = 0.1,
+            estimate_error: float = 1.0
+    ) -> None:
+        """
+        Ctor
+
+        :param process_noise: variance of the actual value between two readings
+        :type process_noise: float
+        :param measurement_noise: variance of the sensor noise
+        :type measurement_noise: float
+        :param estimate_error: initial variance of the estimate
+        :type estimate_error: float
+        """
+        self.process_noise = float(process_noise)
+        self.measurement_noise = float(measurement_noise)
+        if self.process_noise < 0 or self.measurement_noise <= 0:
+            raise ValueError('noises must be positive')
+        self.estimate_error = float(estimate_error)
+        self.reset()
+
+    def reset(self) -> None:
+        self._estimate = None
+        self._error = self.estimate_error
+
+    def update(self, value: float) -> float:
+        if self._estimate is None:
+            self._estimate = value
+            return value
+        self._error += self.process_noise
+        gain = self._error / (self._error + self.measurement_noise)
+        self._estimate += gain * (value - self._estimate)
+        self._error *= 1.0 - gain
+        return self._estimate
+
+
+FILTERS: Dict[str, Type[Filter]] = {
+    'mean': Mean,
+    'median': Median,
+    'ema': EMA,
+    'kalman': Kalman
+}
+
+
+class FilterChain(object):
+    """
+    Filters applied in sequence to the readings of a metric.
+    """
+
+    def __init__(self, filters: List[Filter]) -> None:
+        self.filters = filters
+
+    def update(self, value: float) -> float:
+        for value_filter in self.filters:
+            value = value_filter.update(value)
+        return value
+
+    def replay(self, values: Sequence[float]) -> List[float]:
+        """
+        Filters a whole series from a fresh state, leaving the streaming state untouched.
+
+        :param values: raw values, oldest first
+        :type values: Sequence[float]
+        :return: filtered values
+        :rtype: List[float]
+        """
+        values = list(values)
+        for value_filter in self.filters:
+            fresh = copy(value_filter)
+            fresh.reset()
+            values = fresh.batch(values)
+        return values
+
+
+class Hampel(object):
+    """
+    Streaming Hampel identifier: a value further than `threshold` scaled MADs (median absolute deviations) from the
+    median of the previous `window` values is an outlier. Every value enters the window, so that a genuine step
+    change is accepted once it fills half of it.
+    """
+    # Scales the MAD to the standard deviation of normally distributed values
+    MAD_SCALE: float = 1.4826
+    # `tag` flags outliers as suspect but exports them, `suppress` flags them as bad
+    ACTIONS: Tuple[str, ...] = ('tag', 'suppress')
+
+    def __init__(
+            self,
+            window: int = 7,
+            threshold: float = 3.0,
+            min_deviation: float = 0.0,
+            action: str = 'suppress',
+            reread: bool = False
+    ) -> None:
+        """
+        Ctor
+
+        :param window: number of previous values the median and MAD are computed on
+        :type window: int
+        :param threshold: number of scaled MADs beyond which a value is an outlier
+        :type threshold: float
+        :param min_deviation: lower bound of the scaled MAD, avoids flagging small changes of a flat signal
+        :type min_deviation: float
+        :param action: one of ACTIONS
+        :type action: str
+        :param reread: sample the drop-in once more when an outlier is detected
+        :type reread: bool
+        """
+        if int(window) < 3:
+            raise ValueError('window must be at least 3')
+        if action not in self.ACTIONS:
+            raise ValueError('action must be one of {}'.format(self.ACTIONS))
+        self.window = int(window)
+        self.threshold = float(threshold)
+        self.min_deviation = float(min_deviation)
+        self.action = action
+        self.reread = bool(reread)
+        self._values = deque(maxlen=self.window)
+
+    def is_outlier(self, value: float) -> bool:
+        """
+        Tells whether a value is an outlier, then adds it to the window.
+
+        :param value: the new value
+        :type value: float
+        :return: True if the value is an outlier
+        :rtype: bool
+        """
+        outlier = False
+        if len(self._values) >= 3:
+            ordered = sorted(self._values)
+            median = ordered[len(ordered) // 2]
+            deviations = sorted(abs(previous - median) for previous in ordered)
+            deviation = max(self.MAD_SCALE * deviations[len(deviations) // 2], self.min_deviation)
+            outlier = deviation > 0 and abs(value - median) > self.threshold * deviation
+        self._values.append(value)
+        return outlier
+
+
+def build_filter(spec: Union[str, dict]) -> Filter:
+    """
+    Builds a filter from its configuration, either `{type: median, window: 5}` or the short form `median:5`
+    (positional parameters separated by colons).
+
+    :param spec: configuration of the filter
+    :type spec: Union[str, dict]
+    :return: the filter
+    :rtype: Filter
+    """
+    try:
+        if isinstance(spec, str):
+            filter_type, *args = spec.split(':')
+            return FILTERS[filter_type.strip().lower()](*(float(arg) for arg in args))
+        params = dict(spec)
+        return FILTERS[str(params.pop('type')).lower()](**params)
+    except KeyError as excp:
+        raise ConfigurationException('unknown filter {} in "{}", expected one of {}'.format(excp, spec, list(FILTERS)))
+    except (TypeError, ValueError) as excp:
+        raise ConfigurationException('invalid filter "{}": {}'.format(spec, excp))
+
+
+def build_detectors(config: Dict[str, Union[str, dict]]) -> Dict[str, Hampel]:
+    """
+    Builds the outlier detector of every metric of a drop-in instance, from `{window: 7, threshold: 3}` or the short
+    form `7:3`.
+
+    :param config: detector of each metric, as found under the `outliers` key of an instance
+    :type config: Dict[str, Union[str, dict]]
+    :return: detectors indexed by metric
+    :rtype: Dict[str, Hampel]
+    """
+    if not isinstance(config, dict):
+        raise ConfigurationException('`outliers` must map metrics to detector settings')
+    detectors = {}
+    for metric, spec in config.items():
+        try:
+            if isinstance(spec, str):
+                detectors[str(metric)] = Hampel(*(float(arg) for arg in spec.split(':')))
+            else:
+                detectors[str(metric)] = Hampel(**dict(spec or {}))
+        except (TypeError, ValueError) as excp:
+            raise ConfigurationException('invalid outlier detector "{}" for "{}": {}'.format(spec, metric, excp))
+    return detectors
+
+
+def build_chains(config: Dict[str, Sequence[Union[str, dict]]]) -> Dict[str, FilterChain]:
+    """
+    Builds the filter chain of every metric of a drop-in instance.
+
+    :param config: filters of each metric, as found under the `filters` key of an instance
+    :type config: Dict[str, Sequence[Union[str, dict]]]
+    :return: chains indexed by metric
+    :rtype: Dict[str, FilterChain]
+    """
+    if not isinstance(config, dict):
+        raise ConfigurationException('`filters` must map metrics to lists of filters')
+    chains = {}
+    for metric, specs in config.items():
+        if isinstance(specs, (str, dict)):
+            specs = [specs]
+        chains[str(metric)] = FilterChain([build_filter(spec) for spec in specs])
+    return chains
+
+
+class TestFilters(object):
+    SERIES = [7.0, 7.1, 6.9, 12.0, 7.0, 7.2, 6.8, 7.1, 7.0, 6.9]
+
+    def test_median_removes_spikes(self) -> None:
+        chain = build_chains({'ph': ['median:3']})['ph']
+        assert max(chain.update(value) for value in self.SERIES) < 7.5
+
+    def test_replay_matches_streaming(self) -> None:
+        for spec in ('mean:3', 'median:3', 'ema:0.5', 'kalman:0.01:0.5'):
+            streamed = FilterChain([build_filter(spec)])
+            expected = [streamed.update(value) for value in self.SERIES]
+            replayed = streamed.replay(self.SERIES)
+            assert all(abs(a - b) < 1e-9 for a, b in zip(expected, replayed)), spec
+            assert len(replayed) == len(self.SERIES)
+            # The streaming state is not altered by a replay
+            assert streamed.update(7.0) == FilterChain([build_filter(spec)]).replay(self.SERIES + [7.0])[-1]
+
+    def test_kalman_converges(self) -> None:
+        kalman = Kalman(process_noise=1e-4, measurement_noise=0.5)
+        values = [kalman.update(6.5 + (0.3 if index % 2 else -0.3)) for index in range(200)]
+        assert abs(values[-1] - 6.5) < 0.1
+
+    def test_hampel(self) -> None:
+        hampel = build_detectors({'ph': {'window': 5, 'threshold': 3}})['ph']
+        flags = [hampel.is_outlier(value) for value in self.SERIES]
+        assert flags == [value == 12.0 for value in self.SERIES]
+        # A lasting step change is accepted
+        assert [hampel.is_outlier(value) for value in (9.0, 9.1, 9.0, 8.9, 9.0)][-1] is False
+
+    def test_configuration_errors(self) -> None:
+        import pytest
+        for spec in ('unknown:1', 'ema:2', 'median:0', {'type': 'kalman', 'noise': 1}):
+            with pytest.raises(ConfigurationException):
+                build_filter(spec)
+        with pytest.raises(ConfigurationException):
+            build_chains(['median:3'])
+        with pytest.raises(ConfigurationException):
+            build_detectors({'ph': {'action': 'drop'}})
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers used to declare Prometheus collectors and share them between several drop-in instances.
+"""
+
+from prometheus_client import REGISTRY, metrics
+from threading import Lock
+from typing import Iterable, Optional, Tuple, Type
+
+_lock: Lock = Lock()
+_collectors: dict = {}
+
+
+def get_or_create(
+        metric_class: Type[metrics.MetricWrapperBase],
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        **kwargs
+) -> metrics.MetricWrapperBase:
+    """
+    Returns the collector registered under `name`, creating it on first use.
+    Several instances of the same drop-in class share their collectors and only differ by their label values,
+    which avoids the "Duplicated timeseries" errors raised by the registry.
+
+    :param metric_class: Prometheus metric class (Gauge, Counter, Enum, ...)
+    :type metric_class: Type[metrics.MetricWrapperBase]
+    :param name: metric name
+    :type name: str
+    :param documentation: metric description
+    :type documentation: str
+    :param labelnames: label names used by the metric
+    :type labelnames: Iterable[str]
+    :return: the shared collector
+    :rtype: metrics.MetricWrapperBase
+    """
+    with _lock:
+        collector = _collectors.get(name)
+        if collector is None:
+            collector = metric_class(name, documentation, labelnames, **kwargs)
+            _collectors[name] = collector
+        return collector
+
+
+def unregister(name: str) -> None:
+    """
+    Removes a shared collector from both the cache and the Prometheus registry.
+
+    :param name: metric name used when the collector was created
+    :type name: str
+    """
+    with _lock:
+        collector = _collectors.pop(name, None)
+        if collector is not None:
+            try:
+                REGISTRY.unregister(collector)
+            except KeyError:
+                pass
+
+
+def release(collector: metrics.MetricWrapperBase) -> None:
+    """
+    Removes a shared collector from both the cache and the Prometheus registry, looking it up by identity.
+
+    :param collector: collector returned by `get_or_create`
+    :type collector: metrics.MetricWrapperBase
+    """
+    with _lock:
+        names = [name for name, cached in _collectors.items() if cached is collector]
+    for name in names:
+        unregister(name)
+
+
+class MetricSpec(object):
+    """
+    Declaration of a drop-in metric (see `BaseDropIn.METRICS`): the framework creates the shared collector, binds
+    the child of each instance once, and rounds and validates the readings before they are exported.
+    """
+    __slots__ = ('key', 'metric_class', 'documentation', 'name', 'unit', 'rounding', 'valid_range', 'options')
+
+    def __init__(
+            self,
+            key: str,
+            metric_class: Type[metrics.MetricWrapperBase],
+            documentation: str,
+            name: str = None,
+            unit: str = '',
+            rounding: Optional[int] = None,
+            valid_range: Optional[Tuple[float, float]] = None,
+            **options
+    ) -> None:
+        """
+        Ctor
+
+        :param key: key of the metric in the drop-in, and metric of its readings
+        :type key: str
+        :param metric_class: Prometheus metric class (Gauge, Counter, Enum, ...)
+        :type metric_class: Type[metrics.MetricWrapperBase]
+        :param documentation: metric description
+        :type documentation: str
+        :param name: metric name, prefixed with the drop-in id; defaults to the key
+        :type name: str
+        :param unit: unit of the readings
+        :type unit: str
+        :param rounding: number of decimals kept, None to keep the raw value
+        :type rounding: Optional[int]
+        :param valid_range: inclusive bounds of a valid value, readings outside of them are flagged as bad
+        :type valid_range: Optional[Tuple[float, float]]
+        :param options: extra arguments of the metric class (e.g. `states` for an Enum)
+        """
+        self.key = key
+        self.metric_class = metric_class
+        self.documentation = documentation
+        self.name = name or key
+        self.unit = unit
+        self.rounding = rounding
+        self.valid_range = valid_range
+        self.options = options
+
+    def create(self, prefix: str) -> metrics.MetricWrapperBase:
+        """
+        Returns the shared collector of the metric, labeled by `drop_in_name`.
+
+        :param prefix: prefix of the metric name, the drop-in id
+        :type prefix: str
+        :return: the shared collector
+        :rtype: metrics.MetricWrapperBase
+        """
+        return get_or_create(
+            self.metric_class,
+            '{}_{}'.format(prefix, self.name),
+            self.documentation,
+            ['drop_in_name'],
+            **self.options
+        )
+
+    def is_valid(self, value: float) -> bool:
+        if value is None:
+            return False
+        return self.valid_range is None or self.valid_range[0] <= value <= self.valid_range[1]
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of identical concurrent queries, backed by a cache of their results.
+"""
+
+from app.core.helper.metrics import get_or_create
+from prometheus_client import Counter
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+
+class Flight(object):
+    """
+    A query in progress, awaited by the callers that asked for the same key meanwhile.
+    """
+    __slots__ = ('done', 'result', 'error', 'generation')
+
+    def __init__(self, generation: int) -> None:
+        self.done = Event()
+        # Results of queries started before an invalidation are not cached
+        self.generation = generation
+        self.result: object = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(object):
+    """
+    Runs a query once for all the callers asking for the same key at the same time, and serves its result from a
+    cache for `ttl` seconds afterwards. Failed queries are neither cached nor shared with later callers.
+    Outcomes are counted by `ancs_query_cache{cache, outcome}` (`hit`, `shared` or `miss`).
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        Ctor
+
+        :param name: name of the cache, label of its metrics
+        :type name: str
+        """
+        self.name = name
+        self._lock = Lock()
+        self._flights: Dict[Hashable, Flight] = {}
+        self._cache: Dict[Hashable, Tuple[float, object]] = {}
+        self._generation = 0
+        self.outcomes = get_or_create(
+            Counter,
+            'ancs_query_cache',
+            'Queries served from the cache (hit), by a concurrent identical query (shared) or by the device (miss)',
+            ['cache', 'outcome']
+        )
+
+    def call(
+            self,
+            key: Hashable,
+            function: Callable[[], object],
+            ttl: float = 0.0,
+            cacheable: Callable[[object], bool] = None
+    ) -> object:
+        """
+        Returns the result of the query identified by `key`.
+
+        :param key: identifies identical queries
+        :type key: Hashable
+        :param function: runs the query
+        :type function: Callable[[], object]
+        :param ttl: seconds the result is served from the cache, 0 only coalesces concurrent queries
+        :type ttl: float
+        :param cacheable: tells whether a result may be cached, e.g. not an error response
+        :type cacheable: Callable[[object], bool]
+        :return: the result of the query
+        :rtype: object
+        """
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > monotonic():
+                self.outcomes.labels(self.name, 'hit').inc()
+                return cached[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(self._generation)
+
+        if not leader:
+            self.outcomes.labels(self.name, 'shared').inc()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        self.outcomes.labels(self.name, 'miss').inc()
+        try:
+            flight.result = function()
+        except BaseException as excp:
+            flight.error = excp
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None and ttl > 0 and flight.generation == self._generation and (
+                        cacheable is None or cacheable(flight.result)
+                ):
+                    self._cache[key] = (monotonic() + ttl, flight.result)
+            flight.done.set()
+        return flight.result
+
+    def invalidate(self, key: Hashable = None) -> None:
+        """
+        Drops a cached result, or all of them; the results of the queries in progress will not be cached.
+
+        :param key: the key to drop, None to drop every key
+        :type key: Hashable
+        """
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+
+class TestSingleFlight(object):
+    def test_coalescing(self) -> None:
+        from threading import Thread
+
+        flights = SingleFlight('test')
+        started, release, calls = Event(), Event(), []
+
+        def query() -> str:
+            calls.append(1)
+            started.set()
+            release.wait(1.0)
+            return 'pH,1.98'
+
+        results = []
+        threads = [Thread(target=lambda: results.append(flights.call('I', query, ttl=60))) for _ in range(5)]
+        threads[0].start()
+        started.wait(1.0)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(1.0)
+        assert results == ['pH,1.98'] * 5 and calls == [1]
+        calls.clear()
+        assert flights.call('I', query, ttl=60) == 'pH,1.98' and calls == []
+        flights.invalidate('I')
+        flights.call('I', query, ttl=60)
+        assert calls == [1]
+
+    def test_errors_are_not_cached(self) -> None:
+        flights = SingleFlight('test')
+        responses = iter([(1, None), (0, '7.00')])
+
+        def query() -> tuple:
+            return flights.call('R', lambda: next(responses), ttl=60, cacheable=lambda response: not response[0])
+
+        assert query() == (1, None)
+        assert query() == (0, '7.00')
+        assert query() == (0, '7.00')
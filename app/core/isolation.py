@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+"""
+Execution of drop-ins in supervised worker processes.
+
+The worker process owns the drop-in and its hardware connector; after every periodic call it copies the readings and
+the samples of the drop-in's metrics into a shared memory ring. The web process only drains that ring, publishes the
+readings to its pipeline and exposes the samples through a Prometheus collector, so a crash, a leak or a GIL-heavy
+computation in the drop-in cannot affect it.
+"""
+
+from app.core.config import DropInConfig
+from app.core.dropin.base_dropin import BaseDropIn
+from app.core.helper.metrics import get_or_create
+from app.core.helper.singleton import Singleton
+from app.core.pipeline import Pipeline, Sink
+from app.core.reading import Reading
+from json import dumps, loads
+from logging import Logger, getLogger
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from os import getenv, getppid
+from prometheus_client import Counter, Gauge, REGISTRY
+from prometheus_client.metrics_core import Metric
+from struct import Struct
+from threading import RLock
+from time import monotonic, time
+from typing import Dict, Iterable, List, Optional, Tuple
+import traceback
+
+
+class SharedRing(object):
+    """
+    Single producer / single consumer ring of fixed-size slots living in shared memory.
+
+    Layout: an 8 bytes write counter followed by `capacity` slots. Each slot holds a sequence number, a timestamp,
+    a value and a small binary key; the sequence is odd while the producer writes the slot and even once it is
+    complete, which lets the consumer detect torn or overwritten slots without any lock.
+    """
+    HEADER: Struct = Struct('<Q')
+    SLOT_HEADER: Struct = Struct('<QddH')
+    KEY_SIZE: int = 358
+    SLOT_SIZE: int = SLOT_HEADER.size + KEY_SIZE
+
+    def __init__(self, name: str = None, capacity: int = 1024, create: bool = False) -> None:
+        """
+        Ctor
+
+        :param name: name of the shared memory block, required when attaching to an existing ring
+        :type name: str
+        :param capacity: number of slots
+        :type capacity: int
+        :param create: create the shared memory block instead of attaching to it
+        :type create: bool
+        """
+        self.capacity = capacity
+        size = self.HEADER.size + capacity * self.SLOT_SIZE
+        self._shm = SharedMemory(name=name, create=create, size=size if create else 0)
+        self._buffer = self._shm.buf
+        self._owner = create
+        self._read_count = self.write_count if not create else 0
+        if create:
+            self.HEADER.pack_into(self._buffer, 0, 0)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def write_count(self) -> int:
+        return self.HEADER.unpack_from(self._buffer, 0)[0]
+
+    def write(self, key: bytes, value: float, timestamp: float) -> None:
+        """
+        Appends a record; only one process may write to a ring.
+
+        :param key: encoded key of the record, at most KEY_SIZE bytes
+        :type key: bytes
+        :param value: value of the record
+        :type value: float
+        :param timestamp: unix timestamp of the record
+        :type timestamp: float
+        """
+        index = self.write_count
+        offset = self.HEADER.size + (index % self.capacity) * self.SLOT_SIZE
+        self.SLOT_HEADER.pack_into(self._buffer, offset, index * 2 + 1, timestamp, value, len(key))
+        self._buffer[offset + self.SLOT_HEADER.size:offset + self.SLOT_HEADER.size + len(key)] = key
+        self.SLOT_HEADER.pack_into(self._buffer, offset, index * 2 + 2, timestamp, value, len(key))
+        self.HEADER.pack_into(self._buffer, 0, index + 1)
+
+    def read(self) -> Iterable[Tuple[bytes, float, float]]:
+        """
+        Yields the records written since the last read; records overwritten in the meantime are skipped.
+
+        :return: tuples of (key, value, timestamp)
+        :rtype: Iterable[Tuple[bytes, float, float]]
+        """
+        write_count = self.write_count
+        if write_count - self._read_count > self.capacity:
+            self._read_count = write_count - self.capacity
+        for index in range(self._read_count, write_count):
+            offset = self.HEADER.size + (index % self.capacity) * self.SLOT_SIZE
+            sequence, timestamp, value, key_size = self.SLOT_HEADER.unpack_from(self._buffer, offset)
+            key = bytes(self._buffer[offset + self.SLOT_HEADER.size:offset + self.SLOT_HEADER.size + key_size])
+            if sequence != index * 2 + 2 or self.SLOT_HEADER.unpack_from(self._buffer, offset)[0] != sequence:
+                continue
+            yield key, value, timestamp
+        self._read_count = write_count
+
+    def close(self) -> None:
+        """
+        Detaches from the shared memory block, and destroys it if this ring created it.
+        """
+        self._buffer = None
+        self._shm.close()
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def sample_keys(drop_in: BaseDropIn) -> Iterable[Tuple[Tuple, float]]:
+    """
+    Yields the samples of a drop-in's metrics as (family name, type, sample name, labels) keys and values.
+
+    :param drop_in: the drop-in instance
+    :type drop_in: BaseDropIn
+    :return: tuples of (key, value)
+    :rtype: Iterable[Tuple[Tuple, float]]
+    """
+    for collector in drop_in._metrics.values():
+        for family in collector.collect():
+            for sample in family.samples:
+                if sample.name.endswith('_created'):
+                    continue
+                yield (family.name, family.type, sample.name, tuple(sorted(sample.labels.items()))), sample.value
+
+
+class RingSink(Sink):
+    """
+    Pipeline sink of a worker process, forwarding the readings to the web process through the ring.
+    Reading keys are prefixed with READING_PREFIX to tell them apart from the JSON encoded sample keys.
+    """
+    READING_PREFIX: bytes = b'R'
+
+    def __init__(self, ring: SharedRing) -> None:
+        self.ring = ring
+        self._keys: Dict[Tuple[str, str, str], bytes] = {}
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        for reading in readings:
+            key = (reading.metric, reading.unit, reading.quality)
+            encoded = self._keys.get(key)
+            if encoded is None:
+                encoded = self._keys[key] = self.READING_PREFIX + dumps(key, separators=(',', ':')).encode('utf-8')
+            if len(encoded) <= SharedRing.KEY_SIZE:
+                self.ring.write(encoded, reading.value, reading.timestamp)
+
+    @classmethod
+    def decode(cls, key: bytes) -> Tuple[str, str, str]:
+        """
+        Decodes the key of a reading written by a RingSink.
+
+        :param key: the encoded key
+        :type key: bytes
+        :return: metric, unit and quality of the reading
+        :rtype: Tuple[str, str, str]
+        """
+        return tuple(loads(key[len(cls.READING_PREFIX):].decode('utf-8')))
+
+
+def apply_limits(options: dict) -> None:
+    """
+    Applies the resource limits of a worker process: `memory_limit_mb` (address space), `cpu_time_limit`
+    (seconds of CPU before SIGXCPU, the worker is then restarted) and `nice`.
+
+    :param options: options of the drop-in instance
+    :type options: dict
+    """
+    import os
+    import resource
+    if options.get('memory_limit_mb'):
+        limit = int(options['memory_limit_mb']) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if options.get('cpu_time_limit'):
+        limit = int(options['cpu_time_limit'])
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, limit + 5))
+    if options.get('nice'):
+        os.nice(int(options['nice']))
+
+
+def run_worker(instance: DropInConfig, ring_name: str, capacity: int, stop_event, interval: float) -> None:
+    """
+    Entry point of a worker process: builds the drop-in, then periodically runs it and publishes its samples.
+
+    :param instance: configuration of the instance
+    :type instance: DropInConfig
+    :param ring_name: name of the shared memory ring
+    :type ring_name: str
+    :param capacity: number of slots of the ring
+    :type capacity: int
+    :param stop_event: multiprocessing Event set by the parent to stop the worker
+    :param interval: time between two periodic calls, in seconds
+    :type interval: float
+    """
+    from app.core.dropin.loader import DropInLoader
+    from importlib import import_module
+
+    logger = getLogger()
+    apply_limits(instance.options)
+    parent = getppid()
+    ring = SharedRing(ring_name, capacity)
+    module = import_module(instance.module if '.' in instance.module else 'app.dropins.' + instance.module)
+    drop_in = module.DropIn(logger, **DropInLoader.instance_kwargs(instance))
+    drop_in.setup_metrics()
+    # The snapshot and history are kept by the web process, which receives the readings through the ring
+    pipeline = Pipeline(logger)
+    pipeline.remove_sink('snapshot')
+    pipeline.remove_sink('history')
+    pipeline.remove_sink('quality')
+    pipeline.remove_sink('rollups')
+    pipeline.remove_sink('alerts')
+    pipeline.add_sink('ring', RingSink(ring))
+    keys: Dict[Tuple, bytes] = {}
+    try:
+        while not stop_event.is_set() and getppid() == parent:
+            gap, asleep = interval, False
+            try:
+                drop_in.periodic_call()
+                gap = drop_in.interval if drop_in.adaptive is not None else interval
+                asleep = drop_in.rest(gap)
+            except Exception:
+                logger.error('isolated drop-in "{}" failed:\n{}'.format(drop_in.name, traceback.format_exc()))
+            now = time()
+            for key, value in sample_keys(drop_in):
+                encoded = keys.get(key)
+                if encoded is None:
+                    encoded = keys[key] = dumps(key, separators=(',', ':')).encode('utf-8')
+                    if len(encoded) > SharedRing.KEY_SIZE:
+                        logger.warning('sample {} of "{}" is too large to be shared'.format(key[2], drop_in.name))
+                if len(encoded) <= SharedRing.KEY_SIZE:
+                    ring.write(encoded, value, now)
+            # A sleeping device is woken up by the next periodic call, which waits WAKE_TIME for it
+            stop_event.wait(gap - drop_in.WAKE_TIME if asleep else gap)
+    finally:
+        drop_in.close()
+        ring.close()
+
+
+class IsolatedCollector(object, metaclass=Singleton):
+    """
+    Prometheus collector exposing the samples mirrored from the worker processes. The isolated instances of a module
+    share its metric families, like in-process instances share their collectors (see `get_or_create`), hence a
+    single collector merges the samples of every instance by family.
+    """
+
+    def __init__(self) -> None:
+        # Latest value of each sample, by drop-in instance name
+        self.samples: Dict[str, Dict[bytes, float]] = {}
+        self._decoded: Dict[bytes, Tuple] = {}
+        self._lock = RLock()
+        self._registered = False
+
+    def register(self) -> None:
+        """
+        Adds the collector to the Prometheus registry, once.
+        """
+        with self._lock:
+            if not self._registered:
+                REGISTRY.register(self)
+                self._registered = True
+
+    def update(self, drop_in_name: str, key: bytes, value: float) -> None:
+        """
+        Stores the latest value of a sample mirrored from a worker.
+
+        :param drop_in_name: name of the isolated instance
+        :type drop_in_name: str
+        :param key: JSON encoded (family name, type, sample name, labels) key, see `sample_keys`
+        :type key: bytes
+        :param value: value of the sample
+        :type value: float
+        """
+        if key not in self._decoded:
+            self._decoded[key] = tuple(loads(key.decode('utf-8')))
+        with self._lock:
+            self.samples.setdefault(drop_in_name, {})[key] = value
+
+    def forget(self, drop_in_name: str) -> None:
+        """
+        Drops the samples of a closed instance.
+
+        :param drop_in_name: name of the isolated instance
+        :type drop_in_name: str
+        """
+        with self._lock:
+            self.samples.pop(drop_in_name, None)
+
+    def decoded(self, drop_in_name: str) -> List[Tuple[Tuple, float]]:
+        """
+        Latest samples of an instance, as (family name, type, sample name, labels) keys and values.
+
+        :param drop_in_name: name of the isolated instance
+        :type drop_in_name: str
+        :return: tuples of (key, value)
+        :rtype: List[Tuple[Tuple, float]]
+        """
+        with self._lock:
+            samples = list(self.samples.get(drop_in_name, {}).items())
+        return [(self._decoded[key], value) for key, value in samples]
+
+    def collect(self) -> Iterable[Metric]:
+        with self._lock:
+            names = list(self.samples)
+        families: Dict[str, Metric] = {}
+        for drop_in_name in names:
+            for (family_name, family_type, sample_name, labels), value in self.decoded(drop_in_name):
+                family = families.get(family_name)
+                if family is None:
+                    family = families[family_name] = Metric(
+                        family_name, 'Mirrored from an isolated drop-in', family_type
+                    )
+                family.add_sample(sample_name, {name: label for name, label in labels}, value)
+        return list(families.values())
+
+
+class IsolatedDropIn(BaseDropIn):
+    """
+    Stand-in for a drop-in running in a worker process.
+    The watcher's periodic call supervises the worker (restarting it with a backoff when it died) and drains
+    its readings; it never touches the hardware.
+    """
+    # Number of records held by each ring
+    RING_CAPACITY: int = 1024
+    # Initial and maximum delay before restarting a dead worker, in seconds
+    RESTART_DELAY: float = 1.0
+    RESTART_MAX_DELAY: float = 300.0
+    # Time given to a worker to stop before it is killed, in seconds
+    STOP_TIMEOUT: float = 5.0
+    # Time between two periodic calls in the worker when the instance has no interval, in seconds
+    DEFAULT_INTERVAL: float = 10.0
+
+    def __init__(self, logger: Logger, instance: DropInConfig, drop_in_class: type) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        :param instance: configuration of the isolated instance
+        :type instance: DropInConfig
+        :param drop_in_class: DropIn class of the module, only used for its metadata
+        :type drop_in_class: type
+        """
+        super().__init__(
+            logger,
+            name=instance.name or drop_in_class.DEFAULT_INSTANCE_NAME,
+            labels=instance.labels,
+            interval=instance.interval
+        )
+        self.instance = instance
+        self.drop_in_class = drop_in_class
+        self._context = get_context(getenv('ISOLATION_START_METHOD', 'spawn'))
+        self._ring: Optional[SharedRing] = None
+        self._process = None
+        self._stop_event = None
+        self._restarts = 0
+        self._restart_at = 0.0
+        self._reading_keys: Dict[bytes, Tuple[str, str, str]] = {}
+        self.start()
+
+    def setup_metrics(self) -> None:
+        IsolatedCollector().register()
+        self._metrics['worker_up'] = get_or_create(
+            Gauge,
+            'ancs_isolated_worker_up',
+            'Whether the worker process of an isolated drop-in is running',
+            ['drop_in_name']
+        )
+        self._metrics['worker_restarts'] = get_or_create(
+            Counter,
+            'ancs_isolated_worker_restarts',
+            'Number of times the worker process of an isolated drop-in was restarted',
+            ['drop_in_name']
+        )
+        self._metrics['worker_up'].labels(self.name).set(1)
+
+    def start(self) -> None:
+        """
+        Starts the worker process with a fresh ring.
+        """
+        if self._ring is not None:
+            self._ring.close()
+        self._ring = SharedRing(capacity=self.RING_CAPACITY, create=True)
+        self._stop_event = self._context.Event()
+        self._process = self._context.Process(
+            target=run_worker,
+            args=(
+                self.instance,
+                self._ring.name,
+                self.RING_CAPACITY,
+                self._stop_event,
+                self.instance.interval or self.DEFAULT_INTERVAL
+            ),
+            name='ancs-drop-in-{}'.format(self.name),
+            daemon=True
+        )
+        self._process.start()
+        self.logger.info('started worker process {} for drop-in "{}"'.format(self._process.pid, self.name))
+
+    def periodic_call(self, context: dict = None) -> None:
+        """
+        Restarts the worker if it died, then drains its readings and samples.
+        """
+        if not self._process.is_alive():
+            self.supervise()
+        self.drain()
+
+    def drain(self) -> None:
+        """
+        Publishes the readings written by the worker since the last call and mirrors its samples.
+        """
+        readings = []
+        for key, value, timestamp in self._ring.read():
+            if key.startswith(RingSink.READING_PREFIX):
+                reading_key = self._reading_keys.get(key)
+                if reading_key is None:
+                    reading_key = self._reading_keys[key] = RingSink.decode(key)
+                metric, unit, quality = reading_key
+                readings.append(Reading(metric, value, unit, timestamp, quality))
+            else:
+                IsolatedCollector().update(self.name, key, value)
+        Pipeline().publish(self, readings)
+
+    def supervise(self) -> None:
+        """
+        Schedules and performs the restart of a dead worker, with an exponential backoff.
+        """
+        if 'worker_up' in self._metrics:
+            self._metrics['worker_up'].labels(self.name).set(0)
+        now = monotonic()
+        if not self._restart_at:
+            delay = min(self.RESTART_DELAY * 2 ** self._restarts, self.RESTART_MAX_DELAY)
+            self._restart_at = now + delay
+            self.logger.error(
+                'worker of isolated drop-in "{}" exited with code {}, restarting it in {:.0f}s'
+                .format(self.name, self._process.exitcode, delay)
+            )
+        if now < self._restart_at:
+            return
+        # Drain what the dead worker published before the ring is replaced
+        self.drain()
+        self._restart_at = 0.0
+        self._restarts += 1
+        self.start()
+        if 'worker_up' in self._metrics:
+            self._metrics['worker_up'].labels(self.name).set(1)
+            self._metrics['worker_restarts'].labels(self.name).inc()
+
+    def request_stop(self) -> None:
+        """
+        Asks the worker process to stop once its periodic call in progress completes, without waiting for it; lets
+        several workers wind down at the same time before they are closed.
+        """
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def close(self) -> None:
+        """
+        Stops the worker process and releases the ring and the collector.
+        """
+        with self.lock:
+            if self._stop_event is not None:
+                self._stop_event.set()
+            if self._process is not None:
+                self._process.join(self.STOP_TIMEOUT)
+                if self._process.is_alive():
+                    self._process.kill()
+                    self._process.join(1.0)
+            if self._ring is not None:
+                self._ring.close()
+                self._ring = None
+            IsolatedCollector().forget(self.name)
+            super().close()
+
+    @property
+    def identity(self) -> dict:
+        return {
+            'id': self.drop_in_class.DROP_IN_ID,
+            'version': getattr(self.drop_in_class, 'DROP_IN_VERSION', None),
+            'isolated': True
+        }
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+    @property
+    def restarts(self) -> int:
+        return self._restarts
+
+    def samples(self) -> List[Tuple]:
+        """
+        Latest samples mirrored from the worker, as (sample name, labels, value) tuples.
+
+        :return: mirrored samples
+        :rtype: List[Tuple]
+        """
+        return [
+            (sample_name, dict(labels), value)
+            for (_, _, sample_name, labels), value in IsolatedCollector().decoded(self.name)
+        ]
+
+
+class TestIsolatedCollector(object):
+    def test_merged_families(self) -> None:
+        collector = object.__new__(IsolatedCollector)
+        collector.__init__()
+        for drop_in_name, value in (('ph_tank', 7.0), ('ph_sump', 6.5)):
+            key = dumps(('test_probe_ph', 'gauge', 'test_probe_ph', (('drop_in_name', drop_in_name),)))
+            collector.update(drop_in_name, key.encode('utf-8'), value)
+        families = collector.collect()
+        assert [family.name for family in families] == ['test_probe_ph']
+        assert sorted((sample.labels['drop_in_name'], sample.value) for sample in families[0].samples) == [
+            ('ph_sump', 6.5), ('ph_tank', 7.0)
+        ]
+        collector.forget('ph_tank')
+        assert [sample.labels['drop_in_name'] for sample in collector.collect()[0].samples] == ['ph_sump']
+        assert collector.decoded('ph_tank') == []
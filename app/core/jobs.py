@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Background jobs running long device operations (calibration, import and export of settings, ...) outside of the
+HTTP workers.
+
+Jobs targeting the same device run one after the other, in submission order, on the device's own thread; they
+hold the device (see `app.core.dropin.device_lock`) so that the periodic reads of the watcher never collide with
+their commands. Clients poll a job by its id, or stream its progress (see `app.api.jobs`).
+
+On shutdown, the queued jobs are cancelled and the running ones interrupted once their current step is reported,
+so that a device is never left in the middle of a command; a job whose last step completed is not interrupted.
+"""
+
+from app.core.helper.singleton import Singleton
+from collections import OrderedDict
+from logging import Logger, getLogger
+from os import getenv
+from queue import Queue
+from threading import Condition, Lock, Thread
+from time import time
+from typing import Callable, Dict, Optional
+from uuid import uuid4
+
+
+class Job(object):
+    """
+    A device operation and its progress; `function` receives the job and reports its progress through `step`.
+    """
+    QUEUED: str = 'queued'
+    RUNNING: str = 'running'
+    DONE: str = 'done'
+    FAILED: str = 'failed'
+    CANCELLED: str = 'cancelled'
+    FINISHED: tuple = (DONE, FAILED, CANCELLED)
+
+    def __init__(self, kind: str, device: str, function: Callable[['Job'], object], total: int = None) -> None:
+        """
+        Ctor
+
+        :param kind: type of operation, e.g. `calibration`
+        :type kind: str
+        :param device: name of the target drop-in instance
+        :type device: str
+        :param function: the operation, its return value is the result of the job
+        :type function: Callable[[Job], object]
+        :param total: number of steps, when known in advance
+        :type total: int
+        """
+        self.id = uuid4().hex
+        self.kind = kind
+        self.device = device
+        self.function = function
+        self.state = self.QUEUED
+        self.done = 0
+        self.total = total
+        self.message: Optional[str] = None
+        self.result: object = None
+        self.error: Optional[str] = None
+        self.created = time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        # Incremented on each change, see `JobManager.wait`
+        self.version = 0
+        # Set on shutdown, interrupts the job once its current step is reported
+        self.stopping = False
+        self._changed: Optional[Condition] = None
+
+    def step(self, done: int = None, total: int = None, message: str = None) -> None:
+        """
+        Reports the progress of the job; on shutdown, interrupts it unless the reported step is the last one.
+
+        :param done: number of completed steps, defaults to one more
+        :type done: int
+        :param total: number of steps
+        :type total: int
+        :param message: description of the current step
+        :type message: str
+        :raises InterruptedError: when shutting down with steps left, the next step is not performed
+        """
+        self.done = self.done + 1 if done is None else done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+        self.touch()
+        if self.stopping and (self.total is None or self.done < self.total):
+            raise InterruptedError('interrupted by shutdown after {} of {} steps'.format(
+                self.done, '?' if self.total is None else self.total
+            ))
+
+    def touch(self) -> None:
+        self.version += 1
+        if self._changed is not None:
+            with self._changed:
+                self._changed.notify_all()
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'device': self.device,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'message': self.message,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class DeviceQueue(Thread):
+    """
+    FIFO of the jobs of one device, run by its own thread; `lock` guards the start of a job against its cancellation.
+    """
+
+    def __init__(self, device: str, logger: Logger) -> None:
+        super().__init__(name='jobs-{}'.format(device), daemon=True)
+        self.device = device
+        self.logger = logger
+        self.queue: Queue = Queue()
+        self.lock = Lock()
+
+    def run(self) -> None:
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                if job.state == Job.CANCELLED:
+                    continue
+                job.state, job.started = Job.RUNNING, time()
+            job.touch()
+            try:
+                job.result = job.function(job)
+                job.state = Job.DONE
+            except InterruptedError as excp:
+                self.logger.warning('{} job {} of "{}" {}'.format(job.kind, job.id, job.device, excp))
+                job.state, job.error = Job.CANCELLED, str(excp)
+            except Exception as excp:
+                self.logger.error('{} job {} of "{}" failed: {}'.format(job.kind, job.id, job.device, excp))
+                job.state, job.error = Job.FAILED, str(excp)
+            job.finished = time()
+            job.touch()
+
+
+class JobManager(object, metaclass=Singleton):
+    """
+    Submits the jobs to the queue of their device and keeps the last HISTORY jobs for their clients.
+    """
+    HISTORY: int = int(getenv('JOBS_HISTORY', '100'))
+
+    def __init__(self, logger: Logger = None) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        """
+        self.logger = logger or getLogger()
+        self.jobs: Dict[str, Job] = OrderedDict()
+        self.queues: Dict[str, DeviceQueue] = {}
+        self._changed = Condition()
+        self._lock = Lock()
+
+    def submit(self, kind: str, device: str, function: Callable[[Job], object], total: int = None) -> Job:
+        """
+        Queues a job on its device.
+
+        :param kind: type of operation
+        :type kind: str
+        :param device: name of the target drop-in instance
+        :type device: str
+        :param function: the operation, receiving the job
+        :type function: Callable[[Job], object]
+        :param total: number of steps, when known in advance
+        :type total: int
+        :return: the queued job
+        :rtype: Job
+        """
+        job = Job(kind, device, function, total)
+        job._changed = self._changed
+        with self._lock:
+            self.jobs[job.id] = job
+            finished = [key for key, previous in self.jobs.items() if previous.state in Job.FINISHED]
+            for key in finished[:max(0, len(self.jobs) - self.HISTORY)]:
+                del self.jobs[key]
+            queue = self.queues.get(device)
+            if queue is None:
+                queue = self.queues[device] = DeviceQueue(device, self.logger)
+                queue.start()
+        queue.queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a job that did not start yet.
+
+        :param job_id: id of the job
+        :type job_id: str
+        :return: True if the job was cancelled
+        :rtype: bool
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        with self.queues[job.device].lock:
+            if job.state != Job.QUEUED:
+                return False
+            job.state, job.finished = Job.CANCELLED, time()
+        job.touch()
+        return True
+
+    def wait(self, job: Job, version: int, timeout: float) -> bool:
+        """
+        Waits until a job changes.
+
+        :param job: the job
+        :type job: Job
+        :param version: version of the job already known by the caller
+        :type version: int
+        :param timeout: maximum wait, in seconds
+        :type timeout: float
+        :return: True if the job changed
+        :rtype: bool
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: job.version != version, timeout)
+
+    def shutdown(self, timeout: float) -> None:
+        """
+        Cancels the queued jobs and waits for the running ones, interrupted once their current step is reported.
+
+        :param timeout: maximum wait, in seconds
+        :type timeout: float
+        """
+        running = []
+        for job in list(self.jobs.values()):
+            # A job that started meanwhile can not be cancelled anymore
+            if job.state not in Job.FINISHED and not self.cancel(job.id):
+                job.stopping = True
+                running.append(job)
+        with self._changed:
+            if not self._changed.wait_for(lambda: all(job.state in Job.FINISHED for job in running), timeout):
+                self.logger.warning('jobs still running after {:.1f}s: {}'.format(
+                    timeout, ', '.join('{} of "{}"'.format(job.kind, job.device) for job in running)
+                ))
+
+
+class TestJobs(object):
+    def test_fifo(self) -> None:
+        manager = object.__new__(JobManager)
+        manager.__init__(getLogger())
+        order = []
+
+        def operation(job: Job) -> int:
+            for index in range(3):
+                job.step(total=3)
+                order.append((job.kind, index))
+            return job.done
+
+        first = manager.submit('first', 'ph', operation)
+        second = manager.submit('second', 'ph', operation)
+        while second.state not in Job.FINISHED:
+            manager.wait(second, second.version, 1.0)
+        assert order == [('first', 0), ('first', 1), ('first', 2), ('second', 0), ('second', 1), ('second', 2)]
+        assert (first.state, first.result, second.to_dict()['done']) == (Job.DONE, 3, 3)
+        assert manager.cancel(first.id) is False
+
+    def test_failure(self) -> None:
+        manager = object.__new__(JobManager)
+        manager.__init__(getLogger())
+
+        def operation(job: Job) -> None:
+            raise RuntimeError('no response')
+
+        job = manager.submit('export', 'ph', operation)
+        while job.state not in Job.FINISHED:
+            manager.wait(job, job.version, 1.0)
+        assert (job.state, job.error) == (Job.FAILED, 'no response')
+
+    def test_shutdown(self) -> None:
+        from threading import Event
+
+        manager = object.__new__(JobManager)
+        manager.__init__(getLogger())
+        started = Event()
+
+        def operation(job: Job) -> None:
+            started.set()
+            while True:
+                job.step()
+
+        running = manager.submit('import', 'ph', operation)
+        queued = manager.submit('export', 'ph', operation)
+        started.wait(1.0)
+        manager.shutdown(1.0)
+        assert (running.state, queued.state) == (Job.CANCELLED, Job.CANCELLED)
+        assert running.error.startswith('interrupted by shutdown after ') and queued.started is None
+
+    def test_last_step_not_interrupted(self) -> None:
+        from threading import Event
+
+        manager = object.__new__(JobManager)
+        manager.__init__(getLogger())
+        applying, applied = Event(), Event()
+
+        def calibrate(job: Job) -> str:
+            applying.set()
+            applied.wait(1.0)
+            job.step(1, 1)
+            return 'applied'
+
+        job = manager.submit('calibration', 'ph', calibrate, total=1)
+        applying.wait(1.0)
+        job.stopping = True
+        applied.set()
+        while job.state not in Job.FINISHED:
+            manager.wait(job, job.version, 1.0)
+        assert (job.state, job.result, job.error) == (Job.DONE, 'applied', None)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Host-wide leader election between the processes serving ANCS (uWSGI workers), based on a file lock.
+Only the leader polls the drop-ins; the other processes serve the state it shares.
+"""
+
+from app.core.helper.singleton import Singleton
+from logging import Logger, getLogger
+from os import getenv, getpid
+from threading import Thread
+from typing import Callable, Optional
+import fcntl
+
+
+class LeaderElection(object, metaclass=Singleton):
+    """
+    The process holding an exclusive `flock` on LOCK_FILE is the leader. Followers block on the lock in a
+    background thread and take over as soon as the leader exits, the kernel releasing the lock with the process.
+    Setting WATCHER_LOCK_FILE to an empty value disables the election: the process always leads.
+    """
+    LOCK_FILE: str = getenv('WATCHER_LOCK_FILE', '/tmp/ancs-watcher.lock')
+
+    logger: Logger = None
+    is_leader: bool = False
+
+    def __init__(self, logger: Logger = None, lock_file: str = None) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        :param lock_file: path of the lock file, defaults to LOCK_FILE
+        :type lock_file: str
+        """
+        self.logger = logger or getLogger()
+        self.lock_file = self.LOCK_FILE if lock_file is None else lock_file
+        self._fd = None
+        self._thread: Optional[Thread] = None
+
+    def start(self, on_elected: Callable[[], None]) -> bool:
+        """
+        Tries to become the leader; if another process leads, waits for it in the background.
+
+        :param on_elected: called once this process becomes the leader
+        :type on_elected: Callable[[], None]
+        :return: True if this process leads right away
+        :rtype: bool
+        """
+        if not self.lock_file:
+            self.elected(on_elected)
+            return True
+        self._fd = open(self.lock_file, 'a+')
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.logger.info('process {} follows the watcher leader, waiting for the lock'.format(getpid()))
+            self._thread = Thread(target=self.wait_for_lock, args=(on_elected,), name='leader-election', daemon=True)
+            self._thread.start()
+            return False
+        self.elected(on_elected)
+        return True
+
+    def wait_for_lock(self, on_elected: Callable[[], None]) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self.elected(on_elected)
+
+    def elected(self, on_elected: Callable[[], None]) -> None:
+        self.is_leader = True
+        if self._fd is not None:
+            self._fd.seek(0)
+            self._fd.truncate()
+            self._fd.write(str(getpid()))
+            self._fd.flush()
+        self.logger.info('process {} is the watcher leader'.format(getpid()))
+        on_elected()
+
+    def release(self) -> None:
+        """
+        Gives the leadership up, letting a follower take over.
+        """
+        if self._fd is not None and self.is_leader:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.is_leader = False
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Graceful shutdown of the process running the watcher.
+
+The components register their shutdown hooks in the order they must run (stop the watcher, let the jobs finish,
+flush the checkpoint and the shared metrics, close the drop-ins, give the leadership up); `shutdown` runs them once,
+each receiving the time left before SHUTDOWN_TIMEOUT so that the commands in progress on the devices complete but
+a stuck one never holds a restart. Hooks run after the deadline still do what does not wait (e.g. flushing files).
+
+`install` triggers the shutdown from uWSGI's `atexit` hook when served by uWSGI, from SIGTERM and SIGINT otherwise,
+and at interpreter exit in any case.
+"""
+
+from app.core.helper.singleton import Singleton
+from functools import partial
+from logging import Logger, getLogger
+from os import getenv
+from threading import Lock, current_thread, main_thread
+from time import monotonic
+from typing import Callable, List, Tuple
+import atexit
+import signal
+
+
+class Lifecycle(object, metaclass=Singleton):
+    """
+    Ordered shutdown hooks of the process, run once within SHUTDOWN_TIMEOUT seconds.
+    """
+    TIMEOUT: float = float(getenv('SHUTDOWN_TIMEOUT', '2.0'))
+
+    logger: Logger = None
+    stopped: bool = False
+
+    def __init__(self, logger: Logger = None) -> None:
+        """
+        Ctor
+
+        :param logger: a logger instance
+        :type logger: Logger
+        """
+        self.logger = logger or getLogger()
+        self.stopped = False
+        self._hooks: List[Tuple[str, Callable[[float], None]]] = []
+        self._installed = False
+        self._lock = Lock()
+
+    def on_shutdown(self, name: str, hook: Callable[[float], None]) -> None:
+        """
+        Registers a shutdown hook, run after the ones registered before it.
+
+        :param name: name of the hook, for the logs
+        :type name: str
+        :param hook: receives the time left before the deadline, in seconds
+        :type hook: Callable[[float], None]
+        """
+        with self._lock:
+            self._hooks.append((name, hook))
+
+    def install(self) -> None:
+        """
+        Runs `shutdown` when the process stops; signal handlers are only installed from the main thread, and chain
+        the previous ones.
+        """
+        with self._lock:
+            if self._installed:
+                return
+            self._installed = True
+        try:
+            import uwsgi
+        except ImportError:
+            uwsgi = None
+        if uwsgi is not None:
+            previous = getattr(uwsgi, 'atexit', None)
+            uwsgi.atexit = partial(self.on_exit, previous)
+        elif current_thread() is main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, partial(self.on_signal, signal.getsignal(signum)))
+        atexit.register(self.shutdown)
+
+    def on_exit(self, previous: Callable[[], None]) -> None:
+        self.shutdown()
+        if callable(previous):
+            previous()
+
+    def on_signal(self, previous: object, signum: int, frame: object) -> None:
+        self.logger.info('received signal {}'.format(signal.Signals(signum).name))
+        self.shutdown()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            raise SystemExit(128 + signum)
+
+    def shutdown(self) -> None:
+        """
+        Runs the shutdown hooks, once; a failing hook is logged and does not prevent the next ones from running.
+        """
+        with self._lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            hooks = list(self._hooks)
+        started = monotonic()
+        deadline = started + self.TIMEOUT
+        self.logger.info('shutting down, {:.1f}s given to the devices in use'.format(self.TIMEOUT))
+        for name, hook in hooks:
+            try:
+                hook(max(0.0, deadline - monotonic()))
+            except Exception as excp:
+                self.logger.error('shutdown of {} failed: {}'.format(name, excp))
+        self.logger.info('shutdown completed in {:.3f}s'.format(monotonic() - started))
+
+
+class TestLifecycle(object):
+    def test_shutdown(self) -> None:
+        lifecycle = object.__new__(Lifecycle)
+        lifecycle.__init__(getLogger())
+        lifecycle.TIMEOUT = 1.0
+        calls = []
+
+        def failing(timeout: float) -> None:
+            raise RuntimeError('boom')
+
+        lifecycle.on_shutdown('watcher', lambda timeout: calls.append(('watcher', 0.5 < timeout <= 1.0)))
+        lifecycle.on_shutdown('failing', failing)
+        lifecycle.on_shutdown('checkpoint', lambda timeout: calls.append(('checkpoint', timeout <= 1.0)))
+        lifecycle.shutdown()
+        lifecycle.shutdown()
+        assert calls == [('watcher', True), ('checkpoint', True)]
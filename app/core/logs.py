@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Logging that stays off the measurement path:
+- `Lazy` messages are only formatted when a handler writes them, so disabled debug logs cost a level check,
+- debug records are rate-limited per call site (LOG_DEBUG_RATE records per minute, 0 for no limit),
+- the root logger hands its records to a bounded queue, drained by a listener thread running the actual handlers;
+  records are dropped rather than blocking the caller when the queue is full (LOG_QUEUE_SIZE),
+- the last LOG_RING_SIZE records are kept in memory at LOG_RING_LEVEL (defaults to LOG_LEVEL), e.g. DEBUG in
+  production while the stream handler stays at INFO, and served by `/api/logs`.
+
+Dropped records are counted by `ancs_log_records_dropped{reason}` (`rate` or `queue`).
+"""
+
+from app.core.helper.metrics import get_or_create
+from app.core.helper.singleton import Singleton
+from collections import deque
+from itertools import count
+from logging import DEBUG, Filter, Formatter, Handler, LogRecord, getLevelName, getLogger
+from logging.handlers import QueueHandler, QueueListener
+from os import getenv
+from prometheus_client import Counter
+from queue import Full, Queue
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+import atexit
+
+
+def dropped_records(reason: str) -> Counter:
+    """
+    Returns the counter of the log records dropped for a reason.
+
+    :param reason: `rate` or `queue`
+    :type reason: str
+    :return: the labelled counter
+    :rtype: Counter
+    """
+    return get_or_create(
+        Counter,
+        'ancs_log_records_dropped',
+        'Log records dropped by the debug rate limit (rate) or because the log queue was full (queue)',
+        ['reason']
+    ).labels(reason)
+
+
+class Lazy(object):
+    """
+    Log message formatted with `str.format` when first written: `logger.debug(Lazy('read {} in {:.3f}s', name, t))`.
+    """
+    __slots__ = ('message', 'args', 'kwargs', '_formatted')
+
+    def __init__(self, message: str, *args, **kwargs) -> None:
+        self.message = message
+        self.args = args
+        self.kwargs = kwargs
+        self._formatted: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self._formatted is None:
+            self._formatted = self.message.format(*self.args, **self.kwargs)
+        return self._formatted
+
+
+class DebugRateLimit(Filter):
+    """
+    Lets at most `rate` debug records per minute through from each call site (token bucket, bursts of `rate`);
+    the next record let through from a site carries the number of records it suppressed meanwhile (`suppressed`).
+    """
+
+    def __init__(self, rate: float) -> None:
+        """
+        Ctor
+
+        :param rate: records per minute and call site
+        :type rate: float
+        """
+        super().__init__()
+        self.rate = float(rate)
+        # Tokens, last refill and suppressed records of each (file, line)
+        self._sites: Dict[Tuple[str, int], List[float]] = {}
+        self._lock = Lock()
+        self.dropped = dropped_records('rate')
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno > DEBUG or self.rate <= 0:
+            return True
+        now = monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [self.rate, now, 0]
+            site[0] = min(self.rate, site[0] + (now - site[1]) * self.rate / 60.0)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                self.dropped.inc()
+                return False
+            site[0] -= 1
+            record.suppressed, site[2] = int(site[2]), 0
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that drops the records of a full queue instead of blocking or reporting an error.
+    Records are formatted by the listener thread, not by the caller: their arguments must not change once logged.
+    """
+
+    def __init__(self, queue: Queue) -> None:
+        super().__init__(queue)
+        self.dropped = dropped_records('queue')
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # The queue does not leave the process, formatting is left to the handlers of the listener
+        return record
+
+    def enqueue(self, record: LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped.inc()
+
+
+class RingHandler(Handler, metaclass=Singleton):
+    """
+    Keeps the last `capacity` records of the process in memory, numbered so that clients can poll for new ones.
+    """
+
+    def __init__(self, capacity: int = None) -> None:
+        """
+        Ctor
+
+        :param capacity: number of records kept, defaults to LOG_RING_SIZE
+        :type capacity: int
+        """
+        super().__init__()
+        self.records: deque = deque(maxlen=capacity or int(getenv('LOG_RING_SIZE', '1000')))
+        self._sequence = count(1)
+        self._exceptions = Formatter()
+
+    def emit(self, record: LogRecord) -> None:
+        try:
+            entry = {
+                'id': next(self._sequence),
+                'timestamp': record.created,
+                'level': record.levelname,
+                'logger': record.name,
+                'thread': record.threadName,
+                'module': record.module,
+                'line': record.lineno,
+                'message': record.getMessage()
+            }
+            if record.exc_info:
+                entry['exception'] = self._exceptions.formatException(record.exc_info)
+            if getattr(record, 'suppressed', 0):
+                entry['suppressed'] = record.suppressed
+            self.records.append(entry)
+        except Exception:
+            self.handleError(record)
+
+    def query(self, level: str = None, logger: str = None, since: int = 0, limit: int = 100) -> List[dict]:
+        """
+        Returns the kept records matching the criteria, oldest first.
+
+        :param level: minimum level name, e.g. `WARNING`
+        :type level: str
+        :param logger: prefix of the logger name
+        :type logger: str
+        :param since: only the records whose id is greater
+        :type since: int
+        :param limit: maximum number of records, the most recent ones
+        :type limit: int
+        :return: the records
+        :rtype: List[dict]
+        """
+        levelno = getLevelName(level.upper()) if level else 0
+        if not isinstance(levelno, int):
+            raise ValueError('unknown level "{}"'.format(level))
+        records = [
+            entry for entry in list(self.records)
+            if entry['id'] > since
+            if getLevelName(entry['level']) >= levelno
+            if not logger or entry['logger'].startswith(logger)
+        ]
+        return records[-limit:] if limit > 0 else []
+
+
+def install_queue() -> Optional[QueueListener]:
+    """
+    Moves the handlers of the root logger behind a non-blocking queue and adds the ring of recent records; the
+    moved handlers keep the LOG_LEVEL threshold. Does nothing when already installed.
+
+    :return: the started listener, None if already installed
+    :rtype: Optional[QueueListener]
+    """
+    root = getLogger()
+    if any(isinstance(handler, NonBlockingQueueHandler) for handler in root.handlers):
+        return None
+    level = getLevelName(getenv('LOG_LEVEL', 'INFO').upper())
+    ring_level = getLevelName(getenv('LOG_RING_LEVEL', getLevelName(level)).upper())
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+        handler.setLevel(max(handler.level, level))
+    ring = RingHandler()
+    ring.setLevel(ring_level)
+
+    queue_handler = NonBlockingQueueHandler(Queue(maxsize=int(getenv('LOG_QUEUE_SIZE', '10000'))))
+    queue_handler.addFilter(DebugRateLimit(float(getenv('LOG_DEBUG_RATE', '60'))))
+    listener = QueueListener(queue_handler.queue, *handlers, ring, respect_handler_level=True)
+    listener.start()
+    # Writes the records still queued at exit
+    atexit.register(listener.stop)
+    root.addHandler(queue_handler)
+    root.setLevel(min(level, ring_level))
+    return listener
+
+
+class TestLogs(object):
+    def test_lazy_and_rate_limit(self) -> None:
+        from logging import makeLogRecord
+
+        calls = []
+
+        class Spy(object):
+            def __format__(self, spec: str) -> str:
+                calls.append(spec)
+                return 'spy'
+
+        message = Lazy('read {} in {:.1f}s', Spy(), 0.25)
+        assert calls == []
+        assert str(message) == str(message) == 'read spy in 0.2s' and calls == ['']
+
+        limit = DebugRateLimit(2)
+        records = [makeLogRecord({'levelno': DEBUG, 'pathname': 'watcher.py', 'lineno': 1}) for _ in range(4)]
+        assert [limit.filter(record) for record in records] == [True, True, False, False]
+        assert limit.filter(makeLogRecord({'levelno': DEBUG, 'pathname': 'watcher.py', 'lineno': 2}))
+        limit._sites[('watcher.py', 1)][1] -= 30
+        assert limit.filter(records[0]) and records[0].suppressed == 2
+
+    def test_ring(self) -> None:
+        from logging import ERROR, INFO, makeLogRecord
+
+        ring = object.__new__(RingHandler)
+        ring.__init__(3)
+        for index, level in enumerate((DEBUG, INFO, ERROR, INFO)):
+            ring.handle(makeLogRecord({
+                'levelno': level, 'levelname': getLevelName(level), 'name': 'app.watcher', 'msg': Lazy('{}', index)
+            }))
+        assert [entry['message'] for entry in ring.query()] == ['1', '2', '3']
+        assert [entry['id'] for entry in ring.query(level='error')] == [3]
+        assert [entry['id'] for entry in ring.query(since=2, logger='app')] == [3, 4]
+        assert ring.query(logger='werkzeug') == [] and len(ring.query(limit=1)) == 1
+
+    def test_queue_full(self) -> None:
+        from logging import INFO, makeLogRecord
+        from prometheus_client import REGISTRY
+
+        def dropped() -> float:
+            return REGISTRY.get_sample_value('ancs_log_records_dropped_total', {'reason': 'queue'}) or 0.0
+
+        queue = Queue(maxsize=1)
+        handler = NonBlockingQueueHandler(queue)
+        before = dropped()
+        for index in range(3):
+            handler.handle(makeLogRecord({'levelno': INFO, 'msg': Lazy('{}', index)}))
+        assert queue.qsize() == 1 and queue.get_nowait().getMessage() == '0'
+        assert dropped() - before == 2
@@ -0,0 +1,636 @@
+# -*- coding: utf-8 -*-
+"""
+Fan-out of the readings produced by the drop-ins.
+
+A drop-in is sampled once per periodic call; the resulting batch of readings goes through every sink registered on
+the pipeline (Prometheus metrics, latest values snapshot, in-memory history, ...), so that adding an output never
+means reading the hardware again.
+
+Each dispatch advances the version of the published readings (`Pipeline.version`, exported as
+`ancs_snapshot_version`) while holding `Pipeline.lock`, which readers take to get consistent values. In snapshot mode
+the watcher samples the due drop-ins of a cycle concurrently and publishes their readings at once, as one version whose
+time base is the start of the cycle (see `Pipeline.snapshot`); the readings keep the time they were taken at.
+"""
+
+from app.core.accounting import CostAccounting
+from app.core.helper.metrics import get_or_create
+from app.core.helper.singleton import Singleton
+from app.core.reading import Reading
+from app.core.rollups import ROLLUPS, Bucket, Rollup
+from collections import deque
+from contextlib import contextmanager
+from logging import Logger, getLogger
+from prometheus_client import Counter, Gauge
+from os import getenv
+from threading import Lock, RLock, get_ident
+from time import time
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+
+class Sink(object):
+    """
+    Destination of the readings; `write` receives the whole batch produced by one sample of a drop-in.
+    """
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        """
+        Consumes a batch of readings.
+
+        :param drop_in: the sampled drop-in
+        :type drop_in: BaseDropIn
+        :param readings: readings of the sample
+        :type readings: List[Reading]
+        """
+        raise NotImplementedError
+
+    def forget(self, name: str) -> None:
+        """
+        Drops what is held for a drop-in instance, called when it is unloaded.
+
+        :param name: name of the instance
+        :type name: str
+        """
+        pass
+
+
+class PrometheusSink(Sink):
+    """
+    Sets the drop-in's Prometheus metric named after each reading, through the child bound by `setup_metrics`.
+    Bad readings are not exported, the metric keeps its last valid value.
+    """
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        children = drop_in._children
+        for reading in readings:
+            if reading.quality == Reading.BAD:
+                continue
+            child = children.get(reading.metric)
+            if child is None:
+                metric = drop_in._metrics.get(reading.metric)
+                if metric is None:
+                    continue
+                child = metric.labels(drop_in.name)
+            child.set(reading.value)
+
+
+class QualitySink(Sink):
+    """
+    Counts the readings of every metric by quality (`ancs_readings{drop_in_name, metric, quality}`), so that the
+    share of suspect and bad readings of a sensor can be followed.
+    """
+
+    def __init__(self) -> None:
+        self.counter = get_or_create(
+            Counter,
+            'ancs_readings',
+            'Number of readings published, by quality',
+            ['drop_in_name', 'metric', 'quality']
+        )
+        self._children: Dict[tuple, object] = {}
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        for reading in readings:
+            key = (drop_in.name, reading.metric, reading.quality)
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self.counter.labels(*key)
+            child.inc()
+
+    def forget(self, name: str) -> None:
+        for key in [key for key in self._children if key[0] == name]:
+            del self._children[key]
+            try:
+                self.counter.remove(*key)
+            except KeyError:
+                pass
+
+
+class SnapshotSink(Sink):
+    """
+    Latest reading of every metric of every drop-in.
+    """
+
+    def __init__(self) -> None:
+        self.latest: Dict[str, Dict[str, Reading]] = {}
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        # Readers get either the previous or the new values of a drop-in, never a mix of both
+        values = dict(self.latest.get(drop_in.name, {}))
+        for reading in readings:
+            values[reading.metric] = reading
+        self.latest[drop_in.name] = values
+
+    def forget(self, name: str) -> None:
+        self.latest.pop(name, None)
+
+
+class HistorySink(Sink):
+    """
+    The last HISTORY_SIZE readings of every metric of every drop-in.
+    """
+    HISTORY_SIZE: int = int(getenv('READINGS_HISTORY_SIZE', '360'))
+
+    def __init__(self, size: int = None) -> None:
+        """
+        Ctor
+
+        :param size: number of readings kept per metric, defaults to HISTORY_SIZE
+        :type size: int
+        """
+        self.size = size or self.HISTORY_SIZE
+        self.history: Dict[str, Dict[str, Deque[Reading]]] = {}
+        self._lock = Lock()
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        with self._lock:
+            metrics = self.history.setdefault(drop_in.name, {})
+            for reading in readings:
+                series = metrics.get(reading.metric)
+                if series is None:
+                    series = metrics[reading.metric] = deque(maxlen=self.size)
+                series.append(reading)
+
+    def forget(self, name: str) -> None:
+        with self._lock:
+            self.history.pop(name, None)
+
+    def series(self, name: str, metric: str, since: float = None) -> List[Reading]:
+        """
+        Readings of a metric, oldest first.
+
+        :param name: name of the drop-in instance
+        :type name: str
+        :param metric: name of the metric
+        :type metric: str
+        :param since: only return readings taken after this unix timestamp
+        :type since: float
+        :return: the readings
+        :rtype: List[Reading]
+        """
+        with self._lock:
+            readings = list(self.history.get(name, {}).get(metric, ()))
+        if since is not None:
+            readings = [reading for reading in readings if reading.timestamp > since]
+        return readings
+
+
+class RollupSink(Sink):
+    """
+    Min, max, mean and count of the valid readings of every metric over the buckets of each rollup resolution
+    (see `app.core.rollups`). The aggregates of the last closed bucket are exported as
+    `ancs_readings_rollup{drop_in_name, metric, resolution, aggregate}`.
+    """
+    AGGREGATES: Tuple[str, ...] = ('min', 'max', 'mean', 'count')
+
+    def __init__(self, rollups: Dict[str, Tuple[int, int]] = None) -> None:
+        """
+        Ctor
+
+        :param rollups: resolution (seconds) and number of buckets of each rollup, defaults to ROLLUPS
+        :type rollups: Dict[str, Tuple[int, int]]
+        """
+        self.rollups = ROLLUPS if rollups is None else rollups
+        self.gauge = get_or_create(
+            Gauge,
+            'ancs_readings_rollup',
+            'Aggregates of the readings over the last closed bucket of each resolution',
+            ['drop_in_name', 'metric', 'resolution', 'aggregate']
+        )
+        self.series: Dict[str, Dict[str, Dict[str, Rollup]]] = {}
+        self._lock = Lock()
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        closed = []
+        with self._lock:
+            metrics = self.series.setdefault(drop_in.name, {})
+            for reading in readings:
+                if reading.quality == Reading.BAD:
+                    continue
+                rollups = metrics.get(reading.metric)
+                if rollups is None:
+                    rollups = metrics[reading.metric] = {
+                        name: Rollup(resolution, size) for name, (resolution, size) in self.rollups.items()
+                    }
+                for name, rollup in rollups.items():
+                    bucket = rollup.add(reading.timestamp, reading.value)
+                    if bucket is not None:
+                        closed.append((reading.metric, name, bucket))
+        for metric, name, bucket in closed:
+            self.export(drop_in.name, metric, name, bucket)
+
+    def export(self, drop_in_name: str, metric: str, resolution: str, bucket: Bucket) -> None:
+        values = (bucket.minimum, bucket.maximum, bucket.mean, bucket.count)
+        for aggregate, value in zip(self.AGGREGATES, values):
+            self.gauge.labels(drop_in_name, metric, resolution, aggregate).set(value)
+
+    def forget(self, name: str) -> None:
+        with self._lock:
+            metrics = self.series.pop(name, {})
+        for metric in metrics:
+            for resolution in self.rollups:
+                for aggregate in self.AGGREGATES:
+                    try:
+                        self.gauge.remove(name, metric, resolution, aggregate)
+                    except KeyError:
+                        pass
+
+    def buckets(self, name: str, metric: str, resolution: str, since: float = None) -> Optional[List[Bucket]]:
+        """
+        Buckets of a metric at a resolution, oldest first.
+
+        :param name: name of the drop-in instance
+        :type name: str
+        :param metric: name of the metric
+        :type metric: str
+        :param resolution: name of the rollup, e.g. `5m`
+        :type resolution: str
+        :param since: only return the buckets ending after this unix timestamp
+        :type since: float
+        :return: the buckets, None when the resolution is not maintained
+        :rtype: Optional[List[Bucket]]
+        """
+        if resolution not in self.rollups:
+            return None
+        with self._lock:
+            rollup = self.series.get(name, {}).get(metric, {}).get(resolution)
+            return rollup.buckets(since) if rollup is not None else []
+
+
+class ReadingBus(Sink):
+    """
+    In-process subscriptions to the readings of other drop-ins: the callbacks subscribed to `<instance>.<metric>`
+    receive each new reading of it, in the thread of the publishing drop-in, so they must not block (they
+    typically keep the value for the next sample of the subscriber).
+    """
+
+    def __init__(self) -> None:
+        self._subscribers: Dict[str, List[Callable[[Reading], None]]] = {}
+        self._lock = Lock()
+
+    def subscribe(self, source: str, callback: Callable[[Reading], None]) -> None:
+        """
+        Subscribes a callback to the readings of a metric.
+
+        :param source: `<instance>.<metric>`
+        :type source: str
+        :param callback: called with each new reading
+        :type callback: Callable[[Reading], None]
+        """
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            subscribers[source] = subscribers.get(source, []) + [callback]
+            self._subscribers = subscribers
+
+    def unsubscribe(self, source: str, callback: Callable[[Reading], None]) -> None:
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            callbacks = [subscriber for subscriber in subscribers.get(source, []) if subscriber != callback]
+            if callbacks:
+                subscribers[source] = callbacks
+            else:
+                subscribers.pop(source, None)
+            self._subscribers = subscribers
+
+    def write(self, drop_in, readings: List[Reading]) -> None:
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        for reading in readings:
+            for callback in subscribers.get('{}.{}'.format(drop_in.name, reading.metric), ()):
+                callback(reading)
+
+
+class Pipeline(object, metaclass=Singleton):
+    """
+    Dispatches the readings of each sample to the registered sinks, in registration order.
+    A failing sink is logged and does not prevent the other ones from receiving the readings.
+    """
+    # Sinks feeding other drop-ins, written as soon as the readings are published, even within a snapshot
+    LIVE_SINKS: Tuple[str, ...] = ('bus',)
+    logger: Logger = None
+    sinks: Dict[str, Sink] = None
+    lock: RLock = None
+    version: int = 0
+    timestamp: Optional[float] = None
+
+    def __init__(self, logger: Logger = None) -> None:
+        """
+        Ctor, registers the Prometheus, quality, snapshot, history, rollups and bus sinks.
+
+        :param logger: a logger instance
+        :type logger: Logger
+        """
+        self.logger = logger or getLogger()
+        self.sinks = {
+            'prometheus': PrometheusSink(),
+            'quality': QualitySink(),
+            'snapshot': SnapshotSink(),
+            'history': HistorySink(),
+            'rollups': RollupSink(),
+            'bus': ReadingBus()
+        }
+        # Held while readings are dispatched, so that readers never see a half-published version
+        self.lock = RLock()
+        self.version = 0
+        self.timestamp = None
+        # Start of this process, tells apart the versions of two runs (e.g. in ETags)
+        self.epoch = int(time())
+        self._batch: Optional[List[Tuple[object, List[Reading]]]] = None
+        self._batch_threads: Optional[set] = None
+        self.version_gauge = get_or_create(
+            Gauge,
+            'ancs_snapshot_version',
+            'Version of the published readings, incremented by each publication'
+        )
+        self.timestamp_gauge = get_or_create(
+            Gauge,
+            'ancs_snapshot_timestamp_seconds',
+            'Time base of the last published readings'
+        )
+        self.window_gauge = get_or_create(
+            Gauge,
+            'ancs_snapshot_window_seconds',
+            'Time between the first and the last reading of the last snapshot'
+        )
+
+    def add_sink(self, name: str, sink: Sink) -> None:
+        """
+        Registers a sink, replacing the one with the same name.
+
+        :param name: name of the sink
+        :type name: str
+        :param sink: the sink
+        :type sink: Sink
+        """
+        sinks = dict(self.sinks)
+        sinks[name] = sink
+        self.sinks = sinks
+
+    def remove_sink(self, name: str) -> Optional[Sink]:
+        """
+        Unregisters a sink.
+
+        :param name: name of the sink
+        :type name: str
+        :return: the removed sink, if any
+        :rtype: Optional[Sink]
+        """
+        sinks = dict(self.sinks)
+        sink = sinks.pop(name, None)
+        self.sinks = sinks
+        return sink
+
+    def publish(self, drop_in, readings: List[Reading]) -> None:
+        """
+        Sends the readings of one sample of a drop-in to every sink.
+
+        :param drop_in: the sampled drop-in
+        :type drop_in: BaseDropIn
+        :param readings: readings of the sample
+        :type readings: List[Reading]
+        """
+        if not readings:
+            return
+        batch, threads = self._batch, self._batch_threads
+        if batch is not None and threads is not None and get_ident() in threads:
+            with self.lock:
+                batch.append((drop_in, readings))
+                self.dispatch(drop_in, readings, self.LIVE_SINKS)
+            return
+        with self.lock:
+            self.dispatch(drop_in, readings)
+            self.advance(readings[0].timestamp)
+
+    @contextmanager
+    def snapshot(self, timestamp: float = None) -> Iterator[None]:
+        """
+        Holds back the readings published by the current thread, and by the threads that join the snapshot (see
+        `joined`), until the block exits, then dispatches them at once, as a single version whose time base is the
+        snapshot timestamp. The readings keep their own timestamp and carry the snapshot one as `cycle`; the time
+        between the first and the last of them is exported as `ancs_snapshot_window_seconds`. The LIVE_SINKS get them
+        right away, and `latest` serves them to the drop-ins sampled after them in the block, so that the consumers
+        of a reading are not delayed by a cycle.
+
+        :param timestamp: unix timestamp of the snapshot, defaults to now
+        :type timestamp: float
+        """
+        timestamp = time() if timestamp is None else timestamp
+        batch = self._batch = []
+        self._batch_threads = {get_ident()}
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._batch = self._batch_threads = None
+            if batch:
+                held_back = tuple(name for name in self.sinks if name not in self.LIVE_SINKS)
+                taken = [reading.timestamp for _, readings in batch for reading in readings]
+                with self.lock:
+                    for drop_in, readings in batch:
+                        for reading in readings:
+                            reading.cycle = timestamp
+                        self.dispatch(drop_in, readings, held_back)
+                    self.advance(timestamp)
+                self.window_gauge.set(max(taken) - min(taken))
+
+    @contextmanager
+    def joined(self) -> Iterator[None]:
+        """
+        Adds the readings published by the current thread within the block to the snapshot in progress, e.g. by the
+        drop-ins the watcher samples concurrently; outside of a snapshot, the readings are published right away.
+        """
+        threads = self._batch_threads
+        if threads is None:
+            yield
+            return
+        threads.add(get_ident())
+        try:
+            yield
+        finally:
+            threads.discard(get_ident())
+
+    def latest(self) -> Dict[str, Dict[str, Reading]]:
+        """
+        Returns the latest readings of every drop-in, including the ones held back by the snapshot of the calling
+        thread, e.g. for the inputs of the derived metrics.
+
+        :return: the latest readings by instance then metric, not to be modified
+        :rtype: Dict[str, Dict[str, Reading]]
+        """
+        snapshot = self.sinks.get('snapshot')
+        latest = snapshot.latest if snapshot is not None else {}
+        batch, threads = self._batch, self._batch_threads
+        if not batch or threads is None or get_ident() not in threads:
+            return latest
+        latest = dict(latest)
+        with self.lock:
+            batch = list(batch)
+        for drop_in, readings in batch:
+            values = latest[drop_in.name] = dict(latest.get(drop_in.name, {}))
+            for reading in readings:
+                values[reading.metric] = reading
+        return latest
+
+    def restore(self, drop_in, readings: List[Reading]) -> None:
+        """
+        Serves readings restored from a checkpoint: they only update the Prometheus metrics and the snapshot,
+        the other sinks having already seen them in the previous run.
+
+        :param drop_in: the restored drop-in
+        :type drop_in: BaseDropIn
+        :param readings: its latest readings
+        :type readings: List[Reading]
+        """
+        with self.lock:
+            for sink_name in ('prometheus', 'snapshot'):
+                sink = self.sinks.get(sink_name)
+                if sink is not None:
+                    sink.write(drop_in, readings)
+            self.advance(max(reading.timestamp for reading in readings))
+
+    def dispatch(self, drop_in, readings: List[Reading], sink_names: Tuple[str, ...] = None) -> None:
+        """
+        Writes readings to every sink, the caller holds the lock; the time of each sink is charged to the drop-in
+        (see `app.core.accounting`).
+
+        :param drop_in: the sampled drop-in
+        :type drop_in: BaseDropIn
+        :param readings: readings of the sample
+        :type readings: List[Reading]
+        :param sink_names: only write to these sinks, defaults to all of them
+        :type sink_names: Tuple[str, ...]
+        """
+        accounting = CostAccounting()
+        for sink_name, sink in self.sinks.items():
+            if sink_names is not None and sink_name not in sink_names:
+                continue
+            try:
+                with accounting.measure(drop_in.name, 'output:{}'.format(sink_name)):
+                    sink.write(drop_in, readings)
+            except Exception as excp:
+                self.logger.error(
+                    'sink "{}" failed to write readings of "{}": {}'.format(sink_name, drop_in.name, excp)
+                )
+
+    def advance(self, timestamp: float) -> None:
+        self.version += 1
+        self.timestamp = timestamp
+        self.version_gauge.set(self.version)
+        self.timestamp_gauge.set(timestamp)
+
+    def current(self) -> Tuple[int, Optional[float], Dict[str, Dict[str, Reading]]]:
+        """
+        Returns the latest readings of every drop-in along with their version.
+
+        :return: the version, its time base and the latest readings by instance then metric
+        :rtype: Tuple[int, Optional[float], Dict[str, Dict[str, Reading]]]
+        """
+        snapshot = self.sinks.get('snapshot')
+        with self.lock:
+            return self.version, self.timestamp, dict(snapshot.latest) if snapshot is not None else {}
+
+    def forget(self, name: str) -> None:
+        """
+        Drops what the sinks hold for an unloaded drop-in instance.
+
+        :param name: name of the instance
+        :type name: str
+        """
+        with self.lock:
+            for sink in self.sinks.values():
+                sink.forget(name)
+            self.advance(time())
+
+
+class TestPipeline(object):
+    class DropIn(object):
+        def __init__(self, name: str) -> None:
+            self.name = name
+            self._metrics = {}
+            self._children = {}
+
+    @staticmethod
+    def pipeline() -> Pipeline:
+        # Bypasses the singleton so that tests do not share sinks
+        pipeline = object.__new__(Pipeline)
+        pipeline.__init__(getLogger())
+        return pipeline
+
+    def test_fan_out(self) -> None:
+        pipeline = self.pipeline()
+        history = HistorySink(size=2)
+        pipeline.add_sink('history', history)
+        drop_in = self.DropIn('probe')
+        for value in (1.0, 2.0, 3.0):
+            pipeline.publish(drop_in, [Reading('temperature', value, 'celsius', timestamp=value)])
+
+        assert [reading.value for reading in history.series('probe', 'temperature')] == [2.0, 3.0]
+        assert [reading.value for reading in history.series('probe', 'temperature', since=2.0)] == [3.0]
+        assert pipeline.sinks['snapshot'].latest['probe']['temperature'].value == 3.0
+
+        pipeline.forget('probe')
+        assert history.series('probe', 'temperature') == []
+        assert 'probe' not in pipeline.sinks['snapshot'].latest
+
+    def test_bus(self) -> None:
+        pipeline = self.pipeline()
+        received = []
+        pipeline.sinks['bus'].subscribe('bme280.temperature', received.append)
+        pipeline.publish(self.DropIn('bme280'), [Reading('temperature', 21.5), Reading('humidity', 40.0)])
+        pipeline.publish(self.DropIn('soil'), [Reading('temperature', 18.0)])
+        pipeline.sinks['bus'].unsubscribe('bme280.temperature', received.append)
+        pipeline.publish(self.DropIn('bme280'), [Reading('temperature', 22.0)])
+        assert [reading.value for reading in received] == [21.5]
+
+    def test_snapshot(self) -> None:
+        pipeline = self.pipeline()
+        latest = pipeline.sinks['snapshot'].latest
+        received = []
+        pipeline.sinks['bus'].subscribe('bme280.temperature', received.append)
+        with pipeline.snapshot(timestamp=100.0):
+            pipeline.publish(self.DropIn('bme280'), [Reading('temperature', 21.5, timestamp=98.0)])
+            # Consumers sampled later in the cycle already get the reading
+            assert [reading.value for reading in received] == [21.5]
+            assert pipeline.latest()['bme280']['temperature'].value == 21.5
+            pipeline.publish(self.DropIn('soil'), [Reading('temperature', 18.0, timestamp=99.5)])
+            assert latest == {} and pipeline.version == 0
+        version, timestamp, readings = pipeline.current()
+        assert (version, timestamp) == (1, 100.0) and len(received) == 1
+        assert [readings[name]['temperature'].timestamp for name in ('bme280', 'soil')] == [98.0, 99.5]
+        assert readings['soil']['temperature'].to_dict()['cycle'] == 100.0 and pipeline.latest() is latest
+        pipeline.publish(self.DropIn('soil'), [Reading('temperature', 18.5, timestamp=110.0)])
+        assert pipeline.current()[:2] == (2, 110.0)
+
+    def test_snapshot_joined(self) -> None:
+        from threading import Thread
+
+        pipeline = self.pipeline()
+
+        def sample(name: str, timestamp: float) -> None:
+            with pipeline.joined():
+                pipeline.publish(self.DropIn(name), [Reading('temperature', 20.0, timestamp=timestamp)])
+
+        with pipeline.snapshot(timestamp=100.0):
+            threads = [Thread(target=sample, args=args) for args in (('bme280', 99.0), ('soil', 99.25))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Not joined: published right away
+            other = Thread(target=pipeline.publish, args=(self.DropIn('api'), [Reading('ph', 7.0, timestamp=99.5)]))
+            other.start()
+            other.join()
+            assert pipeline.version == 1 and sorted(pipeline.latest()) == ['api', 'bme280', 'soil']
+        version, timestamp, readings = pipeline.current()
+        assert (version, timestamp) == (2, 100.0) and sorted(readings) == ['api', 'bme280', 'soil']
+        assert pipeline.window_gauge._value.get() == 0.25
+
+    def test_failing_sink(self) -> None:
+        class FailingSink(Sink):
+            def write(self, drop_in, readings: List[Reading]) -> None:
+                raise RuntimeError('boom')
+
+        pipeline = self.pipeline()
+        pipeline.sinks = {'failing': FailingSink(), 'snapshot': SnapshotSink()}
+        pipeline.publish(self.DropIn('probe'), [Reading('ph', 7.0, 'pH')])
+        assert pipeline.sinks['snapshot'].latest['probe']['ph'].value == 7.0
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Statistical profiler of the running process: the thread asking for a profile records the stacks of the selected
+threads every `interval` seconds for its duration; nothing runs between two profiles.
+
+Threads are selected by kind:
+- `watcher`: the background watcher polling the drop-ins, and its sampling threads in snapshot mode,
+- `http`: the threads serving a request at the time of the sample (inside Flask's `wsgi_app`),
+- `jobs`: the device job threads (see `app.core.jobs`),
+- `all`: every thread but the sampler.
+
+Profiles are rendered as collapsed stacks (`thread;outer;...;inner <count>`, the input of flamegraph.pl and most
+flame graph viewers) or in the speedscope file format (https://www.speedscope.app).
+"""
+
+from app.core.background_watcher import BackgroundWatcher
+from collections import Counter
+from os import path, sep
+from threading import enumerate as threads, get_ident
+from time import monotonic, sleep
+from types import CodeType, FrameType
+from typing import Dict, Iterable, List, Tuple
+import sys
+
+
+class StackSampler(object):
+    """
+    Samples the stacks of the selected threads from its caller's thread, which is never sampled.
+    """
+    WATCHER: str = 'watcher'
+    HTTP: str = 'http'
+    JOBS: str = 'jobs'
+    ALL: str = 'all'
+    KINDS: tuple = (WATCHER, HTTP, JOBS, ALL)
+
+    def __init__(self, kinds: Iterable[str] = (WATCHER, HTTP), interval: float = 0.005) -> None:
+        """
+        Ctor
+
+        :param kinds: kinds of the sampled threads, see KINDS
+        :type kinds: Iterable[str]
+        :param interval: time between two samples, in seconds
+        :type interval: float
+        """
+        self.kinds = set(kinds)
+        unknown = self.kinds.difference(self.KINDS)
+        if unknown or not self.kinds:
+            raise ValueError('expected thread kinds among {}, got {}'.format(', '.join(self.KINDS), kinds))
+        if interval <= 0:
+            raise ValueError('the interval must be positive')
+        self.interval = interval
+        # Functions found in the stacks as (name, file, first line), and their index by code object
+        self.frames: List[Tuple[str, str, int]] = []
+        self._frame_ids: Dict[CodeType, int] = {}
+        # Number of samples of each (thread name, frame indexes from the outermost) stack
+        self.stacks: Counter = Counter()
+        self.rounds = 0
+        self.duration = 0.0
+        # Time spent sampling, in seconds
+        self.overhead = 0.0
+
+    def run(self, seconds: float) -> 'StackSampler':
+        """
+        Samples the threads for `seconds` seconds, blocking the caller meanwhile.
+
+        :param seconds: duration of the profile
+        :type seconds: float
+        :return: the sampler, for chaining
+        :rtype: StackSampler
+        """
+        me = get_ident()
+        started = monotonic()
+        deadline = started + seconds
+        while True:
+            sampled = monotonic()
+            names = {thread.ident: thread.name for thread in threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.sample(names.get(ident, str(ident)), frame)
+            self.rounds += 1
+            now = monotonic()
+            self.overhead += now - sampled
+            if now >= deadline:
+                break
+            sleep(min(max(0.0, self.interval - (now - sampled)), deadline - now))
+        self.duration = monotonic() - started
+        return self
+
+    def sample(self, thread_name: str, frame: FrameType) -> None:
+        """
+        Records the stack of a thread, when selected.
+
+        :param thread_name: name of the thread
+        :type thread_name: str
+        :param frame: its current frame
+        :type frame: FrameType
+        """
+        stack = []
+        serving = False
+        while frame is not None:
+            code = frame.f_code
+            frame_id = self._frame_ids.get(code)
+            if frame_id is None:
+                frame_id = self._frame_ids[code] = len(self.frames)
+                self.frames.append((getattr(code, 'co_qualname', code.co_name), short_path(code.co_filename),
+                                    code.co_firstlineno))
+            serving = serving or (code.co_name == 'wsgi_app' and '{}flask{}'.format(sep, sep) in code.co_filename)
+            stack.append(frame_id)
+            frame = frame.f_back
+        selected = (
+            self.ALL in self.kinds,
+            self.WATCHER in self.kinds and thread_name.startswith(BackgroundWatcher.THREAD_NAME),
+            self.HTTP in self.kinds and serving,
+            self.JOBS in self.kinds and thread_name.startswith('jobs-')
+        )
+        if any(selected):
+            self.stacks[(thread_name, tuple(reversed(stack)))] += 1
+
+    def collapsed(self) -> str:
+        """
+        Renders the profile as collapsed stacks, one line per distinct stack.
+
+        :return: the lines, most sampled stack first
+        :rtype: str
+        """
+        lines = []
+        for (thread_name, stack), count in self.stacks.most_common():
+            labels = ['{} ({}:{})'.format(*self.frames[frame_id]).replace(';', ':') for frame_id in stack]
+            lines.append('{} {}'.format(';'.join([thread_name.replace(';', ':')] + labels), count))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def speedscope(self) -> dict:
+        """
+        Renders the profile in the speedscope file format, one sampled profile per thread; the weight of a sample
+        is the average time between two samples.
+
+        :return: the speedscope document
+        :rtype: dict
+        """
+        weight = self.duration / self.rounds if self.rounds else 0.0
+        profiles = {}
+        for (thread_name, stack), count in self.stacks.items():
+            profile = profiles.setdefault(thread_name, {
+                'type': 'sampled',
+                'name': thread_name,
+                'unit': 'seconds',
+                'startValue': 0.0,
+                'endValue': self.duration,
+                'samples': [],
+                'weights': []
+            })
+            profile['samples'].append(list(stack))
+            profile['weights'].append(count * weight)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': 'ancs profile ({:.1f}s, {} samples)'.format(self.duration, self.rounds),
+            'exporter': 'ancs',
+            'activeProfileIndex': 0,
+            'shared': {
+                'frames': [{'name': name, 'file': file_name, 'line': line} for name, file_name, line in self.frames]
+            },
+            'profiles': [profiles[name] for name in sorted(profiles)]
+        }
+
+
+def short_path(file_name: str) -> str:
+    """
+    Strips the longest `sys.path` entry from a file name, e.g. `app/core/pipeline.py`.
+
+    :param file_name: absolute file name of a function
+    :type file_name: str
+    :return: the file name relative to its import root
+    :rtype: str
+    """
+    # An empty entry stands for the working directory
+    for root in sorted((path.abspath(entry) for entry in sys.path), key=len, reverse=True):
+        root = path.join(root, '')
+        if file_name.startswith(root):
+            return file_name[len(root):]
+    return file_name
+
+
+class TestStackSampler(object):
+    def test_profile(self) -> None:
+        from threading import Event, Thread
+
+        stopping = Event()
+
+        def spin() -> None:
+            while not stopping.is_set():
+                sum(range(1000))
+
+        thread = Thread(target=spin, name=BackgroundWatcher.THREAD_NAME, daemon=True)
+        thread.start()
+        try:
+            sampler = StackSampler(interval=0.001).run(0.1)
+        finally:
+            stopping.set()
+            thread.join(1.0)
+        assert sampler.rounds > 10 and set(name for name, _ in sampler.stacks) == {BackgroundWatcher.THREAD_NAME}
+        assert '.spin (app/core/profiler.py:' in sampler.collapsed()
+        document = sampler.speedscope()
+        assert [profile['name'] for profile in document['profiles']] == [BackgroundWatcher.THREAD_NAME]
+        assert all(frame_id < len(document['shared']['frames']) for frame_id in document['profiles'][0]['samples'][0])
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Measurements returned by the drop-ins, see `BaseDropIn.sample`.
+"""
+
+from time import time
+
+
+class Reading(object):
+    """
+    A single measurement: drop-ins produce readings, the pipeline (see `app.core.pipeline`) turns them into metrics,
+    snapshots and history. Slotted so that the thousands of readings kept by the history stay small.
+    """
+    __slots__ = ('metric', 'value', 'unit', 'timestamp', 'quality', 'cycle')
+
+    # Qualities of a reading: trustworthy, doubtful (kept but flagged) or unusable (e.g. a failed read)
+    GOOD: str = 'good'
+    SUSPECT: str = 'suspect'
+    BAD: str = 'bad'
+
+    def __init__(
+            self,
+            metric: str,
+            value: float,
+            unit: str = '',
+            timestamp: float = None,
+            quality: str = GOOD,
+            cycle: float = None
+    ) -> None:
+        """
+        Ctor
+
+        :param metric: name of the measured quantity, the key of the drop-in's Prometheus metric
+        :type metric: str
+        :param value: measured value
+        :type value: float
+        :param unit: unit of the value
+        :type unit: str
+        :param timestamp: unix timestamp of the measurement, defaults to now
+        :type timestamp: float
+        :param quality: one of GOOD, SUSPECT or BAD
+        :type quality: str
+        :param cycle: unix timestamp of the watcher cycle that published the reading, in snapshot mode
+            (see `Pipeline.snapshot`)
+        :type cycle: float
+        """
+        self.metric = metric
+        self.value = value
+        self.unit = unit
+        self.timestamp = time() if timestamp is None else timestamp
+        self.quality = quality
+        self.cycle = cycle
+
+    def to_dict(self) -> dict:
+        values = {
+            'metric': self.metric,
+            'value': self.value,
+            'unit': self.unit,
+            'timestamp': self.timestamp,
+            'quality': self.quality
+        }
+        if self.cycle is not None:
+            values['cycle'] = self.cycle
+        return values
+
+    def __repr__(self) -> str:
+        return 'Reading({}={}{} @{:.3f}, {})'.format(self.metric, self.value, self.unit, self.timestamp, self.quality)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental aggregates (min, max, mean, count) of the readings of each metric over fixed time buckets, maintained as
+the readings are published (see `app.core.pipeline.RollupSink`) so that long-range queries read a few hundred
+buckets instead of every raw reading.
+
+The resolutions and the number of buckets kept for each of them are set by READINGS_ROLLUPS, by default
+`1m:60,5m:288,1h:168,6h:120` (an hour of minutes, a day of 5 minutes, a week of hours and 30 days of 6 hours, about
+25 kB per metric). Longer retentions, e.g. `1m:1440,5m:2016,1h:720`, cost 40 bytes per closed bucket and metric.
+"""
+
+from array import array
+from os import getenv
+from typing import Dict, List, Optional, Tuple
+
+# Seconds per duration suffix
+UNITS: Dict[str, int] = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+DEFAULT_ROLLUPS: str = '1m:60,5m:288,1h:168,6h:120'
+
+
+class Bucket(object):
+    """
+    Aggregates of the readings of one time bucket, constant in size whatever the number of readings.
+    """
+    __slots__ = ('start', 'count', 'total', 'minimum', 'maximum')
+
+    def __init__(self, start: float) -> None:
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+
+    @classmethod
+    def from_values(cls, start: float, count: float, total: float, minimum: float, maximum: float) -> 'Bucket':
+        bucket = cls(start)
+        bucket.count, bucket.total, bucket.minimum, bucket.maximum = int(count), total, minimum, maximum
+        return bucket
+
+    def values(self) -> Tuple[float, float, float, float, float]:
+        return self.start, self.count, self.total, self.minimum, self.maximum
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'timestamp': self.start,
+            'min': self.minimum,
+            'max': self.maximum,
+            'mean': self.mean,
+            'count': self.count
+        }
+
+
+class Rollup(object):
+    """
+    Buckets of one resolution for one metric: the bucket being filled and the last `size` closed ones. Closed
+    buckets are kept as FIELDS doubles each in a flat array, used as a ring once full, rather than as objects.
+    """
+    # start, count, total, minimum and maximum
+    FIELDS: int = 5
+
+    def __init__(self, resolution: int, size: int) -> None:
+        """
+        Ctor
+
+        :param resolution: duration of a bucket in seconds, buckets are aligned on multiples of it
+        :type resolution: int
+        :param size: number of closed buckets kept
+        :type size: int
+        """
+        self.resolution = resolution
+        self.size = size
+        self.current: Optional[Bucket] = None
+        # Grows up to `size` buckets, then `_oldest` is overwritten by each closed bucket
+        self._closed = array('d')
+        self._oldest = 0
+
+    def add(self, timestamp: float, value: float) -> Optional[Bucket]:
+        """
+        Adds a value to the bucket of its timestamp; late values are added to the current bucket.
+
+        :param timestamp: unix timestamp of the value
+        :type timestamp: float
+        :param value: the value
+        :type value: float
+        :return: the bucket closed by this value, if any
+        :rtype: Optional[Bucket]
+        """
+        start = timestamp - timestamp % self.resolution
+        closed = None
+        if self.current is None:
+            self.current = Bucket(start)
+        elif start > self.current.start:
+            closed = self.current
+            self.close(closed)
+            self.current = Bucket(start)
+        self.current.add(value)
+        return closed
+
+    def close(self, bucket: Bucket) -> None:
+        """
+        Keeps a closed bucket, in place of the oldest one when `size` buckets are kept already.
+
+        :param bucket: the closed bucket
+        :type bucket: Bucket
+        """
+        if len(self._closed) < self.size * self.FIELDS:
+            self._closed.extend(bucket.values())
+            return
+        offset = self._oldest * self.FIELDS
+        self._closed[offset:offset + self.FIELDS] = array('d', bucket.values())
+        self._oldest = (self._oldest + 1) % self.size
+
+    def closed(self) -> List[Bucket]:
+        """
+        Closed buckets, oldest first.
+
+        :return: the buckets
+        :rtype: List[Bucket]
+        """
+        kept = len(self._closed) // self.FIELDS
+        buckets = []
+        for index in range(kept):
+            offset = (self._oldest + index) % kept * self.FIELDS
+            buckets.append(Bucket.from_values(*self._closed[offset:offset + self.FIELDS]))
+        return buckets
+
+    def buckets(self, since: float = None) -> List[Bucket]:
+        """
+        Closed buckets followed by the current one, oldest first.
+
+        :param since: only return the buckets ending after this unix timestamp
+        :type since: float
+        :return: the buckets
+        :rtype: List[Bucket]
+        """
+        buckets = self.closed()
+        if self.current is not None:
+            buckets.append(self.current)
+        if since is not None:
+            buckets = [bucket for bucket in buckets if bucket.start + self.resolution > since]
+        return buckets
+
+
+def parse_duration(duration: str) -> int:
+    """
+    Converts `90`, `30s`, `5m`, `1h` or `1d` to seconds.
+
+    :param duration: the duration
+    :type duration: str
+    :return: the number of seconds
+    :rtype: int
+    """
+    duration = str(duration).strip().lower()
+    if duration[-1:] in UNITS:
+        return int(duration[:-1]) * UNITS[duration[-1]]
+    return int(duration)
+
+
+def parse_rollups(rollups: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parses a list of rollups, `<resolution>:<size>` separated by commas.
+
+    :param rollups: the rollups
+    :type rollups: str
+    :return: resolution in seconds and number of buckets kept, indexed by resolution name
+    :rtype: Dict[str, Tuple[int, int]]
+    """
+    parsed = {}
+    for rollup in filter(None, (rollup.strip() for rollup in rollups.split(','))):
+        name, _, size = rollup.partition(':')
+        resolution = parse_duration(name)
+        if resolution <= 0 or int(size or 1) <= 0:
+            raise ValueError('invalid rollup "{}"'.format(rollup))
+        parsed[name.strip()] = (resolution, int(size or 1))
+    return parsed
+
+
+ROLLUPS: Dict[str, Tuple[int, int]] = parse_rollups(getenv('READINGS_ROLLUPS', DEFAULT_ROLLUPS))
+
+
+class TestRollups(object):
+    def test_buckets(self) -> None:
+        rollup = Rollup(60, size=2)
+        closed = [rollup.add(timestamp, value) for timestamp, value in ((0, 1.0), (30, 3.0), (61, 5.0), (130, 2.0))]
+        assert [bucket.start if bucket else None for bucket in closed] == [None, None, 0, 60]
+        assert [bucket.to_dict() for bucket in rollup.buckets(since=100)] == [
+            {'timestamp': 60, 'min': 5.0, 'max': 5.0, 'mean': 5.0, 'count': 1},
+            {'timestamp': 120, 'min': 2.0, 'max': 2.0, 'mean': 2.0, 'count': 1}
+        ]
+        assert (closed[2].minimum, closed[2].maximum, closed[2].mean, closed[2].count) == (1.0, 3.0, 2.0, 2)
+
+    def test_ring(self) -> None:
+        rollup = Rollup(60, size=3)
+        for minute in range(6):
+            rollup.add(minute * 60.0, float(minute))
+        assert [(bucket.start, bucket.mean) for bucket in rollup.closed()] == [(120, 2.0), (180, 3.0), (240, 4.0)]
+        assert len(rollup._closed) == 3 * Rollup.FIELDS and rollup.current.start == 300
+
+    def test_parse(self) -> None:
+        assert parse_rollups('1m:1440, 1h:720,90') == {'1m': (60, 1440), '1h': (3600, 720), '90': (90, 1)}
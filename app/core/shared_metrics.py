@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Sharing of the watcher leader's metrics with the other processes.
+
+After each watcher cycle the leader writes the Prometheus exposition of its registry to a file (write then rename,
+so readers never see a partial file); followers serve that file on /metrics. Every process therefore exposes the
+same values, and adding HTTP workers does not multiply bus traffic.
+
+Metrics are collected while no readings are being published (see `SnapshotRegistry`), so an exposition never mixes
+two versions of the readings; `ancs_snapshot_version` tells which one it holds.
+"""
+
+from app.core.leader import LeaderElection
+from app.core.pipeline import Pipeline
+from os import getenv, path, replace
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, make_wsgi_app
+from tempfile import NamedTemporaryFile
+from typing import Callable, Iterable, Iterator
+
+SNAPSHOT_FILE: str = getenv('METRICS_SNAPSHOT_FILE', '/tmp/ancs-metrics.prom')
+
+
+class SnapshotRegistry(object):
+    """
+    View of a registry collecting its metrics under the lock of the pipeline.
+    """
+
+    def __init__(self, registry: CollectorRegistry = REGISTRY) -> None:
+        self.registry = registry
+
+    def collect(self) -> Iterator:
+        with Pipeline().lock:
+            metrics = list(self.registry.collect())
+        return iter(metrics)
+
+    def restricted_registry(self, names: Iterable[str]) -> 'SnapshotRegistry':
+        return SnapshotRegistry(self.registry.restricted_registry(names))
+
+
+def write_snapshot(snapshot_file: str = None) -> None:
+    """
+    Atomically writes the exposition of the local registry.
+
+    :param snapshot_file: destination, defaults to METRICS_SNAPSHOT_FILE
+    :type snapshot_file: str
+    """
+    snapshot_file = snapshot_file or SNAPSHOT_FILE
+    with NamedTemporaryFile('wb', dir=path.dirname(snapshot_file) or '.', delete=False) as snapshot_fd:
+        snapshot_fd.write(generate_latest(SnapshotRegistry()))
+    replace(snapshot_fd.name, snapshot_file)
+
+
+def make_shared_wsgi_app(election: LeaderElection, snapshot_file: str = None) -> Callable:
+    """
+    Returns a WSGI app serving the live registry in the leader and the leader's snapshot in followers.
+
+    :param election: the leader election of this process
+    :type election: LeaderElection
+    :param snapshot_file: snapshot written by the leader, defaults to METRICS_SNAPSHOT_FILE
+    :type snapshot_file: str
+    :return: a WSGI application
+    :rtype: Callable
+    """
+    live_app = make_wsgi_app(SnapshotRegistry())
+    snapshot_file = snapshot_file or SNAPSHOT_FILE
+
+    def shared_app(environ: dict, start_response: Callable):
+        if election.is_leader:
+            return live_app(environ, start_response)
+        try:
+            with open(snapshot_file, 'rb') as snapshot_fd:
+                data = snapshot_fd.read()
+        except OSError:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b'No metrics published by the watcher leader yet\n']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE_LATEST), ('Content-Length', str(len(data)))])
+        return [data]
+
+    return shared_app
@@ -1,58 +1,69 @@
 # -*- coding: utf-8 -*-
-from inspect import stack
+from app.core.config import DropInConfig, config_path, drop_in_configs, load_config
+from app.core.dropin.loader import DropInLoader
+from app.core.exception.dropin_exceptions import ConfigurationException
 from logging import Logger, getLogger
-import os
+from os import path
+import pkgutil
 import sys
-import traceback
-from typing import Iterable, Tuple
+from time import perf_counter
+from typing import Iterable, List, Optional, Tuple
 
+_loaded: Optional[Tuple[dict, dict]] = None
 
-def load_drop_ins() -> Tuple[dict, dict]:
+
+def load_drop_ins(initialize: bool = True) -> Tuple[dict, dict]:
     """
     Loads existing drop-ins into the Flask app and returns a list
-    of loaded drop-ins
+    of loaded drop-ins.
+    Only the modules of the instances declared in the configuration file (see `app.core.config`) are imported;
+    without a configuration file, every available module is loaded once with its default settings.
+    Instances are initialized in parallel, slow or failing ones are completed in the background.
 
-    :return: a tuple containing loaded modules and API enabled handlers
+    :param initialize: construct the instances, see `DropInLoader.load`
+    :type initialize: bool
+    :return: a tuple containing loaded drop-ins indexed by instance name and API enabled handlers
     :rtype: Tuple[dict, dict]
     """
     logger = getLogger()
     logger.debug('loading drop-ins...')
-    drop_ins: dict = {}
-    api_namespaces: dict = {}
-    for module_name in list_modules(logger):
-        logger.debug('processing module "{}"'.format(module_name))
+    loader = DropInLoader(logger)
+    started = perf_counter()
+    instances = discover_drop_ins(logger)
+    loader.record_phase('discovery', perf_counter() - started)
 
-        # noinspection PyBroadException
-        try:
-            drop_in_module = __import__("app.dropins." + module_name, fromlist=["*"])
-            drop_in = drop_in_module.DropIn(logger)
-            module_id = drop_in.identity['id']
-            drop_in.setup_metrics()
-            logger.info('loaded drop-in {}'.format(module_name))
-        except Exception:
-            logger.error("could not register drop in {}:\n{}".format(module_name, traceback.format_exc()))
-            continue
-        try:
-            # If an endpoint is defined, the module exposes an API
-            api_namespaces[module_id] = drop_in_module.api_namespace
-        except AttributeError:
-            logger.info(
-                'Module "{}" does not expose an API'
-                .format(module_name)
-            )
-        except Exception as excp:
-            logger.warning(
-                'Unexpected error while loading module "{}", won\'t expose webservices. Error: {}'
-                .format(module_name, str(excp))
-            )
-        else:
-            logger.info(
-                'registered module "{}" for API access'
-                .format(module_name)
-            )
-        drop_ins[module_id] = drop_in
+    return loader.load(instances, initialize=initialize)
 
-    return drop_ins, api_namespaces
+
+def discover_drop_ins(logger: Logger) -> List[DropInConfig]:
+    """
+    Returns the drop-in instances to load at startup, see `declared_instances`; an invalid configuration file loads
+    none rather than probing the devices at their default address.
+
+    :param logger: Logger instance
+    :type logger: Logger
+    :return: List[DropInConfig]
+    """
+    try:
+        return declared_instances(logger)
+    except ConfigurationException as excp:
+        logger.error('invalid drop-ins configuration, no drop-in loaded: {}'.format(excp))
+        return []
+
+
+def declared_instances(logger: Logger) -> List[DropInConfig]:
+    """
+    Returns the drop-in instances declared in the configuration file, or one default instance per available module
+    when there is no configuration file; a configuration file declaring no instance loads none.
+
+    :param logger: Logger instance
+    :type logger: Logger
+    :return: List[DropInConfig]
+    :raises ConfigurationException: when the configuration file is invalid
+    """
+    if not path.isfile(config_path()):
+        return [DropInConfig(module=module_name) for module_name in list_modules(logger)]
+    return drop_in_configs(load_config())
 
 
 def list_modules(logger: Logger) -> Iterable[str]:
@@ -63,27 +74,50 @@ def list_modules(logger: Logger) -> Iterable[str]:
     :type logger: Logger
     :return: Iterable[str]
     """
-    drop_ins_path = os.path.dirname(os.path.abspath(stack()[0][1]))
-    for file in os.listdir(drop_ins_path):
-        logger.debug('checking drop-in candidate "{}"'.format(file))
-        if os.path.isfile(os.path.join(drop_ins_path, file)):
-            purged_name = file[:file.rindex('.')]
-            extension = file[file.rindex('.') + 1:]
-            if extension != 'py':
-                logger.debug('-> invalid extension')
-                continue
-            if purged_name not in ('__init__',):
-                logger.debug('viable candidate found')
-                yield purged_name
-            else:
-                logger.debug('-> invalid name')
-                continue
-        else:
-            logger.debug('-> not a file')
+    for module_info in pkgutil.iter_modules(__path__):
+        logger.debug('checking drop-in candidate "{}"'.format(module_info.name))
+        if module_info.ispkg:
+            logger.debug('-> not a module')
             continue
+        logger.debug('viable candidate found')
+        yield module_info.name
+
+
+def __getattr__(name: str) -> dict:
+    """
+    Loads the drop-ins on first access to `loaded_drop_ins` or `api_drop_ins` rather than at import time.
+    Only the modules are imported: instances are constructed by the process elected to run the watcher,
+    through `DropInLoader().initialize()`, and `loaded_drop_ins` is filled in place.
+    """
+    global _loaded
+    if name not in ('loaded_drop_ins', 'api_drop_ins'):
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    if _loaded is None:
+        # Disable dropins discovery when running the test suites
+        if hasattr(sys, "__pytest_running__"):
+            _loaded = ({}, {})
+        else:
+            _loaded = load_drop_ins(initialize=False)
+    return _loaded[0] if name == 'loaded_drop_ins' else _loaded[1]
+
 
-# Disable dropins discovery when running the test suites
-if hasattr(sys, "__pytest_running__"):
-    loaded_drop_ins, api_drop_ins = ({}, {})
-else:
-    loaded_drop_ins, api_drop_ins = load_drop_ins()
+class TestDiscovery(object):
+    def test_configuration_file(self) -> None:
+        from os import environ
+        from tempfile import mkdtemp
+
+        directory = mkdtemp()
+        previous = environ.get('DROP_INS_CONFIG')
+        try:
+            environ['DROP_INS_CONFIG'] = path.join(directory, 'missing.yml')
+            assert 'atlas_ezo_ph' in [instance.module for instance in discover_drop_ins(getLogger())]
+            for file_name, content in (('empty.yml', 'drop_ins: []\n'), ('invalid.yml', 'drop_ins: [address: 1]\n')):
+                environ['DROP_INS_CONFIG'] = path.join(directory, file_name)
+                with open(environ['DROP_INS_CONFIG'], 'w') as config_fd:
+                    config_fd.write(content)
+                assert discover_drop_ins(getLogger()) == []
+        finally:
+            if previous is None:
+                environ.pop('DROP_INS_CONFIG', None)
+            else:
+                environ['DROP_INS_CONFIG'] = previous
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
-from adafruit_bme280.basic import Adafruit_BME280_I2C
 from app.core.dropin.base_i2c_dropin import BaseI2CDropIn
-from board import I2C
+from app.core.helper.metrics import MetricSpec
+from app.core.logs import Lazy
+from app.core.reading import Reading
 from logging import Logger
 from os import environ
-from prometheus_client import Gauge, Counter, metrics, Info, Enum
+from prometheus_client import Gauge
 from random import choices
 from string import ascii_letters
-from typing import Optional, Dict
+from typing import Dict, List, Optional
 
 class DropIn(BaseI2CDropIn):
     """
@@ -17,11 +18,31 @@ class DropIn(BaseI2CDropIn):
     DEFAULT_BUS: int = 1
     DROP_IN_VERSION: str = '0.0.1'
     DROP_IN_ID: str = 'adafruit_bme280'
+    DEFAULT_INSTANCE_NAME: str = 'bme280'
     FLASK_ROUTING_RULE: str = 'bme280'
     HANDLED_METHODS = ('GET', 'POST')
     STANDARD_PRESSURE: str = "1013.25"
-
-    def __init__(self, logger: Logger, bus: int = None, address: int = None, connector: object = None):
+    # Bounds are the operating ranges of the sensor
+    METRICS = (
+        MetricSpec('temperature', Gauge, 'Temperature (Celsius degrees)', unit='celsius', rounding=1,
+                   valid_range=(-40.0, 85.0)),
+        MetricSpec('altitude', Gauge, 'Altitude (meters)', unit='m', rounding=2),
+        MetricSpec('humidity', Gauge, 'Humidity (%)', unit='%', rounding=2, valid_range=(0.0, 100.0)),
+        MetricSpec('pressure', Gauge, 'Pressure (hPa)', unit='hPa', rounding=2, valid_range=(300.0, 1100.0))
+    )
+    INFO_METRIC = 'bme280'
+
+    _i2c: object = None
+
+    def __init__(
+            self,
+            logger: Logger,
+            bus: int = None,
+            address: int = None,
+            connector: object = None,
+            calibration: dict = None,
+            **kwargs
+    ):
         """
         Constructor.
         note: `connector` may be a lambda or function that returns an object that MUST exhibit the
@@ -38,14 +59,19 @@ class DropIn(BaseI2CDropIn):
         :type address: int
         :param connector: connector used to talk to the I2C device, defaults to adafruit_bme280 implementation
         :type connector: object
+        :param calibration: optional calibration values, supports `sea_level_pressure` (hPa)
+        :type calibration: dict
+        :param kwargs: instance settings (name, labels, interval)
         """
-        self._metrics: Dict[str, metrics.MetricWrapperBase] = {}
-        if not "SEA_LEVEL_PRESSURE" in environ:
+        calibration = calibration or {}
+        if not "SEA_LEVEL_PRESSURE" in environ and not "sea_level_pressure" in calibration:
             logger.warning(
                 f"No custom sea level pressure is defined, falling back to the standard one ({self.STANDARD_PRESSURE} hPa)"
                 "but some readings will be off; adjust it by setting the environment variable SEA_LEVEL_PRESSURE"
             )
-        self.SEA_LEVEL_PRESSURE: float = float(environ.get("SEA_LEVEL_PRESSURE", self.STANDARD_PRESSURE))
+        self.SEA_LEVEL_PRESSURE: float = float(
+            calibration.get("sea_level_pressure", environ.get("SEA_LEVEL_PRESSURE", self.STANDARD_PRESSURE))
+        )
         current_address: int = address if address else self.DEFAULT_ADDRESS
         current_bus: int = bus if bus else self.DEFAULT_BUS
         current_connector: object
@@ -53,80 +79,43 @@ class DropIn(BaseI2CDropIn):
         if callable(connector):
             current_connector = connector(bus=current_bus, address=current_address)
         else:
+            # Blinka probes the board when imported, only pay for it when the default connector is used
+            from adafruit_bme280.basic import Adafruit_BME280_I2C
+            from board import I2C
             i2c_setup = I2C()
-            current_connector = Adafruit_BME280_I2C(i2c_setup)
+            self._i2c = i2c_setup
+            current_connector = Adafruit_BME280_I2C(i2c_setup, address=current_address)
             current_connector.sea_level_pressure = self.SEA_LEVEL_PRESSURE
-        super().__init__(current_bus, current_address, logger, connector=current_connector)
-
-
-    def setup_metrics(self):
-        # Setup metrics objects. Should never be called by anything except the # __init__() method.
-        self._metrics['state'] = Enum(
-            self.DROP_IN_ID + '_drop_in_status',
-            'Current status of the drop-in',
-            ['drop_in_name'],
-            states=['starting', 'ready', 'measuring']
-        )
-        self._metrics['state'].labels('bme280').state('starting')
+        super().__init__(current_bus, current_address, logger, connector=current_connector, **kwargs)
 
-        self._metrics['periodic_passes'] = Counter(
-            self.DROP_IN_ID + '_measurements_count',
-            'Number of times periodic measurements were performed',
-            ['drop_in_name']
-        )
 
-        self._metrics['temperature'] = Gauge(
-            self.DROP_IN_ID + '_temperature',
-            'Temperature (Celsius degrees)',
-            ['drop_in_name']
-        )
-        self._metrics['altitude'] = Gauge(
-            self.DROP_IN_ID + '_altitude',
-            'Altitude (meters)',
-            ['drop_in_name']
-        )
-        self._metrics['humidity'] = Gauge(
-            self.DROP_IN_ID + '_humidity',
-            'Humidity (%)',
-            ['drop_in_name']
-        )
-        self._metrics['pressure'] = Gauge(
-            self.DROP_IN_ID + '_pressure',
-            'Pressure (hPa)',
-            ['drop_in_name']
-        )
+    def info(self) -> Dict[str, str]:
+        return {**super().info(), 'rule': self.FLASK_ROUTING_RULE}
 
-        self._metrics['bme280'] = Info(
-            self.DROP_IN_ID + '_drop_in',
-            'Information regarding this drop_in',
-            ['drop_in_name']
-        )
-        self._metrics['bme280'].labels('bme280').info(
-            {
-                'version': self.DROP_IN_VERSION,
-                'id': self.DROP_IN_ID,
-                'rule': self.FLASK_ROUTING_RULE,
-                'capabilities': 'temperature, altitude, humidity, pressure'
-            }
-        )
-        self._metrics['state'].labels('bme280').state('ready')
+    def sample(self) -> List[Reading]:
+        """
+        Reads temperature, humidity, pressure and altitude from the sensor.
 
-    def periodic_call(self, context: dict = None) -> None:
+        :return: the readings
+        :rtype: List[Reading]
         """
-        Called by the watcher thread, used to perform periodic measurements and increase
-        relevant Prometheus counters.
+        self.logger.debug(Lazy('sampling {}', self.DROP_IN_ID))
+        return [
+            self.reading('temperature', self._connector.temperature),
+            self.reading('humidity', self._connector.humidity),
+            self.reading('pressure', self._connector.pressure),
+            self.reading('altitude', self._connector.altitude)
+        ]
+
+    def close(self) -> None:
         """
-        self.logger.debug('running periodic upkeep for {}'.format(self.DROP_IN_ID))
-        self._metrics['state'].labels('bme280').state('measuring')
-
-        self._metrics['periodic_passes'].labels('bme280').inc()
-        self._metrics['temperature'].labels('bme280').set(round(self._connector.temperature, 1))
-        self._metrics['humidity'].labels('bme280').set(round(self._connector.humidity, 2))
-        self._metrics['pressure'].labels('bme280').set(round(self._connector.pressure, 2))
-        self._metrics['altitude'].labels('bme280').set(round(self._connector.altitude, 2))
-
-        self._metrics['state'].labels('bme280').state('ready')
-        self.logger.debug('periodic upkeep succeeded')
+        Releases the Blinka I2C bus opened by the default connector.
+        """
+        with self.lock:
+            if self._i2c is not None:
+                self._i2c.deinit()
+                self._i2c = None
+            super().close()
 
     def handler(self, context: dict = None) -> Optional[str]:
         """
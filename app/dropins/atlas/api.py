@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+REST API of the Atlas EZO pH drop-in, imported on first access to `app.dropins.atlas_ezo_ph.api_namespace` so that
+the headless collector does not load Flask.
+
+Requests target the instance loaded by the watcher (`?name=<instance>`, defaults to the only pH instance). Queries
+are coalesced and cached (see `DropIn.cached_query`); the long operations (calibration, import and export) are queued
+as jobs on the device, see `app.core.jobs` and `/api/jobs`.
+"""
+
+from app.api.admin import not_leader
+from app.core.dropin.loader import DropInLoader
+from app.core.jobs import Job, JobManager
+from app.core.leader import LeaderElection
+from app.dropins import atlas_ezo_ph
+from .api_schemas import CalibrationDataSchema, CalibrationPointSchema
+from flask import abort, request
+from flask_restx import Resource, Namespace
+from http import HTTPStatus
+from marshmallow import ValidationError
+from typing import Optional
+
+
+api_namespace = Namespace("pH", description="Available operations for Atlas EZO pH sensor")
+
+
+def get_device() -> 'atlas_ezo_ph.DropIn':
+    """
+    Returns the pH instance targeted by the request; outside of the watcher leader, aborts with the response of the
+    leader to the request, and with 404 when there is no such instance (isolated instances can not be queried
+    through the API).
+
+    :return: the drop-in instance
+    :rtype: atlas_ezo_ph.DropIn
+    """
+    if not LeaderElection().is_leader:
+        abort(not_leader())
+    name = request.args.get('name')
+    devices = {
+        device_name: device for device_name, device in list(DropInLoader().drop_ins.items())
+        if getattr(device, 'DROP_IN_ID', None) == atlas_ezo_ph.DropIn.DROP_IN_ID and hasattr(device, 'command')
+    }
+    if name is None and len(devices) == 1:
+        return next(iter(devices.values()))
+    device = devices.get(name)
+    if device is None:
+        abort(HTTPStatus.NOT_FOUND, 'unknown pH instance, expected `?name=` among: {}'.format(', '.join(devices)))
+    return device
+
+
+def accepted(job: Job) -> tuple:
+    """
+    Response of a queued job, pointing to its status.
+
+    :param job: the job
+    :type job: Job
+    :return: a 202 response
+    :rtype: tuple
+    """
+    return {
+        'status': HTTPStatus.ACCEPTED,
+        'result': job.to_dict()
+    }, HTTPStatus.ACCEPTED, {'Location': '/api/jobs/{}'.format(job.id)}
+
+
+def export_job(device: 'atlas_ezo_ph.DropIn') -> Job:
+    """
+    Queues an export of the calibration of a device, unless one is already queued or running.
+
+    :param device: the drop-in instance
+    :type device: atlas_ezo_ph.DropIn
+    :return: the export job
+    :rtype: Job
+    """
+    manager = JobManager()
+    for job in list(manager.jobs.values()):
+        if job.kind == 'export' and job.device == device.name and job.state not in Job.FINISHED:
+            return job
+
+    def export(job: Job) -> list:
+        return device.export_calibration(lambda done, total: job.step(done, total))
+
+    return manager.submit('export', device.name, export)
+
+
+@api_namespace.route('/device')
+class Device(Resource):
+    @classmethod
+    def get(cls):
+        dev_response = get_device().cached_query('I')
+
+        try:
+            _, dev_type, firmware = dev_response[1].split(',')
+        except (ValueError, AttributeError):
+            _, dev_type, firmware = (None, 'N/A', 'N/A')
+
+        return {
+            'status': 200,
+            'result': {
+                'ret_code': int(dev_response[0]),
+                'raw': dev_response[1],
+                'device_type': dev_type,
+                'firmware_version': firmware
+            }
+        }, 200
+
+
+@api_namespace.route('/calibration')
+class Calibration(Resource):
+    @classmethod
+    def get(cls):
+        dev_response = get_device().cached_query('Cal,?')
+
+        cal_points = None
+        try:
+            cal_points = int(dev_response[1][-1:])
+        except TypeError:
+            pass
+
+        response = {
+            'status': 200,
+            'result': {
+                'ret_code': int(dev_response[0]),
+                'raw': dev_response[1],
+                'is_calibrated': False if dev_response[1] == '?CAL,0' else True,
+                'cal_points': cal_points
+            }
+        }
+
+        return response, 200
+
+    @classmethod
+    def post(cls):
+        """
+        Create a calibration point, `{"point": "mid", "value": 7.0}` (`low`, `mid`, `high` or `clear`).
+        The calibration runs as a job: the response points to its status.
+        """
+        device = get_device()
+        try:
+            point = CalibrationPointSchema().load(request.get_json(force=True, silent=True) or {})
+        except ValidationError as excp:
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': excp.messages}, HTTPStatus.BAD_REQUEST
+
+        def calibrate(job: Job) -> Optional[str]:
+            response = device.calibrate(point['point'], point.get('value'))
+            job.step(1, 1)
+            return response
+
+        return accepted(JobManager().submit('calibration', device.name, calibrate, total=1))
+
+
+@api_namespace.route('/calibration/data')
+class CalibrationData(Resource):
+    @classmethod
+    def get(cls):
+        """
+        Export the calibration data from the device, as a job whose result holds the exported lines; an export of
+        the instance that did not finish yet is answered instead of queuing another one.
+        """
+        return accepted(export_job(get_device()))
+
+    @classmethod
+    def put(cls):
+        """
+        Import calibration data, `{"data": [<lines of an export>]}`, as a job.
+        """
+        device = get_device()
+        try:
+            lines = CalibrationDataSchema().load(request.get_json(force=True, silent=True) or {})['data']
+        except ValidationError as excp:
+            return {'status': HTTPStatus.BAD_REQUEST, 'error': excp.messages}, HTTPStatus.BAD_REQUEST
+
+        def import_data(job: Job) -> None:
+            device.import_calibration(lines, lambda done, total: job.step(done, total))
+
+        return accepted(JobManager().submit('import', device.name, import_data, total=len(lines)))
+
+
+@api_namespace.route('/calibration/export')
+class CalibrationExport(Resource):
+    @classmethod
+    def get(cls):
+        """
+        Result of the last export job of the instance, see `POST`.
+        """
+        device = get_device()
+        exports = [
+            job for job in list(JobManager().jobs.values())
+            if job.kind == 'export' and job.device == device.name and job.state == Job.DONE
+        ]
+        if not exports:
+            return {
+                'status': HTTPStatus.NOT_FOUND,
+                'error': 'no calibration export, POST to this endpoint to export it'
+            }, HTTPStatus.NOT_FOUND
+        return {
+            'status': 200,
+            'result': {
+                'ret_code': 0,
+                'raw': ''.join(exports[-1].result),
+                'lines': exports[-1].result,
+                'lines_count': len(exports[-1].result),
+                'exported': exports[-1].finished
+            }
+        }, 200
+
+    @classmethod
+    def post(cls):
+        """
+        Export the calibration data, as a job whose result holds the exported lines.
+        """
+        return accepted(export_job(get_device()))
+
+
+class TestCalibrationData(object):
+    def test_get_queues_export(self) -> None:
+        from flask import Flask
+        from flask_restx import Api
+        from threading import Event
+
+        class Device(object):
+            DROP_IN_ID = atlas_ezo_ph.DropIn.DROP_IN_ID
+            name = 'test_export_ph'
+
+            def command(self, command: str) -> None:
+                raise AssertionError('the device was queried within the request')
+
+            def export_calibration(self, progress=None) -> list:
+                calls.append(progress)
+                release.wait(1.0)
+                return ['line1', 'line2']
+
+        calls, release = [], Event()
+        app = Flask(__name__)
+        Api(app).add_namespace(api_namespace, path='/api/atlas_ph')
+        loader, election = DropInLoader(), LeaderElection()
+        was_leader = election.is_leader
+        loader.drop_ins[Device.name] = Device()
+        election.is_leader = True
+        try:
+            client = app.test_client()
+            first = client.get('/api/atlas_ph/calibration/data?name=test_export_ph')
+            second = client.get('/api/atlas_ph/calibration/data?name=test_export_ph')
+            job_id = first.get_json()['result']['id']
+            assert (first.status_code, first.headers['Location']) == (HTTPStatus.ACCEPTED, '/api/jobs/' + job_id)
+            # The export in progress is answered instead of queuing another one
+            assert second.get_json()['result']['id'] == job_id
+            job = JobManager().get(job_id)
+            assert job.state in (Job.QUEUED, Job.RUNNING) and job.result is None
+            release.set()
+            while job.state not in Job.FINISHED:
+                JobManager().wait(job, job.version, 1.0)
+            assert (job.state, job.result, len(calls)) == (Job.DONE, ['line1', 'line2'], 1)
+        finally:
+            release.set()
+            election.is_leader = was_leader
+            loader.drop_ins.pop(Device.name, None)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from marshmallow import Schema, fields, validate
+from marshmallow import Schema, fields, validate, validates_schema, ValidationError
 
 
 class I2CDeviceSchema(Schema):
@@ -10,3 +10,17 @@ class I2CDeviceSchema(Schema):
 
 class CalibrationSchema(I2CDeviceSchema):
     points = fields.Int(required=True, validate=validate.Range(min=1, max=3))
+
+
+class CalibrationPointSchema(Schema):
+    point = fields.Str(required=True, validate=validate.OneOf(['low', 'mid', 'high', 'clear']))
+    value = fields.Float(validate=validate.Range(min=0, max=14))
+
+    @validates_schema
+    def validate_value(self, data: dict, **kwargs) -> None:
+        if data.get('point') != 'clear' and data.get('value') is None:
+            raise ValidationError('the pH of the buffer solution is required', 'value')
+
+
+class CalibrationDataSchema(Schema):
+    data = fields.List(fields.Str(validate=validate.Length(min=1)), required=True, validate=validate.Length(min=1))
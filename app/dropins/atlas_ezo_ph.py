@@ -1,19 +1,24 @@
 # -*- coding: utf-8 -*-
 
 from app.core.dropin.base_i2c_dropin import BaseI2CDropIn
-from .atlas.api_schemas import I2CDeviceSchema, CalibrationSchema
-from flask import request
-from flask_restx import Resource, Namespace
-from http import HTTPStatus
-from logging import Logger, getLogger
-from prometheus_client import Gauge, Counter, metrics, Info, Enum
-from typing import Optional, Dict, Tuple, List
+from app.core.dropin.device_lock import DeviceLock
+from app.core.helper.metrics import MetricSpec
+from app.core.helper.single_flight import SingleFlight
+from app.core.logs import Lazy
+from app.core.reading import Reading
+from logging import Logger
+from prometheus_client import Gauge
+from typing import Callable, Optional, Dict, Tuple, List
 
 
-api_namespace = Namespace("pH", description="Available operations for Atlas EZO pH sensor")
-
-# for name, model in api_models.items():
-#     api_namespace.model()
+def __getattr__(name: str) -> object:
+    """
+    Imports the API of the drop-in on first access, Flask is not needed to poll the sensor.
+    """
+    if name == 'api_namespace':
+        from .atlas.api import api_namespace
+        return api_namespace
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
 
 class DropIn(BaseI2CDropIn):
@@ -26,11 +31,34 @@ class DropIn(BaseI2CDropIn):
     DROP_IN_VERSION: str = '0.0.1'
     DROP_IN_ID: str = 'atlas_ph'
     SENSOR_TYPE: str = 'pH'
+    DEFAULT_INSTANCE_NAME: str = 'ph'
     DEFAULT_ERROR_VALUE = -99.0
+    # List of supported commands: https://www.atlas-scientific.com/_files/_datasheets/_circuit/pH_EZO_datasheet.pdf
+    METRICS = (
+        MetricSpec('ph', Gauge, 'pH', unit='pH', rounding=2, valid_range=(0.0, 14.0)),
+    )
+    INFO_METRIC = 'atlas_ph'
+    # Any command wakes the board from `Sleep`; margin given to it before the next command, in seconds
+    WAKE_TIME = 1.0
+    # Seconds the responses of `cached_query` are kept, per command; other commands are only coalesced
+    QUERY_TTLS: Dict[str, float] = {
+        'I': 6 * 3600.0,
+        'CAL,?': 3600.0,
+        'STATUS': 60.0,
+        'R': 2.0
+    }
+    # Calibration points accepted by the `Cal` command; `clear` deletes the calibration
+    CALIBRATION_POINTS: Tuple[str, ...] = ('mid', 'low', 'high', 'clear')
+    # Smallest temperature change (celsius) sent to the board as a new compensation
+    DEFAULT_COMPENSATION_THRESHOLD: float = 0.5
 
-    _metrics: Dict[str, metrics.MetricWrapperBase] = {}
     sensor_firmware: Optional[str] = None
     sensor_type: str = 'ph'
+    compensation_source: Optional[str] = None
+    compensation_threshold: float = DEFAULT_COMPENSATION_THRESHOLD
+    # Latest temperature published by the compensation source, and the one the board compensates for
+    _temperature: Optional[float] = None
+    _compensated: Optional[float] = None
     """:type ._connector: PHWrapper"""
     _connector = None
 
@@ -66,6 +94,30 @@ class DropIn(BaseI2CDropIn):
             """
             return self._connector.query(command)
 
+        def sleep(self) -> None:
+            """
+            Put the board in low power mode, it does not answer.
+            """
+            self._connector.query('Sleep')
+
+        def wake(self) -> None:
+            """
+            Wake the board up by sending it a command whose response is not read.
+            """
+            write = getattr(self._connector, 'write', None)
+            if callable(write):
+                write('I')
+            else:
+                self._connector.query('I')
+
+        def close(self) -> None:
+            """
+            Close the underlying connector's file descriptors.
+            """
+            close = getattr(self._connector, 'close', None)
+            if callable(close):
+                close()
+
     def query(self, command: str) -> Optional[Tuple[int, Optional[str]]]:
         """
         Perform a query and parse the return.
@@ -77,7 +129,16 @@ class DropIn(BaseI2CDropIn):
         """
         return self._connector.query(command)
 
-    def __init__(self, logger: Logger, bus: int = None, address: int = None, connector: object = None) -> None:
+    def __init__(
+            self,
+            logger: Logger,
+            bus: int = None,
+            address: int = None,
+            connector: object = None,
+            calibration: dict = None,
+            compensation: dict = None,
+            **kwargs
+    ) -> None:
         """
         Constructor.
         note: `connector` may be a lambda or function that returns an object that MUST exhibit the
@@ -93,6 +154,13 @@ class DropIn(BaseI2CDropIn):
         :param address: I2C address of the sensor
         :type address: int
         :param connector: connector used to talk to the I2C device, defaults to '.atlas.atlasI2C.AtlasI2C implementation
+        :param calibration: unused, EZO boards store their own calibration
+        :type calibration: dict
+        :param compensation: temperature compensation, `{temperature: <instance>.<metric>, threshold: 0.5}`; the
+            temperature published by that instance is sent to the board (`T,<temp>`) when it changes by more than
+            the threshold
+        :type compensation: dict
+        :param kwargs: instance settings (name, labels, interval)
         """
         current_address: int = address or self.DEFAULT_ADDRESS
         current_bus: int = bus or self.DEFAULT_BUS
@@ -111,188 +179,287 @@ class DropIn(BaseI2CDropIn):
             except BaseException as excp:
                 logger.warning('Could not instantiate default connector (AtlasI2C): {}'.format(excp))
                 raise
-            try:
-                response = current_connector.query('I')
-            except Exception as excp:
-                logger.warning('Could not query sensor: {}'.format(excp))
-                raise
-            try:
-                if response[0] or len(response) != 2:
-                    logger.warning(
-                        'Could not retrieve sensor type, unstable system. Error code: {} // Response: {}'
-                        .format(response[0], response[1])
-                    )
-                else:
-                    identity_data = response[1].split(',')
-                    self.sensor_type = identity_data[1]
-                    self.sensor_firmware = identity_data[2]
-                    current_connector._name = self.sensor_type or DropIn.SENSOR_TYPE
-            except IndexError:
-                logger.warning('Invalid board name returned, unspecified behaviour')
-
-        super().__init__(current_bus, current_address, logger, connector=DropIn.PHWrapper(current_connector))
-
-    def setup_metrics(self):
-        # List of supported commands: https://www.atlas-scientific.com/_files/_datasheets/_circuit/pH_EZO_datasheet.pdf
-        self._metrics['state'] = Enum(
-            self.DROP_IN_ID + '_drop_in_status',
-            'Current status of the drop-in',
-            ['drop_in_name'],
-            states=['starting', 'ready', 'measuring']
+            identity = (kwargs.get('checkpoint') or {}).get('identity') or {}
+            if identity.get('sensor_type') and (identity.get('bus'), identity.get('address')) == (
+                    current_bus, current_address
+            ):
+                # Identity saved by the previous run, the board is not queried again
+                self.sensor_type = identity['sensor_type']
+                self.sensor_firmware = identity.get('sensor_firmware')
+                current_connector._name = self.sensor_type
+            else:
+                self.identify(current_connector, logger)
+
+        super().__init__(
+            current_bus,
+            current_address,
+            logger,
+            connector=DropIn.PHWrapper(current_connector),
+            **kwargs
         )
-        self._metrics['state'].labels('ph').state('starting')
+        self.queries = SingleFlight(self.name)
+        compensation = compensation or {}
+        if compensation.get('temperature'):
+            self.compensation_source = str(compensation['temperature'])
+            self.compensation_threshold = float(compensation.get('threshold', self.DEFAULT_COMPENSATION_THRESHOLD))
+            self.subscribe(self.compensation_source, self.on_temperature)
+
+    def identify(self, connector: object, logger: Logger) -> None:
+        """
+        Queries the type and firmware of the board.
 
-        self._metrics['periodic_passes'] = Counter(
-            self.DROP_IN_ID + '_measurements_count',
-            'Number of times periodic measurements were performed',
-            ['drop_in_name']
-        )
+        :param connector: the AtlasI2C connector
+        :type connector: object
+        :param logger: logger instance
+        :type logger: Logger
+        """
+        try:
+            response = connector.query('I')
+        except Exception as excp:
+            logger.warning('Could not query sensor: {}'.format(excp))
+            raise
+        try:
+            if response[0] or len(response) != 2:
+                logger.warning(
+                    'Could not retrieve sensor type, unstable system. Error code: {} // Response: {}'
+                    .format(response[0], response[1])
+                )
+            else:
+                identity_data = response[1].split(',')
+                self.sensor_type = identity_data[1]
+                self.sensor_firmware = identity_data[2]
+                connector._name = self.sensor_type or DropIn.SENSOR_TYPE
+        except IndexError:
+            logger.warning('Invalid board name returned, unspecified behaviour')
+
+    def checkpoint(self) -> dict:
+        return {
+            **super().checkpoint(),
+            'identity': {
+                'bus': self._bus,
+                'address': self._address,
+                'sensor_type': self.sensor_type,
+                'sensor_firmware': self.sensor_firmware
+            }
+        }
 
-        self._metrics['ph'] = Gauge(
-            self.DROP_IN_ID + '_ph',
-            'pH',
-            ['drop_in_name']
-        )
+    def info(self) -> Dict[str, str]:
+        return {
+            **super().info(),
+            'sensor_firmware': self.sensor_firmware,
+            'capabilities': 'ph, settings, api',
+            'compensation': self.compensation_source
+        }
 
-        self._metrics['atlas_ph'] = Info(
-            self.DROP_IN_ID + '_drop_in',
-            'Information regarding this drop_in',
-            ['drop_in_name']
-        )
+    def on_temperature(self, reading: Reading) -> None:
+        """
+        Keeps the temperature published by the compensation source, it is sent to the board by the next sample.
 
-        self._metrics['atlas_ph'].labels('ph').info(
-            {
-                'version': self.DROP_IN_VERSION,
-                'id': self.DROP_IN_ID,
-                'sensor_firmware': self.sensor_firmware,
-                'capabilities': 'ph, settings, api'
-            }
-        )
-        self._metrics['state'].labels('ph').state('ready')
+        :param reading: the temperature reading
+        :type reading: Reading
+        """
+        if reading.quality != Reading.BAD:
+            self._temperature = reading.value
 
-    def periodic_call(self, context: dict = None) -> None:
+    def compensate(self) -> None:
         """
-        Called by the watcher thread, used to perform periodic measurements and increase
-        relevant Prometheus counters.
+        Sends the latest temperature to the board when it differs from the compensated one by more than the
+        threshold; the temperature is never read on purpose, it comes from the readings of its source.
         """
-        self.logger.debug('running periodic upkeep for {}'.format(self.DROP_IN_ID))
-        self._metrics['state'].labels('ph').state('measuring')
-
-        self._metrics['periodic_passes'].labels('ph').inc()
-        current_ph = self._connector.ph
-        if current_ph:
-            current_ph = round(current_ph, 2)
+        temperature = self._temperature
+        if temperature is None or (
+                self._compensated is not None and abs(temperature - self._compensated) < self.compensation_threshold
+        ):
+            return
+        response = self._connector.query('T,{:.2f}'.format(temperature))
+        self.queries.invalidate('R')
+        if response and not response[0]:
+            self.logger.debug(Lazy('"{}" compensated for {} celsius', self.name, temperature))
+            self._compensated = temperature
         else:
-            current_ph = -99.9
-        self._metrics['ph'].labels('ph').set(current_ph)
+            self.logger.warning('"{}" could not set the temperature compensation: {}'.format(self.name, response))
 
-        self._metrics['state'].labels('ph').state('ready')
-        self.logger.debug('periodic upkeep succeeded')
+    def sample(self) -> List[Reading]:
+        """
+        Reads the pH, after updating the temperature compensation if needed; a failed read is reported with the
+        error value and a bad quality.
 
-    @property
-    def identity(self) -> Dict[str, object]:
-        return {
-            'id': self.DROP_IN_ID,
-            'version': self.DROP_IN_VERSION,
-            'firmware': self.sensor_firmware
-        }
+        :return: the readings
+        :rtype: List[Reading]
+        """
+        self.logger.debug(Lazy('sampling {}', self.DROP_IN_ID))
+        self.compensate()
+        current_ph = self._connector.ph
+        if current_ph is not None:
+            return [self.reading('ph', current_ph)]
+        return [self.reading('ph', self.DEFAULT_ERROR_VALUE, quality=Reading.BAD)]
 
+    def cached_query(self, command: str) -> Optional[Tuple[int, Optional[str]]]:
+        """
+        Performs a read-only query; concurrent identical queries share one exchange with the board and successful
+        responses are cached for the QUERY_TTLS of the command. Calibration writes invalidate the cache.
 
-@api_namespace.route('/device')
-class Device(Resource):
-    @classmethod
-    def get(cls):
-        logger = getLogger()
-        device = DropIn(logger=logger)
-        dev_response = device.query('I')
+        :param command: a read-only command, e.g. `I` or `Cal,?`
+        :type command: str
+        :return: the parsed result
+        :rtype: Optional[Tuple[int, Optional[str]]]
+        """
+        def query() -> Optional[Tuple[int, Optional[str]]]:
+            with self.lock.priority(DeviceLock.INTERACTIVE):
+                self.ready()
+                return self._connector.query(command)
+
+        key = command.upper()
+        return self.queries.call(
+            key,
+            query,
+            ttl=self.QUERY_TTLS.get(key, 0.0),
+            cacheable=lambda response: bool(response) and not response[0]
+        )
 
-        try:
-            _, dev_type, firmware = dev_response[1].split(',')
-        except (ValueError, AttributeError):
-            _, dev_type, firmware = (None, 'N/A', 'N/A')
+    def command(self, command: str) -> Optional[str]:
+        """
+        Sends a command with the interactive priority, ahead of the periodic reads waiting for the device.
 
-        return {
-            'status': 200,
-            'result': {
-                'ret_code': int(dev_response[0]),
-                'raw': dev_response[1],
-                'device_type': dev_type,
-                'firmware_version': firmware
-            }
-        }, 200
+        :param command: the command
+        :type command: str
+        :return: the response of the board
+        :rtype: Optional[str]
+        """
+        with self.lock.priority(DeviceLock.INTERACTIVE):
+            self.ready()
+            response = self._connector.query(command)
+        if not response or response[0]:
+            raise IOError('command "{}" failed: {}'.format(command, response))
+        return response[1]
 
+    def sleep(self) -> None:
+        self._connector.sleep()
 
-@api_namespace.route('/calibration')
-class Calibration(Resource):
-    @classmethod
-    def get(cls):
-        logger = getLogger()
-        device = DropIn(logger=logger)
-        dev_response = device.query('Cal,?')
+    def wake(self) -> None:
+        self._connector.wake()
 
-        cal_points = None
+    def calibrate(self, point: str, value: float = None) -> Optional[str]:
+        """
+        Records a calibration point, the probe being in the matching buffer solution.
+
+        :param point: one of CALIBRATION_POINTS
+        :type point: str
+        :param value: pH of the buffer solution
+        :type value: float
+        :return: the response of the board
+        :rtype: Optional[str]
+        """
+        if point not in self.CALIBRATION_POINTS:
+            raise ValueError('calibration point must be one of {}'.format(', '.join(self.CALIBRATION_POINTS)))
         try:
-            cal_points = int(dev_response[1][-1:])
-        except TypeError:
-            pass
-
-        response = {
-            'status': 200,
-            'result': {
-                'ret_code': int(dev_response[0]),
-                'raw': dev_response[1],
-                'is_calibrated': False if dev_response[1] == '?CAL,0' else True,
-                'cal_points': cal_points
-            }
-        }
-
-        return response, 200
+            with self.lock.priority(DeviceLock.INTERACTIVE):
+                if point == 'clear':
+                    return self.command('Cal,clear')
+                return self.command('Cal,{},{:.2f}'.format(point, float(value)))
+        finally:
+            self.queries.invalidate()
+
+    def export_calibration(self, progress: Callable[[int, int], None] = None) -> List[str]:
+        """
+        Exports the calibration of the board, one command per line; the device is held until the export ends.
 
-    @classmethod
-    def post(cls):
+        :param progress: called with the number of exported lines and the total after each line
+        :type progress: Callable[[int, int], None]
+        :return: the exported lines
+        :rtype: List[str]
         """
-        Create a calibration point.
-        :return:
+        with self.lock.priority(DeviceLock.INTERACTIVE):
+            _, lines_count, _ = self.command('Export,?').split(',')
+            lines = []
+            for index in range(int(lines_count)):
+                lines.append(self.command('Export'))
+                if progress is not None:
+                    progress(index + 1, int(lines_count))
+        return lines
+
+    def import_calibration(self, lines: List[str], progress: Callable[[int, int], None] = None) -> None:
         """
-        logger = getLogger()
-        device = DropIn(logger=logger)
+        Imports a calibration previously exported by `export_calibration`; the device is held until the import ends.
+
+        :param lines: the exported lines
+        :type lines: List[str]
+        :param progress: called with the number of imported lines and the total after each line
+        :type progress: Callable[[int, int], None]
+        """
+        try:
+            with self.lock.priority(DeviceLock.INTERACTIVE):
+                for index, line in enumerate(lines):
+                    self.command('Import,{}'.format(line))
+                    if progress is not None:
+                        progress(index + 1, len(lines))
+        finally:
+            self.queries.invalidate()
 
-        pass
+    @property
+    def identity(self) -> Dict[str, object]:
+        return {
+            'id': self.DROP_IN_ID,
+            'version': self.DROP_IN_VERSION,
+            'firmware': self.sensor_firmware
+        }
 
 
-@api_namespace.route('/calibration/data')
-class CalibrationData(Resource):
-    @classmethod
-    def get(cls):
-        logger = getLogger()
-        device = DropIn(logger=logger)
-        export_query = device.query('Export,?')
-        _, lines_count, bytes_count = export_query[1].split(',')
-        lines_count = int(lines_count)
-        bytes_count = int(bytes_count)
+class TestAtlasEzoPh(object):
+    def test_temperature_compensation(self) -> None:
+        from app.core.pipeline import Pipeline
+        from logging import getLogger
 
-        export_data = ''
-        for i in range(1, lines_count + 1):
-            export_query = device.query('export')
-            export_data += export_query[1]
+        class Connector(object):
+            def __init__(self, bus: int, address: int) -> None:
+                self.commands = []
 
-        return {
-            'status': 200,
-            'result': {
-                'ret_code': 0,
-                'raw': export_data,
-                'lines_count': lines_count,
-                'bytes_count': bytes_count
-            }
-        }
+            def query(self, command: str) -> Tuple[int, str]:
+                self.commands.append(command)
+                return 0, '7.01' if command == 'R' else ''
 
-    @classmethod
-    def put(cls):
-        """
-        Import calibration data
-        :return:
-        """
-        logger = getLogger()
-        device = DropIn(logger=logger)
+        class Source(object):
+            name = 'test_bme'
 
-        pass
+        connectors = []
+        drop_in = DropIn(
+            getLogger(),
+            name='test_ph',
+            connector=lambda **kwargs: connectors.append(Connector(**kwargs)) or connectors[-1],
+            compensation={'temperature': 'test_bme.temperature', 'threshold': 0.5}
+        )
+        bus = Pipeline().sinks['bus']
+        try:
+            assert [reading.value for reading in drop_in.sample()] == [7.01]
+            for temperature, quality in ((21.0, Reading.GOOD), (21.2, Reading.GOOD), (35.0, Reading.BAD),
+                                         (22.0, Reading.GOOD)):
+                bus.write(Source(), [Reading('temperature', temperature, quality=quality)])
+                drop_in.sample()
+            # Changes below the threshold and bad readings are not sent to the board
+            assert connectors[0].commands == ['R', 'T,21.00', 'R', 'R', 'R', 'T,22.00', 'R']
+        finally:
+            drop_in.close()
+            drop_in.release_metrics()
+        bus.write(Source(), [Reading('temperature', 30.0)])
+        assert drop_in._temperature == 22.0
+
+    def test_sample(self) -> None:
+        from logging import getLogger
+
+        class Connector(object):
+            def __init__(self, bus: int, address: int) -> None:
+                self.responses = [(0, '0.00'), (1, None)]
+
+            def query(self, command: str) -> Tuple[int, Optional[str]]:
+                return self.responses.pop(0)
+
+        drop_in = DropIn(getLogger(), name='test_ph_sample', connector=Connector)
+        try:
+            # A pH of 0 is a valid reading
+            assert [(reading.value, reading.quality) for reading in drop_in.sample()] == [(0.0, Reading.GOOD)]
+            assert [(reading.value, reading.quality) for reading in drop_in.sample()] == [
+                (DropIn.DEFAULT_ERROR_VALUE, Reading.BAD)
+            ]
+        finally:
+            drop_in.close()
+            drop_in.release_metrics()
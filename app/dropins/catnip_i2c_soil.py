@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from app.core.dropin.base_i2c_dropin import BaseI2CDropIn
+from app.core.helper.metrics import MetricSpec
+from app.core.logs import Lazy
+from app.core.reading import Reading
 from logging import Logger
-from prometheus_client import Gauge, Counter, metrics, Info, Enum
-from typing import Optional, Dict
+from prometheus_client import Gauge
+from typing import Dict, List, Optional
 
 
 class DropIn(BaseI2CDropIn):
@@ -14,16 +17,35 @@ class DropIn(BaseI2CDropIn):
     DEFAULT_BUS: int = 1
     DROP_IN_VERSION: str = '0.0.1'
     DROP_IN_ID: str = 'catnip_soil'
+    DEFAULT_INSTANCE_NAME: str = 'soil'
     FLASK_ROUTING_RULE: str = 'soil'
     HANDLED_METHODS: tuple = ('GET', 'POST')
     # The values below should reflect your specific device state, perform a calibration
     # if needed beforehand.
     CALIBRATED_MIN_MOISTURE: int = 221
     CALIBRATED_MAX_MOISTURE: int = 614
-
-    _metrics: Dict[str, metrics.MetricWrapperBase] = {}
-
-    def __init__(self, logger: Logger, bus: int = None, address: int = None, connector: object = None):
+    METRICS = (
+        MetricSpec('temperature', Gauge, 'Temperature (Celsius degrees)', unit='celsius'),
+        # see https://github.com/Miceuz/i2c-moisture-sensor/issues/27#issuecomment-434716035
+        MetricSpec('capacitance', Gauge, 'Capacitance value (arbitrary unit)'),
+        MetricSpec('moisture', Gauge, 'Moisture (%)', unit='%'),
+        # see https://www.tindie.com/products/miceuz/i2c-soil-moisture-sensor/ - #Rugged Version
+        MetricSpec('brightness', Gauge, 'Brightness (arbitrary unit)')
+    )
+    INFO_METRIC = 'soil'
+    # The Chirp wakes from deep sleep on any read, and answers reliably about a second later
+    WAKE_TIME = 1.0
+
+
+    def __init__(
+            self,
+            logger: Logger,
+            bus: int = None,
+            address: int = None,
+            connector: object = None,
+            calibration: dict = None,
+            **kwargs
+    ):
         """
         Constructor.
         note: `connector` may be a lambda or function that returns an object that MUST exhibit the
@@ -40,7 +62,11 @@ class DropIn(BaseI2CDropIn):
         :type address: int
         :param connector: connector used to talk to the I2C device, defaults to adafruit_bme280 implementation
         :type connector: object
+        :param calibration: optional calibration values, supports `min_moisture` and `max_moisture`
+        :type calibration: dict
+        :param kwargs: instance settings (name, labels, interval)
         """
+        calibration = calibration or {}
         current_address: int = address if address else self.DEFAULT_ADDRESS
         current_bus: int = bus if bus else self.DEFAULT_BUS
         current_connector: object
@@ -56,83 +82,46 @@ class DropIn(BaseI2CDropIn):
             current_connector = Chirp(
                 bus=current_bus,
                 address=current_address,
-                min_moist=self.CALIBRATED_MIN_MOISTURE,
-                max_moist=self.CALIBRATED_MAX_MOISTURE,
+                min_moist=int(calibration.get('min_moisture', self.CALIBRATED_MIN_MOISTURE)),
+                max_moist=int(calibration.get('max_moisture', self.CALIBRATED_MAX_MOISTURE)),
             )
-        super().__init__(current_bus, current_address, logger, connector=current_connector)
-
-    def setup_metrics(self):
-        self._metrics['state'] = Enum(
-            self.DROP_IN_ID + '_drop_in_status',
-            'Current status of the drop-in',
-            ['drop_in_name'],
-            states=['starting', 'ready', 'measuring']
-        )
-        self._metrics['state'].labels('soil').state('starting')
-
-        self._metrics['periodic_passes'] = Counter(
-            self.DROP_IN_ID + '_measurements_count',
-            'Number of times periodic measurements were performed',
-            ['drop_in_name']
-        )
-
-        self._metrics['temperature'] = Gauge(
-            self.DROP_IN_ID + '_temperature',
-            'Temperature (Celsius degrees)',
-            ['drop_in_name']
-        )
-        self._metrics['capacitance'] = Gauge(
-            self.DROP_IN_ID + '_capacitance',
-            # see https://github.com/Miceuz/i2c-moisture-sensor/issues/27#issuecomment-434716035
-            'Capacitance value (arbitrary unit)',
-            ['drop_in_name']
-        )
-        self._metrics['moisture'] = Gauge(
-            self.DROP_IN_ID + '_moisture',
-            'Moisture (%)',
-            ['drop_in_name']
-        )
-        self._metrics['brightness'] = Gauge(
-            self.DROP_IN_ID + '_brightness',
-            # see https://www.tindie.com/products/miceuz/i2c-soil-moisture-sensor/ - #Rugged Version
-            'Brightness (arbitrary unit)',
-            ['drop_in_name']
-        )
+        super().__init__(current_bus, current_address, logger, connector=current_connector, **kwargs)
 
-        self._metrics['soil'] = Info(
-            self.DROP_IN_ID + '_drop_in',
-            'Information regarding this drop_in',
-            ['drop_in_name']
-        )
-        self._metrics['soil'].labels('soil').info(
-            {
-                'version': self.DROP_IN_VERSION,
-                'id': self.DROP_IN_ID,
-                'rule': self.FLASK_ROUTING_RULE,
-                'capabilities': 'temperature, capacitance, brightness, moisture'
-            }
-        )
-        self._metrics['state'].labels('soil').state('ready')
+    def info(self) -> Dict[str, str]:
+        return {**super().info(), 'rule': self.FLASK_ROUTING_RULE}
 
-    def periodic_call(self, context: dict = None):
+    def sample(self) -> List[Reading]:
         """
-                Called by the watcher thread, used to perform periodic measurements and increase
-                relevant Prometheus counters.
-                """
-        self.logger.debug('running periodic upkeep for {}'.format(self.DROP_IN_ID))
-        self._metrics['state'].labels('soil').state('measuring')
+        Triggers a measurement and reads temperature, capacitance, moisture and brightness.
 
-        self._metrics['periodic_passes'].labels('soil').inc()
-        # Perform readings
+        :return: the readings
+        :rtype: List[Reading]
+        """
+        self.logger.debug(Lazy('sampling {}', self.DROP_IN_ID))
         self._connector.trigger()
+        return [
+            self.reading('temperature', self._connector.temp),
+            self.reading('capacitance', self._connector.moist),
+            self.reading('moisture', self._connector.moist_percent),
+            self.reading('brightness', self._connector.light)
+        ]
+
+    def sleep(self) -> None:
+        self._connector.sleep()
 
-        self._metrics['temperature'].labels('soil').set(self._connector.temp)
-        self._metrics['capacitance'].labels('soil').set(self._connector.moist)
-        self._metrics['moisture'].labels('soil').set(self._connector.moist_percent)
-        self._metrics['brightness'].labels('soil').set(self._connector.light)
+    def wake(self) -> None:
+        # `wake_up` would block the watcher for the whole wake time, which it waits for itself
+        self._connector.wake_up(wake_time=0)
 
-        self._metrics['state'].labels('soil').state('ready')
-        self.logger.debug('periodic upkeep succeeded')
+    def close(self) -> None:
+        """
+        Closes the SMBus handle opened by the Chirp connector.
+        """
+        with self.lock:
+            bus = getattr(self._connector, 'bus', None)
+            if bus is not None and callable(getattr(bus, 'close', None)):
+                bus.close()
+            super().close()
 
     def handler(self, context: dict = None) -> Optional[str]:
         pass
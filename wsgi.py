@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*
-from ancs import app
+from ancs.web import app
 
 if __name__ == "__main__":
     app.run()